@@ -15,11 +15,9 @@ from model.Superglue.dataset import pts_from_meter_to_pixel, pts_from_pixel_to_m
 from model.Superglue.dataset import input_transforms as superglue_input_transforms
 import torchvision.transforms.functional as TF
 # import model.Superglue.dataset
-from model.Superglue.verify import visualize_poi, visualize_matching
-
-import rospy
-from geometry_msgs.msg import PoseStamped
-from nav_msgs.msg import Path
+import multiprocessing
+import time
+from evaluation.localization_metrics import localization_report, save_report, TRAVELLED_DISTANCES
 
 parser = argparse.ArgumentParser(description='GlobalLocalization')
 parser.add_argument('--mode', type=str, default='train', help='Mode', choices=['train', 'test'])
@@ -44,8 +42,31 @@ parser.add_argument('--num_clusters', type=int, default=64, help='num_clusters')
 parser.add_argument('--final_dim', type=int, default=256, help='final_dim')
 parser.add_argument('--meters_per_pixel', type=float, default=0.20, help='meters_per_pixel')
 parser.add_argument('--top_k', type=int, default=3, help='top_k')
+parser.add_argument('--offline', action='store_true',
+                    help='evaluate without ROS nor display, database features are extracted once and queries '
+                         'are verified in parallel')
+parser.add_argument('--num_processes', type=int, default=4, help='processes verifying queries in offline mode')
+parser.add_argument('--report_file', type=str, default=None, help='json file of the localization report')
 args = parser.parse_args()
 
+# the weights are loaded from args.saved_model_path, see load_matching
+MATCHING_CONFIG = {
+    'superpoint': {
+        'nms_radius': 4,
+        'keypoint_threshold': 0.005,
+        'max_keypoints': -1,
+        'pretrained': False,
+    },
+    'Superglue': {
+        'weights': 'indoor',
+        'sinkhorn_iterations': 100,
+        'match_threshold': 0.2,
+        'pretrained': False,
+    }
+}
+MIN_INLIERS = 20
+MAX_INLIERS = 30
+
 
 def visualize_netvlad():
     base_model = BaseModel(300, 300)
@@ -300,8 +321,7 @@ def superglue_match(target_image, source_image, resolution : int, matching=None,
     return mkpts0, mkpts1, kpts0, kpts1
 
 
-def pipeline_test():
-    torch.set_grad_enabled(False)
+def load_spinetvlad():
     # Define model for embedding
     base_model = BaseModel(300, 300)
     net_vlad = NetVLAD(num_clusters=args.num_clusters, dim=256, alpha=1.0, outdim=args.final_dim)
@@ -311,7 +331,25 @@ def pipeline_test():
     model_checkpoint = torch.load(saved_model_file_spinetvlad, map_location=lambda storage, loc: storage)
     model.load_state_dict(model_checkpoint)
     print("Loaded spinetvlad checkpoints from \'{}\'.".format(saved_model_file_spinetvlad))
+    return model
+
+
+def load_matching(device):
+    matching = Matching(MATCHING_CONFIG).eval().to(device)
+
+    saved_model_file_superglue = os.path.join(args.saved_model_path, 'spsg-rotation-invariant.pth.tar')
+    # saved_model_file_superglue = os.path.join(args.saved_model_path, 'superglue-juxin.pth.tar')
+
+    model_checkpoint = torch.load(saved_model_file_superglue, map_location=lambda storage, loc: storage)
+    matching.load_state_dict(model_checkpoint)
+    print("Loaded superglue checkpoints from \'{}\'.".format(saved_model_file_superglue))
+    return matching
+
 
+def load_sequences():
+    """
+    :return: database_images_info, query_images_info, database_images_dir, query_images_dir
+    """
     # images_dir = os.path.join(args.dataset_dir, args.sequence)
     database_images_dir = os.path.join(args.dataset_dir, args.sequence)
     query_images_dir = os.path.join(args.dataset_dir, args.sequence)
@@ -327,33 +365,27 @@ def pipeline_test():
             struct_filename=os.path.join(args.dataset_dir, 'struct_file_' + args.sequence_query + '.txt'))
         database_images_dir = os.path.join(args.dataset_dir, args.sequence_database)
         query_images_dir = os.path.join(args.dataset_dir, args.sequence_query)
+    return database_images_info, query_images_info, database_images_dir, query_images_dir
+
+
+def pipeline_test():
+    # ROS and the display are only needed here, model.Superglue.verify parses the arguments of Superglue training
+    import rospy
+    from geometry_msgs.msg import PoseStamped
+    from nav_msgs.msg import Path
+    from model.Superglue.verify import visualize_poi, visualize_matching
+
+    torch.set_grad_enabled(False)
+    model = load_spinetvlad()
+    database_images_info, query_images_info, database_images_dir, query_images_dir = load_sequences()
 
     image_database = ImageDatabase(images_info=database_images_info,
                                    images_dir=database_images_dir, model=model,
                                    generate_database=True,
                                    transforms=input_transforms())
 
-    config = {
-        'superpoint': {
-            'nms_radius': 4,
-            'keypoint_threshold': 0.005,
-            'max_keypoints': -1
-        },
-        'Superglue': {
-            'weights': 'indoor',
-            'sinkhorn_iterations': 100,
-            'match_threshold': 0.2,
-        }
-    }
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    matching = Matching(config).eval().to(device)
-
-    saved_model_file_superglue = os.path.join(args.saved_model_path, 'spsg-rotation-invariant.pth.tar')
-    # saved_model_file_superglue = os.path.join(args.saved_model_path, 'superglue-juxin.pth.tar')
-
-    model_checkpoint = torch.load(saved_model_file_superglue, map_location=lambda storage, loc: storage)
-    matching.load_state_dict(model_checkpoint)
-    print("Loaded superglue checkpoints from \'{}\'.".format(saved_model_file_superglue))
+    matching = load_matching(device)
 
     translation_errors = []
     rotation_errors = []
@@ -390,8 +422,8 @@ def pipeline_test():
         T_w_source_best = None
         target_image_best = None
 
-        min_inliers = 20
-        max_inliers = 30
+        min_inliers = MIN_INLIERS
+        max_inliers = MAX_INLIERS
         # min_inliers = 0
         # max_inliers = 0
         resolution = int(100 / args.meters_per_pixel)
@@ -572,56 +604,201 @@ def pipeline_test():
         # translation_errors.append(float('nan'))
         # print('accumulated_distance', accumulated_distance)
 
-    translation_errors = np.array(translation_errors)
-    rotation_errors = np.array(rotation_errors)
-    print('Mean translation error: {}'.format(translation_errors.mean()))
-    for r in [0.1, 0.2, 0.3, 0.5, 0.8, 1.0, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
-        print('Percentage of translation errors under {} m: {}'.format(r, (translation_errors<r).sum() / len(translation_errors)))
-    for theta in [1.0, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
-        print('Percentage of rotation errors under {} degrees: {}'.format(theta, (rotation_errors<theta).sum() / len(rotation_errors)))
+    print_localization_report(translation_errors, rotation_errors, success_records, accumulated_distance,
+                              len(query_images_info))
 
-    plt.scatter(np.linspace(0, len(translation_errors), num=len(translation_errors)), np.array(translation_errors))
-    plt.xlabel("SPI id")
-    plt.ylabel("translation error")
-    plt.show()
 
-    travelled_distances = [0.2, 0.4, 0.6, 0.8, 1.0, 1.5, 2, 3, 4, 5, 6, 8, 10, 15, 20, 25, 30, 35, 40, 45, 50]
-    probabilities = []
-    for thres_distance in travelled_distances:
-        probabilities.append(localization_probability(accumulated_distance, np.array(success_records), thres_distance))
-    plt.plot(travelled_distances, probabilities, lw=1)
-    # plt.plot([0, 1], [0, 1], '--', color=(0.6, 0.6, 0.6), label="Luck")
-    plt.xlabel("travelled distance")
-    plt.ylabel("probabilities")
-    # plt.show()
+def image_info_pose(image_info):
+    """
+    :return: T_w_image: 4 * 4
+    """
+    T_w_image = np.hstack([R.from_quat(image_info['orientation'][[1, 2, 3, 0]]).as_matrix(),
+                           image_info['position'].reshape(3, 1)])
+    return np.vstack([T_w_image, np.array([0, 0, 0, 1])])
 
-    translation_errors = translation_errors[~np.isnan(translation_errors)]
-    rotation_errors = rotation_errors[~np.isnan(rotation_errors)]
 
-    trans_err_avg = translation_errors.mean()
-    trans_err_std = translation_errors - trans_err_avg
-    trans_err_std = np.sqrt((trans_err_std * trans_err_std).mean())
-    print("average translation error: {}".format(trans_err_avg))
-    print("standard deviation of translation error: {}".format(trans_err_std))
+def spi_tensor(image_file, resolution, device):
+    tf = transforms.Compose([
+        transforms.Resize(size=(resolution, resolution)),
+        transforms.ToTensor(),
+    ])
+    return tf(Image.open(image_file)).float()[None].to(device)
 
-    rotation_err_avg = rotation_errors.mean()
-    rotation_err_std = rotation_errors - rotation_err_avg
-    rotation_err_std = np.sqrt((rotation_err_std * rotation_err_std).mean())
-    print("average rotation_errors error: {}".format(rotation_err_avg))
-    print("standard deviation of rotation_errors error: {}".format(rotation_err_std))
 
-    print("recall: {}".format(len(translation_errors) / len(query_images_info)))
+@torch.no_grad()
+def extract_superpoint_features(matching, images_files, resolution, device):
+    """
+    :return: list of SuperPoint features of the images, as numpy arrays
+    """
+    features = []
+    for image_file in tqdm(images_files):
+        pred = matching.superpoint({'image': spi_tensor(image_file, resolution, device)})
+        features.append({k: v[0].cpu().numpy() for k, v in pred.items()})
+    return features
 
 
-    pass
+@torch.no_grad()
+def localize_query(matching, query_image_file, candidates, resolution, device):
+    """
+    Verify the candidates of a query as pipeline_test does, with the features of the candidates precomputed
+    :param candidates: list of (SuperPoint features, T_w_target) of the retrieved database SPIs
+    :return: T_w_source_best: 4 * 4, None if no candidate is verified
+    """
+    source_image = spi_tensor(query_image_file, resolution, device)
+    pred1 = matching.superpoint({'image': source_image})
+    best_score = -1
+    T_w_source_best = None
+    for target_features, T_w_target in candidates:
+        data = {
+            # only the shape of image0 is used by SuperGlue
+            'image0': source_image, 'image1': source_image,
+            **{k + '0': [torch.from_numpy(v).to(device)] for k, v in target_features.items()},
+            **{k + '1': v for k, v in pred1.items()},
+        }
+        pred = matching(data)
+        kpts0 = target_features['keypoints']
+        kpts1 = pred1['keypoints'][0].cpu().numpy()
+        matches = pred['matches0'][0].cpu().numpy()
+        valid = matches > -1
+        target_kpts_in_meters = pts_from_pixel_to_meter(kpts0[valid], args.meters_per_pixel)
+        source_kpts_in_meters = pts_from_pixel_to_meter(kpts1[matches[valid]], args.meters_per_pixel)
+        T_target_source, score = compute_relative_pose_with_ransac_test(target_kpts_in_meters, source_kpts_in_meters)
+        if score is None:
+            continue
+        if score > best_score and score > MIN_INLIERS and best_score < MAX_INLIERS:
+            best_score = score
+            T_target_source = np.array([[T_target_source[0, 0], T_target_source[0, 1], 0, T_target_source[0, 2]],
+                                        [T_target_source[1, 0], T_target_source[1, 1], 0, T_target_source[1, 2]],
+                                        [0, 0, 1, 0],
+                                        [0, 0, 0, 1]])
+            T_w_source_best = T_w_target @ T_target_source
+        if best_score > MAX_INLIERS:
+            break
+    return T_w_source_best
+
+
+_offline_worker = {}
+
+
+def _init_offline_worker(num_threads):
+    torch.set_num_threads(num_threads)
+    _offline_worker['matching'] = load_matching(torch.device('cpu'))
+
+
+def _localize_query_in_worker(job):
+    query_image_file, candidates = job
+    return localize_query(_offline_worker['matching'], query_image_file, candidates,
+                          int(100 / args.meters_per_pixel), torch.device('cpu'))
+
+
+def offline_evaluation():
+    """
+    pipeline_test without ROS nor display: descriptors and SuperPoint features of the database are extracted
+    once, queries are retrieved in a single batch and verified by args.num_processes processes
+    """
+    torch.set_grad_enabled(False)
+    t0 = time.time()
+    model = load_spinetvlad()
+    database_images_info, query_images_info, database_images_dir, query_images_dir = load_sequences()
+    image_database = ImageDatabase(images_info=database_images_info,
+                                   images_dir=database_images_dir, model=model,
+                                   generate_database=True,
+                                   transforms=input_transforms())
+    query_encodings = image_database.encode_images(query_images_info, query_images_dir)
+    _, indices = image_database.index.search(query_encodings, args.top_k + 1)
+    # avoid the same image from database
+    indices = indices[:, :args.top_k] if args.use_different_sequence else indices[:, 1:args.top_k + 1]
 
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    matching = load_matching(device)
+    resolution = int(100 / args.meters_per_pixel)
+    candidate_indices = np.unique(indices[indices >= 0])
+    print("Extracting SuperPoint features of {} candidate SPIs".format(len(candidate_indices)))
+    database_features = dict(zip(candidate_indices.tolist(), extract_superpoint_features(
+        matching, [os.path.join(database_images_dir, database_images_info[i]['image_file'])
+                   for i in candidate_indices], resolution, device)))
+
+    jobs = [(os.path.join(query_images_dir, query_image_info['image_file']),
+             [(database_features[i], image_info_pose(database_images_info[i])) for i in query_indices if i >= 0])
+            for query_image_info, query_indices in zip(query_images_info, indices.tolist())]
+    if args.num_processes > 1:
+        num_threads = max(1, multiprocessing.cpu_count() // args.num_processes)
+        with multiprocessing.Pool(args.num_processes, initializer=_init_offline_worker,
+                                  initargs=(num_threads,)) as pool:
+            results = list(tqdm(pool.imap(_localize_query_in_worker, jobs, chunksize=4), total=len(jobs)))
+    else:
+        results = [localize_query(matching, query_image_file, candidates, resolution, device)
+                   for query_image_file, candidates in tqdm(jobs)]
+
+    translation_errors = []
+    rotation_errors = []
+    success_records = []
+    accumulated_distance = 0
+    last_T_w_source_gt = None
+    for query_image_info, T_w_source_best in zip(query_images_info, results):
+        T_w_source_gt = image_info_pose(query_image_info)
+        # record travelled distance
+        if last_T_w_source_gt is not None:
+            T_last_current = np.linalg.inv(last_T_w_source_gt) @ T_w_source_gt
+            accumulated_distance += np.sqrt(T_last_current[:3, 3] @ T_last_current[:3, 3])
+        last_T_w_source_gt = T_w_source_gt
+
+        if T_w_source_best is not None:
+            delta_T_w_source = np.linalg.inv(T_w_source_best) @ T_w_source_gt
+            translation_errors.append(np.sqrt(delta_T_w_source[:3, 3] @ delta_T_w_source[:3, 3]))
+            rotation_errors.append(np.arccos(min(1, 0.5 * (np.trace(delta_T_w_source[:3, :3]) - 1))) / np.pi * 180)
+            success_records.append((accumulated_distance, True))
+        else:
+            success_records.append((accumulated_distance, False))
+
+    print("Evaluated {} queries in {:.1f} s".format(len(query_images_info), time.time() - t0))
+    print_localization_report(translation_errors, rotation_errors, success_records, accumulated_distance,
+                              len(query_images_info), show_plots=False)
 
-def localization_probability(total_distance, localization_results, thres_distance):
-    num_intervals = int(total_distance / thres_distance) + 1
-    success = np.zeros(num_intervals)
-    for result in localization_results:
-        success[int(result[0] / thres_distance)] = 1
-    return 1 - success.mean()
+
+def print_localization_report(translation_errors, rotation_errors, success_records, accumulated_distance,
+                              num_queries, show_plots=True):
+    """
+    :param success_records: list of (travelled distance, localized) of the queries in order
+    """
+    report = localization_report(translation_errors, rotation_errors, success_records, accumulated_distance,
+                                 num_queries)
+    print('Mean translation error: {}'.format(report['translation_error']['mean']))
+    for r, ratio in report['translation_error']['ratio_under'].items():
+        print('Percentage of translation errors under {} m: {}'.format(r, ratio))
+    for theta, ratio in report['rotation_error']['ratio_under'].items():
+        print('Percentage of rotation errors under {} degrees: {}'.format(theta, ratio))
+
+    plt.scatter(np.linspace(0, len(translation_errors), num=len(translation_errors)), np.array(translation_errors))
+    plt.xlabel("SPI id")
+    plt.ylabel("translation error")
+    if show_plots:
+        plt.show()
+
+    # former definition, comparable with earlier reports: 1 - fraction of the intervals holding any query
+    for thres_distance, probability in report['localization_probability'].items():
+        print('Localization probability over {} m: {}'.format(thres_distance, probability))
+    for thres_distance, probability in report['probability_localized_within'].items():
+        print('Probability of localizing within {} m (successful localizations only): {}'.format(
+            thres_distance, probability))
+    plt.plot(TRAVELLED_DISTANCES, list(report['probability_localized_within'].values()), lw=1,
+             label="localized within")
+    plt.plot(TRAVELLED_DISTANCES, list(report['localization_probability'].values()), lw=1,
+             label="former localization probability")
+    plt.legend()
+    # plt.plot([0, 1], [0, 1], '--', color=(0.6, 0.6, 0.6), label="Luck")
+    plt.xlabel("travelled distance")
+    plt.ylabel("probabilities")
+    # plt.show()
+
+    print("average translation error: {}".format(report['translation_error']['mean']))
+    print("standard deviation of translation error: {}".format(report['translation_error']['std']))
+    print("average rotation_errors error: {}".format(report['rotation_error']['mean']))
+    print("standard deviation of rotation_errors error: {}".format(report['rotation_error']['std']))
+    print("recall: {}".format(report['recall']))
+
+    if args.report_file is not None:
+        save_report(report, args.report_file)
 
 
 if __name__ == '__main__':
@@ -664,4 +841,7 @@ if __name__ == '__main__':
     ##############################################
     # global localization pipeline matching test #
     ##############################################
-    pipeline_test()
+    if args.offline:
+        offline_evaluation()
+    else:
+        pipeline_test()
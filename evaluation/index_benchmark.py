@@ -0,0 +1,108 @@
+import argparse
+import json
+import time
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from model.Birdview.vlad_index import VladIndex
+
+
+parser = argparse.ArgumentParser(description='IndexBenchmark')
+parser.add_argument('--descriptors_file', type=str, default=None,
+                    help='.npy file of N * D NetVLAD descriptors, random descriptors are used if not given')
+parser.add_argument('--num_database', type=int, default=200000, help='number of random database descriptors')
+parser.add_argument('--num_queries', type=int, default=1000, help='number of queries')
+parser.add_argument('--dim', type=int, default=256, help='dimension of random descriptors')
+parser.add_argument('--top_k', type=int, default=3, help='top_k')
+parser.add_argument('--index_types', type=str, default='ivf_flat,ivf_pq,hnsw', help='index types to compare with flat')
+parser.add_argument('--nlist', type=int, default=1024, help='nlist')
+parser.add_argument('--pq_m', type=int, default=32, help='pq_m')
+parser.add_argument('--nprobes', type=str, default='1,4,16,64', help='nprobe values of IVF indices')
+parser.add_argument('--ef_searches', type=str, default='16,32,64,128', help='efSearch values of HNSW')
+parser.add_argument('--output_file', type=str, default=None, help='json file of the results')
+args = parser.parse_args()
+
+
+def make_descriptors():
+    """
+    :return: database_descriptors: N * D, query_descriptors: M * D
+    """
+    if args.descriptors_file is not None:
+        descriptors = np.load(args.descriptors_file).astype(np.float32)
+        database_descriptors, query_descriptors = train_test_split(descriptors, test_size=args.num_queries,
+                                                                   random_state=10)
+        return np.ascontiguousarray(database_descriptors), np.ascontiguousarray(query_descriptors)
+
+    # clustered random descriptors, queries are noisy copies of database descriptors
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((256, args.dim)).astype(np.float32)
+    database_descriptors = centers[rng.integers(0, len(centers), args.num_database)] \
+        + 0.5 * rng.standard_normal((args.num_database, args.dim)).astype(np.float32)
+    database_descriptors /= np.linalg.norm(database_descriptors, axis=1, keepdims=True)
+    query_descriptors = database_descriptors[rng.integers(0, args.num_database, args.num_queries)] \
+        + 0.05 * rng.standard_normal((args.num_queries, args.dim)).astype(np.float32)
+    query_descriptors /= np.linalg.norm(query_descriptors, axis=1, keepdims=True)
+    return database_descriptors, query_descriptors
+
+
+def timed_search(index, query_descriptors):
+    """
+    :return: indices: M * k, latency per query in ms
+    """
+    # one query at a time, as in GlobalLocalizer
+    indices = np.zeros((len(query_descriptors), args.top_k), dtype=np.int64)
+    t0 = time.perf_counter()
+    for i, query_descriptor in enumerate(query_descriptors):
+        _, indices[i] = index.search(query_descriptor[None, ...], args.top_k)
+    return indices, (time.perf_counter() - t0) / len(query_descriptors) * 1e3
+
+
+def recall(indices, ground_truth_indices):
+    """ Fraction of the exact top k found """
+    hits = [len(np.intersect1d(result, ground_truth)) for result, ground_truth in zip(indices, ground_truth_indices)]
+    return np.sum(hits) / ground_truth_indices.size
+
+
+def benchmark():
+    database_descriptors, query_descriptors = make_descriptors()
+    dim = database_descriptors.shape[1]
+    print("database: {}, queries: {}, dim: {}".format(len(database_descriptors), len(query_descriptors), dim))
+
+    flat_index = VladIndex(dim, {'type': 'flat'})
+    flat_index.add(database_descriptors)
+    ground_truth_indices, flat_latency = timed_search(flat_index, query_descriptors)
+    results = [{'type': 'flat', 'recall': 1.0, 'latency_ms': flat_latency, 'build_s': 0.}]
+
+    for index_type in args.index_types.split(','):
+        config = {'type': index_type, 'nlist': args.nlist, 'pq_m': args.pq_m}
+        t0 = time.perf_counter()
+        index = VladIndex(dim, config)
+        index.add(database_descriptors)
+        if not index.train():
+            print("Too few database descriptors to train a {} index, it is searched as a flat index".format(index_type))
+        build_time = time.perf_counter() - t0
+        if index_type == 'hnsw':
+            search_parameters = [{'ef_search': int(ef_search)} for ef_search in args.ef_searches.split(',')]
+        else:
+            search_parameters = [{'nprobe': int(nprobe)} for nprobe in args.nprobes.split(',')]
+        for parameters in search_parameters:
+            index.set_search_parameters(**parameters)
+            indices, latency = timed_search(index, query_descriptors)
+            results.append({'type': index_type, **parameters, 'recall': recall(indices, ground_truth_indices),
+                            'latency_ms': latency, 'build_s': build_time})
+
+    for result in results:
+        parameters = ', '.join('{}={}'.format(key, result[key]) for key in ['nprobe', 'ef_search'] if key in result)
+        print("{:>9} {:<14} recall@{}: {:.4f}  latency: {:.3f} ms  speedup: {:.1f}x  build: {:.1f} s".format(
+            result['type'], parameters, args.top_k, result['recall'], result['latency_ms'],
+            flat_latency / result['latency_ms'], result['build_s']))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {}".format(args.output_file))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+
+from global_localization.common.image_info import make_images_info
+from global_localization.online.feature_extractor import FeatureExtractor
+from global_localization.online.pose_estimator import PoseEstimator
+
+
+parser = argparse.ArgumentParser(description='KeypointBudgetBenchmark')
+parser.add_argument('--dataset_dir', type=str, default='/media/li/lavie/dataset/birdview_dataset/', help='dataset_dir')
+parser.add_argument('--sequence_database', type=str, default='juxin_1023_map', help='sequence_database')
+parser.add_argument('--sequence_query', type=str, default='juxin_1023_map', help='sequence_query')
+parser.add_argument('--saved_model_path', type=str,
+                    default='/media/li/lavie/dataset/birdview_dataset/saved_models', help='saved_model_path')
+parser.add_argument('--meters_per_pixel', type=float, default=0.25, help='meters_per_pixel')
+parser.add_argument('--scale', type=float, default=100, help='size of SPIs in meters')
+parser.add_argument('--policies', type=str, default='top_k,grid', help='keypoint budget policies')
+parser.add_argument('--budgets', type=str, default='128,256,512,1024,-1', help='keypoint budgets, -1 for all keypoints')
+parser.add_argument('--grid_cells', type=int, default=8, help='grid_cells of the grid policy')
+parser.add_argument('--max_pair_distance', type=float, default=10, help='max distance of a query to its database SPI')
+parser.add_argument('--num_queries', type=int, default=200, help='number of queries')
+parser.add_argument('--translation_tolerance', type=float, default=2.0, help='meters')
+parser.add_argument('--rotation_tolerance', type=float, default=5.0, help='degrees')
+parser.add_argument('--min_inliers', type=int, default=20, help='min_inliers')
+parser.add_argument('--output_file', type=str, default=None, help='json file of the results')
+args = parser.parse_args()
+
+
+def make_pairs():
+    """
+    Pair each query SPI with the nearest database SPI
+    :return: list of (database image info, query image info)
+    """
+    database_images_info = make_images_info(
+        os.path.join(args.dataset_dir, 'struct_file_' + args.sequence_database + '.txt'))
+    query_images_info = make_images_info(
+        os.path.join(args.dataset_dir, 'struct_file_' + args.sequence_query + '.txt'))
+    same_sequence = args.sequence_database == args.sequence_query
+    tree = cKDTree(np.array([image_info['pose'][:3, 3] for image_info in database_images_info]))
+    pairs = []
+    for i, query_image_info in enumerate(query_images_info):
+        # the second nearest SPI is used within the same sequence, the nearest one is the query itself
+        k = 2 if same_sequence else 1
+        distances, indices = tree.query(query_image_info['pose'][:3, 3], k=k)
+        distance, index = (distances[-1], indices[-1]) if same_sequence else (distances, indices)
+        if distance < args.max_pair_distance:
+            pairs.append((database_images_info[index], query_image_info))
+    rng = np.random.default_rng(0)
+    if len(pairs) > args.num_queries:
+        pairs = [pairs[i] for i in sorted(rng.choice(len(pairs), args.num_queries, replace=False))]
+    return pairs
+
+
+def load_image(images_dir, image_info, resolution):
+    image = cv2.imread(os.path.join(images_dir, image_info['image_file']), cv2.IMREAD_GRAYSCALE)
+    return cv2.resize(image, (resolution, resolution), interpolation=cv2.INTER_LINEAR)
+
+
+def pose_error(T_target_source, T_w_target, T_w_source):
+    """
+    :param T_target_source: 3 * 3, estimated 2D pose
+    :return: translation error in meters, rotation error in degrees
+    """
+    T_target_source_gt = np.linalg.inv(T_w_target) @ T_w_source
+    translation_error = np.linalg.norm(np.asarray(T_target_source[:2, 2]) - T_target_source_gt[:2, 3])
+    yaw = np.arctan2(T_target_source[1, 0], T_target_source[0, 0])
+    yaw_gt = np.arctan2(T_target_source_gt[1, 0], T_target_source_gt[0, 0])
+    rotation_error = np.degrees(np.abs(np.arctan2(np.sin(yaw - yaw_gt), np.cos(yaw - yaw_gt))))
+    return float(translation_error), float(rotation_error)
+
+
+def benchmark():
+    resolution = int(args.scale / args.meters_per_pixel)
+    pose_estimator = PoseEstimator({
+        'superglue': {
+            'weights': 'outdoor',
+            'sinkhorn_iterations': 100,
+            'match_threshold': 0.2,
+        },
+        'saved_model_path': args.saved_model_path,
+        'meters_per_pixel': args.meters_per_pixel,
+        'scale': args.scale,
+    })
+    pairs = make_pairs()
+    print("{} query / database pairs".format(len(pairs)))
+    database_images_dir = os.path.join(args.dataset_dir, args.sequence_database)
+    query_images_dir = os.path.join(args.dataset_dir, args.sequence_query)
+    images = [(load_image(database_images_dir, target, resolution), load_image(query_images_dir, source, resolution))
+              for target, source in tqdm(pairs)]
+
+    results = []
+    for policy in args.policies.split(','):
+        feature_extractor = FeatureExtractor({
+            'saved_model_path': args.saved_model_path,
+            'keypoint_budget': {'policy': policy, 'grid_cells': args.grid_cells},
+        })
+        for budget in [int(budget) for budget in args.budgets.split(',')]:
+            feature_extractor.keypoint_budget_ = budget
+            num_keypoints, extraction_latencies, matching_latencies = [], [], []
+            translation_errors, rotation_errors, successes = [], [], []
+            for (target, source), (target_image, source_image) in zip(tqdm(pairs), images):
+                t0 = time.perf_counter()
+                target_features = feature_extractor.extract_features(target_image)
+                source_features = feature_extractor.extract_features(source_image)
+                t1 = time.perf_counter()
+                T_target_source, score = pose_estimator.estimate_pose({'features': source_features},
+                                                                      {'features': target_features})
+                t2 = time.perf_counter()
+                num_keypoints.append(len(source_features['keypoints'][0]))
+                extraction_latencies.append((t1 - t0) / 2)
+                matching_latencies.append(t2 - t1)
+                if T_target_source is None or score < args.min_inliers:
+                    successes.append(False)
+                    continue
+                translation_error, rotation_error = pose_error(T_target_source, target['pose'], source['pose'])
+                translation_errors.append(translation_error)
+                rotation_errors.append(rotation_error)
+                successes.append(translation_error < args.translation_tolerance and
+                                 rotation_error < args.rotation_tolerance)
+            results.append({
+                'policy': policy,
+                'budget': budget,
+                'mean_keypoints': float(np.mean(num_keypoints)),
+                'success_rate': float(np.mean(successes)),
+                'median_translation_error': float(np.median(translation_errors)) if translation_errors else None,
+                'median_rotation_error': float(np.median(rotation_errors)) if rotation_errors else None,
+                'extraction_latency_ms': float(np.mean(extraction_latencies) * 1e3),
+                'matching_latency_ms': float(np.mean(matching_latencies) * 1e3),
+                'matching_latency_p95_ms': float(np.percentile(matching_latencies, 95) * 1e3),
+            })
+
+    for result in results:
+        print("{:>6} budget {:>5}  keypoints: {:7.1f}  success: {:.3f}  median error: {} m / {} deg  "
+              "extraction: {:.1f} ms  matching: {:.1f} ms (p95 {:.1f} ms)".format(
+            result['policy'], result['budget'], result['mean_keypoints'], result['success_rate'],
+            None if result['median_translation_error'] is None else round(result['median_translation_error'], 3),
+            None if result['median_rotation_error'] is None else round(result['median_rotation_error'], 3),
+            result['extraction_latency_ms'], result['matching_latency_ms'], result['matching_latency_p95_ms']))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {}".format(args.output_file))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import resource
+import time
+
+# CPU only, so that results are comparable between machines
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from global_localization.common.image_info import make_images_info
+from global_localization.online.global_localizer import GlobalLocalizer
+
+
+parser = argparse.ArgumentParser(description='LocalizationBenchmark')
+parser.add_argument('--database_struct_file', type=str, default=None,
+                    help='struct file of the database SPIs, a synthetic database is used if not given')
+parser.add_argument('--database_images_dir', type=str, default=None, help='database_images_dir')
+parser.add_argument('--database_cache_dir', type=str, default=None, help='database_cache_dir')
+parser.add_argument('--query_struct_file', type=str, default=None,
+                    help='struct file of the query SPIs, synthetic queries are used if not given')
+parser.add_argument('--query_images_dir', type=str, default=None, help='query_images_dir')
+parser.add_argument('--saved_model_path', type=str,
+                    default='/media/li/lavie/dataset/birdview_dataset/saved_models', help='saved_model_path')
+parser.add_argument('--num_database', type=int, default=10000, help='size of the synthetic database')
+parser.add_argument('--num_distinct_images', type=int, default=16,
+                    help='number of distinct synthetic SPIs, their features are shared by the synthetic database')
+parser.add_argument('--image_size', type=int, default=1000, help='size of synthetic SPIs in pixels')
+parser.add_argument('--num_queries', type=int, default=200, help='number of queries')
+parser.add_argument('--warmup', type=int, default=10, help='number of queries run before measuring')
+parser.add_argument('--top_k', type=int, default=3, help='top_k')
+parser.add_argument('--index_type', type=str, default='flat', help='type of VladIndex')
+parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnxruntime'],
+                    help='backend of NetVLAD and SuperPoint, exported models are read from saved_model_path')
+parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 for the torch default')
+parser.add_argument('--seed', type=int, default=0, help='seed')
+parser.add_argument('--output_file', type=str, default=None, help='json file of the results')
+args = parser.parse_args()
+
+
+def make_synthetic_spi(rng, size):
+    """ Random road-like structures: lines and blobs on a dark background """
+    image = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(40):
+        p0, p1 = rng.integers(0, size, 2), rng.integers(0, size, 2)
+        cv2.line(image, tuple(int(v) for v in p0), tuple(int(v) for v in p1), int(rng.integers(100, 255)),
+                 int(rng.integers(2, 8)))
+    for _ in range(80):
+        center = rng.integers(0, size, 2)
+        cv2.circle(image, tuple(int(v) for v in center), int(rng.integers(2, 15)), int(rng.integers(100, 255)), -1)
+    return image
+
+
+def perturb_spi(rng, image):
+    """ Rotate and shift an SPI, as seen from a nearby pose """
+    size = image.shape[0]
+    matrix = cv2.getRotationMatrix2D((size / 2, size / 2), float(rng.uniform(-180, 180)), 1.0)
+    matrix[:, 2] += rng.uniform(-0.05, 0.05, 2) * size
+    return cv2.warpAffine(image, matrix, (size, size))
+
+
+def random_pose(rng, extent=1000.):
+    pose = np.identity(4)
+    pose[:2, 3] = rng.uniform(0, extent, 2)
+    return pose
+
+
+def make_localizer():
+    config = {
+        "top_k": args.top_k,
+        "index": {"type": args.index_type},
+        "profiling": {"enabled": True},
+        "place_recognizer": {"saved_model_path": args.saved_model_path, "backend": args.backend},
+        "feature_extractor": {"saved_model_path": args.saved_model_path, "backend": args.backend},
+        "pose_estimator": {"saved_model_path": args.saved_model_path},
+    }
+    if args.database_struct_file is not None:
+        config.update({
+            "pure_localization": True,
+            "database_struct_file": args.database_struct_file,
+            "database_images_dir": args.database_images_dir,
+            "database_cache_dir": args.database_cache_dir,
+        })
+    else:
+        # the synthetic database is filled below
+        config["pure_localization"] = False
+    return GlobalLocalizer(config)
+
+
+def fill_synthetic_database(localizer, rng):
+    """
+    :return: distinct synthetic SPIs the database was made of
+    """
+    images = [make_synthetic_spi(rng, args.image_size) for _ in range(args.num_distinct_images)]
+    distinct_images_info = []
+    for i, image in enumerate(tqdm(images)):
+        spinetvlad_image, features_image = localizer.preprocess_spi(image)
+        distinct_images_info.append(localizer.extract_spi(spinetvlad_image, features_image, random_pose(rng), i))
+
+    images_info, descriptors = [], []
+    for i in range(args.num_database):
+        base_image_info = distinct_images_info[i % len(distinct_images_info)]
+        descriptor = base_image_info['vlad'] + 0.1 * rng.standard_normal(base_image_info['vlad'].shape)
+        descriptor = (descriptor / np.linalg.norm(descriptor)).astype(np.float32)
+        images_info.append({
+            'image_file': "synthetic_{}.png".format(i),
+            'timestamp': 0.,
+            'pose': random_pose(rng),
+            'vlad': descriptor,
+            'features': base_image_info['features'],
+        })
+        descriptors.append(descriptor)
+    localizer.map_.extend(images_info, np.stack(descriptors))
+    localizer.map_.index_.train()
+    # queries are only localized from now on
+    localizer.pure_localization_ = True
+    return images
+
+
+def make_queries(rng, database_images):
+    """
+    :return: list of (image, pose, seq)
+    """
+    num_queries = args.num_queries + args.warmup
+    if args.query_struct_file is not None:
+        images_info = make_images_info(args.query_struct_file)
+        indices = rng.choice(len(images_info), min(num_queries, len(images_info)), replace=False)
+        return [(cv2.imread(os.path.join(args.query_images_dir, images_info[i]['image_file']), cv2.IMREAD_GRAYSCALE),
+                 images_info[i]['pose'], seq) for seq, i in enumerate(indices)]
+    if database_images is None:
+        database_images = [make_synthetic_spi(rng, args.image_size) for _ in range(args.num_distinct_images)]
+    return [(perturb_spi(rng, database_images[rng.integers(len(database_images))]), random_pose(rng), seq)
+            for seq in range(num_queries)]
+
+
+def summarize(latencies):
+    latencies = np.array(latencies) * 1e3
+    return {
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+def benchmark():
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    localizer = make_localizer()
+    database_images = fill_synthetic_database(localizer, rng) if args.database_struct_file is None else None
+    queries = make_queries(rng, database_images)
+    print("database: {} SPIs, queries: {}".format(len(localizer.map_), len(queries)))
+
+    for image, pose, seq in queries[:args.warmup]:
+        localizer.handle_slam_spi(image, pose, seq)
+    localizer.profiler_.reset()
+
+    latencies, successes = [], []
+    t0 = time.perf_counter()
+    for image, pose, seq in tqdm(queries[args.warmup:]):
+        t = time.perf_counter()
+        T_w_source, score = localizer.handle_slam_spi(image, pose, seq)
+        latencies.append(time.perf_counter() - t)
+        successes.append(T_w_source is not None)
+    total_time = time.perf_counter() - t0
+
+    # quantiles of the stages are bucket upper bounds of the profiler histograms
+    stages = {name: {'count': stage['count'], **{key + '_ms': stage[key] * 1e3 for key in ['mean', 'p50', 'p95', 'p99', 'max']}}
+              for name, stage in localizer.profiler_.as_dict().items()}
+    results = {
+        'settings': {
+            'database': args.database_struct_file or 'synthetic',
+            'database_size': len(localizer.map_),
+            'queries': args.query_struct_file or 'synthetic',
+            'num_queries': len(latencies),
+            'top_k': args.top_k,
+            'index_type': args.index_type,
+            'backend': args.backend,
+            'num_threads': torch.get_num_threads(),
+            'torch_version': torch.__version__,
+            'seed': args.seed,
+        },
+        'latency': summarize(latencies),
+        'queries_per_second': len(latencies) / total_time,
+        'success_rate': float(np.mean(successes)),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'stages': stages,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {}".format(args.output_file))
+
+
+if __name__ == '__main__':
+    benchmark()
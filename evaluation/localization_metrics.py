@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+
+
+TRANSLATION_THRESHOLDS = [0.1, 0.2, 0.3, 0.5, 0.8, 1.0, 2, 3, 4, 5, 6, 7, 8, 9, 10]  # meters
+ROTATION_THRESHOLDS = [1.0, 2, 3, 4, 5, 6, 7, 8, 9, 10]  # degrees
+TRAVELLED_DISTANCES = [0.2, 0.4, 0.6, 0.8, 1.0, 1.5, 2, 3, 4, 5, 6, 8, 10, 15, 20, 25, 30, 35, 40, 45, 50]  # meters
+
+
+def localization_probabilities(success_records, total_distance, thres_distances=TRAVELLED_DISTANCES,
+                               legacy=False):
+    """
+    Probability of localizing at least once while travelling a distance: the drive is split into
+    intervals of each distance, and the fraction of intervals with a successful localization is counted.
+    All the intervals of all the distances are searched at once in the sorted distances of the successes.
+    :param success_records: N * 2, (travelled distance, localized) of the queries
+    :param total_distance: travelled distance of the whole drive
+    :param legacy: definition of the former localization_probability, 1 - fraction of the intervals holding
+                   any query, localized or not
+    :return: probabilities, one per distance of thres_distances
+    """
+    records = np.asarray(success_records, dtype=np.float64).reshape(-1, 2)
+    successes = np.sort(records[:, 0] if legacy else records[records[:, 1] > 0, 0])
+    thres_distances = np.asarray(thres_distances, dtype=np.float64)
+    num_intervals = np.floor(total_distance / thres_distances).astype(np.int64) + 1
+    starts = np.cumsum(num_intervals) - num_intervals
+    interval_indices = np.arange(num_intervals.sum()) - np.repeat(starts, num_intervals)
+    lengths = np.repeat(thres_distances, num_intervals)
+    # successes in [k * d, (k + 1) * d)
+    lower = np.searchsorted(successes, interval_indices * lengths, side='left')
+    upper = np.searchsorted(successes, (interval_indices + 1) * lengths, side='left')
+    coverage = np.add.reduceat((upper > lower).astype(np.int64), starts) / num_intervals
+    return 1 - coverage if legacy else coverage
+
+
+def _ratios_under(errors, thresholds):
+    return {str(threshold): float(np.mean(errors < threshold)) if len(errors) > 0 else None
+            for threshold in thresholds}
+
+
+def _mean_std(errors):
+    if len(errors) == 0:
+        return None, None
+    return float(errors.mean()), float(errors.std())
+
+
+def localization_report(translation_errors, rotation_errors, success_records, total_distance, num_queries):
+    """
+    :param translation_errors: meters, of the localized queries
+    :param rotation_errors: degrees, of the localized queries
+    :param success_records: (travelled distance, localized) of all the queries
+    :return: dict of the error statistics and the localization probabilities, None when undefined.
+             'localization_probability' keeps the former definition, comparable with earlier reports, and
+             'probability_localized_within' is the probability of localizing within each travelled distance,
+             see localization_probabilities
+    """
+    translation_errors = np.asarray(translation_errors, dtype=np.float64)
+    rotation_errors = np.asarray(rotation_errors, dtype=np.float64)
+    translation_errors = translation_errors[~np.isnan(translation_errors)]
+    rotation_errors = rotation_errors[~np.isnan(rotation_errors)]
+    translation_mean, translation_std = _mean_std(translation_errors)
+    rotation_mean, rotation_std = _mean_std(rotation_errors)
+    probabilities = localization_probabilities(success_records, total_distance)
+    legacy_probabilities = localization_probabilities(success_records, total_distance, legacy=True)
+    return {
+        'num_queries': num_queries,
+        'num_localized': len(translation_errors),
+        'recall': len(translation_errors) / num_queries if num_queries > 0 else None,
+        'travelled_distance': float(total_distance),
+        'translation_error': {'mean': translation_mean, 'std': translation_std,
+                              'ratio_under': _ratios_under(translation_errors, TRANSLATION_THRESHOLDS)},
+        'rotation_error': {'mean': rotation_mean, 'std': rotation_std,
+                           'ratio_under': _ratios_under(rotation_errors, ROTATION_THRESHOLDS)},
+        'localization_probability': {str(distance): float(probability)
+                                     for distance, probability in zip(TRAVELLED_DISTANCES, legacy_probabilities)},
+        'probability_localized_within': {str(distance): float(probability)
+                                         for distance, probability in zip(TRAVELLED_DISTANCES, probabilities)},
+    }
+
+
+def save_report(report, filename):
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Saved localization report to {}".format(filename))
+
+
+if __name__ == "__main__":
+    # check against the loop of the former localization_probability, with both definitions
+    def reference(success_records, total_distance, thres_distance, legacy):
+        success = np.zeros(int(total_distance / thres_distance) + 1)
+        for result in success_records:
+            if legacy or result[1]:
+                success[int(result[0] / thres_distance)] = 1
+        return 1 - success.mean() if legacy else success.mean()
+
+    rng = np.random.default_rng(0)
+    total_distance = 500.
+    distances = np.sort(rng.uniform(0, total_distance, 2000))
+    success_records = np.stack([distances, rng.random(len(distances)) < 0.3], axis=1)
+    for legacy in [False, True]:
+        probabilities = localization_probabilities(success_records, total_distance, legacy=legacy)
+        expected = [reference(success_records, total_distance, d, legacy) for d in TRAVELLED_DISTANCES]
+        assert np.allclose(probabilities, expected), (legacy, probabilities, expected)
+    print("localization_probabilities matches the loop reference")
@@ -10,10 +10,10 @@ from model.Birdview.netvlad import NetVLAD, EmbedNet
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import numpy as np
-from sklearn.metrics import roc_auc_score, f1_score, precision_recall_curve
+from evaluation.retrieval_auc import retrieval_histogram
+from evaluation.retrieval_recall import retrieval_recall
 from matplotlib import pyplot as plt
 import scipy.io as scio
-import faiss
 
 
 parser = argparse.ArgumentParser(description='metrics')
@@ -29,6 +29,7 @@ parser.add_argument('--saved_model_path', type=str,
                     default='/media/admini/lavie/dataset/birdview_dataset/saved_models', help='saved_model_path')
 parser.add_argument('--num_clusters', type=int, default=64, help='num_clusters')
 parser.add_argument('--final_dim', type=int, default=256, help='final_dim')
+parser.add_argument('--tile_size', type=int, default=2048, help='SPIs per tile of the pairwise AUC computation')
 args = parser.parse_args()
 
 
@@ -78,21 +79,14 @@ def spi_vlad_roc_auc():
     # print(descriptors.shape)
 
     N = len(descriptors)
-    diff = descriptors[...,None] - descriptors.transpose(0,1)[None,...]
-    score_matrix = (1 - torch.einsum('mdn,mdn->mn', diff, diff)).numpy()
-    # print(score_matrix)
-
     positions = torch.cat(positions).view(-1, 3)
-    diff = positions[..., None] - positions.transpose(0, 1)[None, ...]
-    label_matrix = (torch.einsum('mdn,mdn->mn', diff, diff) < (args.positive_search_radius**2)).numpy()
-    # print(label_matrix.reshape(-1))
-    # print(score_matrix.reshape(-1))
-
-    print('AUC:', roc_auc_score(label_matrix.reshape(-1), score_matrix.reshape(-1)))
+    histogram = retrieval_histogram(descriptors.numpy(), positions.numpy(), args.positive_search_radius,
+                                    tile_size=args.tile_size)
 
-    # print('F1-score:', f1_score(label_matrix.reshape(-1), score_matrix.reshape(-1)))
+    print('AUC:', histogram.roc_auc())
+    print('AP:', histogram.average_precision())
 
-    precision, recall, thresholds = precision_recall_curve(label_matrix.reshape(-1), score_matrix.reshape(-1))
+    precision, recall, thresholds = histogram.pr_curve()
     print(recall, precision)
     plt.plot(recall, precision, lw=1)
 
@@ -124,15 +118,10 @@ def m2dp_auc():
     descriptors = scio.loadmat(data_file)['descriptors'][:-1]
     print(descriptors.shape)
 
-    descriptors = torch.Tensor(descriptors)
-    positions = torch.Tensor(positions)
-    diff = descriptors[..., None] - descriptors.transpose(0, 1)[None, ...]
-    score_matrix = (1 - torch.einsum('mdn,mdn->mn', diff, diff)).numpy()
-
-    diff = positions[..., None] - positions.transpose(0, 1)[None, ...]
-    label_matrix = (torch.einsum('mdn,mdn->mn', diff, diff) < (args.positive_search_radius ** 2)).numpy()
+    histogram = retrieval_histogram(descriptors, positions, args.positive_search_radius, tile_size=args.tile_size)
 
-    print('AUC:', roc_auc_score(label_matrix.reshape(-1), score_matrix.reshape(-1)))
+    print('AUC:', histogram.roc_auc())
+    print('AP:', histogram.average_precision())
     pass
 
 
@@ -148,15 +137,10 @@ def sc_ringkeys_auc():
     descriptors = scio.loadmat(data_file)['ringkeys'][1:]
     print(descriptors.shape)
 
-    descriptors = torch.Tensor(descriptors)
-    positions = torch.Tensor(positions)
-    diff = descriptors[..., None] - descriptors.transpose(0, 1)[None, ...]
-    score_matrix = (1 - torch.einsum('mdn,mdn->mn', diff, diff)).numpy()
+    histogram = retrieval_histogram(descriptors, positions, args.positive_search_radius, tile_size=args.tile_size)
 
-    diff = positions[..., None] - positions.transpose(0, 1)[None, ...]
-    label_matrix = (torch.einsum('mdn,mdn->mn', diff, diff) < (args.positive_search_radius ** 2)).numpy()
-
-    print('AUC:', roc_auc_score(label_matrix.reshape(-1), score_matrix.reshape(-1)))
+    print('AUC:', histogram.roc_auc())
+    print('AP:', histogram.average_precision())
     pass
 
 
@@ -173,15 +157,10 @@ def sc_ringkeys_auc():
     descriptors = np.load(data_file)
     print(descriptors.shape)
 
-    descriptors = torch.Tensor(descriptors)
-    positions = torch.Tensor(positions)
-    diff = descriptors[..., None] - descriptors.transpose(0, 1)[None, ...]
-    score_matrix = (1 - torch.einsum('mdn,mdn->mn', diff, diff)).numpy()
-
-    diff = positions[..., None] - positions.transpose(0, 1)[None, ...]
-    label_matrix = (torch.einsum('mdn,mdn->mn', diff, diff) < (args.positive_search_radius ** 2)).numpy()
+    histogram = retrieval_histogram(descriptors, positions, args.positive_search_radius, tile_size=args.tile_size)
 
-    print('AUC:', roc_auc_score(label_matrix.reshape(-1), score_matrix.reshape(-1)))
+    print('AUC:', histogram.roc_auc())
+    print('AP:', histogram.average_precision())
     pass
 
 
@@ -204,21 +183,10 @@ def top_k_m2dp():
     database_descriptors, query_descriptors, database_positions, query_positions = \
         train_test_split(descriptors, positions, test_size=0.4, random_state=10)
 
-    index = faiss.IndexFlatL2(database_descriptors.shape[-1])
-    index.add(database_descriptors)
-    topk_score_overall = np.zeros(k)
-    for descriptor, position in zip(query_descriptors, query_positions):
-        distances, indices = index.search(descriptor.reshape(1,-1), k)
-        candidate_positions = database_positions[indices[0]]
-        diff = candidate_positions - position
-        # print((diff * diff).sum(axis=1))
-        # print(diff)
-        is_true_result = (diff * diff).sum(axis=1) < positive_radius**2
-        topk_score = is_true_result.cumsum() > 0
-        # print(topk_score)
-        topk_score_overall += topk_score
-    topk_score_overall /= len(query_descriptors)
-    print(topk_score_overall)
+    results = retrieval_recall(database_descriptors, query_descriptors, database_positions, query_positions,
+                               positive_radius, top_k=k)
+    print(results['recall@k'])
+    print('recall@1%:', results['recall@1%'])
     print(database_descriptors.shape)
     print(query_descriptors.shape)
     print(database_positions.shape)
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+
+from global_localization.common.image_info import make_images_info
+from global_localization.common.model_registry import ModelRegistry
+from global_localization.common.quantization import model_size_mb
+from global_localization.online.place_recognizer import PlaceRecognizer
+from global_localization.online.feature_extractor import FeatureExtractor
+from global_localization.online.pose_estimator import PoseEstimator
+from evaluation.retrieval_recall import retrieval_recall
+
+
+# Accuracy of the int8 inference modes against the fp32 models:
+#   recall@k of NetVLAD retrieval, pose errors of SuperPoint + SuperGlue on query / database pairs,
+#   model sizes and latencies
+
+parser = argparse.ArgumentParser(description='QuantizationReport')
+parser.add_argument('--dataset_dir', type=str, default='/media/li/lavie/dataset/birdview_dataset/', help='dataset_dir')
+parser.add_argument('--sequence_database', type=str, default='juxin_0617', help='sequence_database')
+parser.add_argument('--sequence_query', type=str, default='juxin_0619', help='sequence_query')
+parser.add_argument('--calibration_sequence', type=str, default=None,
+                    help='SPIs calibrating static quantization, sequence_database if not given')
+parser.add_argument('--num_calibration_images', type=int, default=32, help='num_calibration_images')
+parser.add_argument('--saved_model_path', type=str,
+                    default='/media/li/lavie/dataset/birdview_dataset/saved_models', help='saved_model_path')
+parser.add_argument('--modes', type=str, default='fp32,dynamic,static', help='inference modes to compare')
+parser.add_argument('--backend', type=str, default='x86', help='quantized engine, qnnpack on ARM')
+parser.add_argument('--netvlad_imgsize', type=int, default=1000, help='netvlad_imgsize')
+parser.add_argument('--meters_per_pixel', type=float, default=0.25, help='meters_per_pixel')
+parser.add_argument('--scale', type=float, default=100, help='size of SPIs in meters')
+parser.add_argument('--top_k', type=str, default='1,5,10', help='k of recall@k')
+parser.add_argument('--positive_radius', type=float, default=8, help='max distance of a correct retrieval')
+parser.add_argument('--max_pair_distance', type=float, default=10, help='max distance of a query to its database SPI')
+parser.add_argument('--num_queries', type=int, default=200, help='number of queries')
+parser.add_argument('--translation_tolerance', type=float, default=2.0, help='meters')
+parser.add_argument('--rotation_tolerance', type=float, default=5.0, help='degrees')
+parser.add_argument('--min_inliers', type=int, default=20, help='min_inliers')
+parser.add_argument('--output_file', type=str, default=None, help='json file of the results')
+args = parser.parse_args()
+
+
+def quantization_configs(mode):
+    """
+    :return: quantization configs of PlaceRecognizer, FeatureExtractor, PoseEstimator
+    """
+    calibration_images_dir = os.path.join(args.dataset_dir, args.calibration_sequence or args.sequence_database)
+    calibration = {
+        'backend': args.backend,
+        'calibration_images_dir': calibration_images_dir,
+        'num_calibration_images': args.num_calibration_images,
+    }
+    if mode == 'fp32':
+        return {'mode': 'none'}, {'mode': 'none'}, {'mode': 'none'}
+    if mode == 'dynamic':
+        return ({'mode': 'dynamic', 'backend': args.backend}, {'mode': 'none'},
+                {'mode': 'dynamic', 'backend': args.backend})
+    if mode == 'static':
+        return ({**calibration, 'mode': 'static', 'image_size': args.netvlad_imgsize},
+                {**calibration, 'mode': 'static', 'image_size': int(args.scale / args.meters_per_pixel)},
+                {'mode': 'dynamic', 'backend': args.backend})
+    raise ValueError("Unknown mode {}".format(mode))
+
+
+def sample_queries(query_images_info):
+    rng = np.random.default_rng(0)
+    if len(query_images_info) > args.num_queries:
+        return [query_images_info[i] for i in sorted(rng.choice(len(query_images_info), args.num_queries, replace=False))]
+    return query_images_info
+
+
+def load_image(images_dir, image_info, resolution):
+    image = cv2.imread(os.path.join(images_dir, image_info['image_file']), cv2.IMREAD_GRAYSCALE)
+    return cv2.resize(image, (resolution, resolution), interpolation=cv2.INTER_LINEAR)
+
+
+def pose_error(T_target_source, T_w_target, T_w_source):
+    """
+    :param T_target_source: 3 * 3, estimated 2D pose
+    :return: translation error in meters, rotation error in degrees
+    """
+    T_target_source_gt = np.linalg.inv(T_w_target) @ T_w_source
+    translation_error = np.linalg.norm(np.asarray(T_target_source[:2, 2]) - T_target_source_gt[:2, 3])
+    yaw = np.arctan2(T_target_source[1, 0], T_target_source[0, 0])
+    yaw_gt = np.arctan2(T_target_source_gt[1, 0], T_target_source_gt[0, 0])
+    rotation_error = np.degrees(np.abs(np.arctan2(np.sin(yaw - yaw_gt), np.cos(yaw - yaw_gt))))
+    return float(translation_error), float(rotation_error)
+
+
+def evaluate_retrieval(place_recognizer, database_images_info, query_images_info):
+    """
+    :return: recall@k for each k of args.top_k, mean descriptor latency in seconds, query descriptors
+    """
+    database_images_dir = os.path.join(args.dataset_dir, args.sequence_database)
+    query_images_dir = os.path.join(args.dataset_dir, args.sequence_query)
+    database_descriptors = np.concatenate([
+        place_recognizer.extract_descriptor(load_image(database_images_dir, image_info, args.netvlad_imgsize))
+        for image_info in tqdm(database_images_info)])
+    latencies, query_descriptors = [], []
+    for image_info in tqdm(query_images_info):
+        image = load_image(query_images_dir, image_info, args.netvlad_imgsize)
+        t = time.perf_counter()
+        query_descriptors.append(place_recognizer.extract_descriptor(image))
+        latencies.append(time.perf_counter() - t)
+    query_descriptors = np.concatenate(query_descriptors)
+
+    top_k = [int(k) for k in args.top_k.split(',')]
+    same_sequence = args.sequence_database == args.sequence_query
+    database_positions = np.array([image_info['pose'][:3, 3] for image_info in database_images_info])
+    query_positions = np.array([image_info['pose'][:3, 3] for image_info in query_images_info])
+    # with the same sequence, the nearest descriptor is the query itself
+    results = retrieval_recall(database_descriptors, query_descriptors, database_positions, query_positions,
+                               args.positive_radius, top_k=max(top_k), exclude_self=same_sequence)
+    recalls = {'recall@{}'.format(k): float(results['recall@k'][k - 1]) for k in top_k}
+    return recalls, float(np.mean(latencies)), query_descriptors
+
+
+def evaluate_poses(feature_extractor, pose_estimator, pairs):
+    """
+    :param pairs: list of (database image info, query image info)
+    """
+    resolution = int(args.scale / args.meters_per_pixel)
+    database_images_dir = os.path.join(args.dataset_dir, args.sequence_database)
+    query_images_dir = os.path.join(args.dataset_dir, args.sequence_query)
+    extraction_latencies, matching_latencies = [], []
+    translation_errors, rotation_errors, successes = [], [], []
+    for target, source in tqdm(pairs):
+        target_image = load_image(database_images_dir, target, resolution)
+        source_image = load_image(query_images_dir, source, resolution)
+        t0 = time.perf_counter()
+        target_features = feature_extractor.extract_features(target_image)
+        source_features = feature_extractor.extract_features(source_image)
+        t1 = time.perf_counter()
+        T_target_source, score = pose_estimator.estimate_pose({'features': source_features},
+                                                              {'features': target_features})
+        t2 = time.perf_counter()
+        extraction_latencies.append((t1 - t0) / 2)
+        matching_latencies.append(t2 - t1)
+        if T_target_source is None or score < args.min_inliers:
+            successes.append(False)
+            continue
+        translation_error, rotation_error = pose_error(T_target_source, target['pose'], source['pose'])
+        translation_errors.append(translation_error)
+        rotation_errors.append(rotation_error)
+        successes.append(translation_error < args.translation_tolerance and rotation_error < args.rotation_tolerance)
+    return {
+        'pose_success_rate': float(np.mean(successes)),
+        'median_translation_error': float(np.median(translation_errors)) if translation_errors else None,
+        'median_rotation_error': float(np.median(rotation_errors)) if rotation_errors else None,
+        'extraction_latency_ms': float(np.mean(extraction_latencies) * 1e3),
+        'matching_latency_ms': float(np.mean(matching_latencies) * 1e3),
+    }
+
+
+def report():
+    database_images_info = make_images_info(
+        os.path.join(args.dataset_dir, 'struct_file_' + args.sequence_database + '.txt'))
+    query_images_info = sample_queries(make_images_info(
+        os.path.join(args.dataset_dir, 'struct_file_' + args.sequence_query + '.txt')))
+
+    # pair each query with the nearest database SPI, which is not the query itself
+    same_sequence = args.sequence_database == args.sequence_query
+    tree = cKDTree(np.array([image_info['pose'][:3, 3] for image_info in database_images_info]))
+    distances, indices = tree.query(np.array([image_info['pose'][:3, 3] for image_info in query_images_info]),
+                                    k=2 if same_sequence else 1)
+    if same_sequence:
+        distances, indices = distances[:, 1], indices[:, 1]
+    pairs = [(database_images_info[index], query_image_info)
+             for query_image_info, distance, index in zip(query_images_info, distances, indices)
+             if distance < args.max_pair_distance]
+    print("{} database SPIs, {} queries, {} pairs".format(len(database_images_info), len(query_images_info), len(pairs)))
+
+    results = {}
+    fp32_descriptors = None
+    for mode in args.modes.split(','):
+        place_recognizer_quantization, feature_extractor_quantization, pose_estimator_quantization = \
+            quantization_configs(mode)
+        # models of a mode are not shared with the other modes
+        registry = ModelRegistry()
+        place_recognizer = PlaceRecognizer({'saved_model_path': args.saved_model_path,
+                                            'quantization': place_recognizer_quantization}, registry=registry)
+        feature_extractor = FeatureExtractor({'saved_model_path': args.saved_model_path,
+                                              'quantization': feature_extractor_quantization}, registry=registry)
+        pose_estimator = PoseEstimator({'saved_model_path': args.saved_model_path,
+                                        'meters_per_pixel': args.meters_per_pixel,
+                                        'scale': args.scale,
+                                        'quantization': pose_estimator_quantization}, registry=registry)
+
+        recalls, descriptor_latency, descriptors = evaluate_retrieval(
+            place_recognizer, database_images_info, query_images_info)
+        result = {
+            **recalls,
+            'descriptor_latency_ms': descriptor_latency * 1e3,
+            **evaluate_poses(feature_extractor, pose_estimator, pairs),
+            'netvlad_size_mb': model_size_mb(place_recognizer.model_),
+            'superpoint_size_mb': model_size_mb(feature_extractor.superpoint_ if feature_extractor.dense_model_ is None
+                                                else feature_extractor.dense_model_),
+            'superglue_size_mb': model_size_mb(pose_estimator.superglue_),
+        }
+        if mode == 'fp32':
+            fp32_descriptors = descriptors
+        elif fp32_descriptors is not None:
+            # descriptors are L2 normalized
+            result['descriptor_cosine_to_fp32'] = float(np.mean(np.sum(descriptors * fp32_descriptors, axis=1)))
+        results[mode] = result
+        print(mode, json.dumps(result, indent=2))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {}".format(args.output_file))
+
+
+if __name__ == '__main__':
+    report()
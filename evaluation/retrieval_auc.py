@@ -0,0 +1,112 @@
+import numpy as np
+
+
+class ScoreHistogram(object):
+    """
+    Streaming ROC and precision-recall curves: scores of positive and negative pairs are counted in
+    num_bins bins over [low, high], so memory does not depend on the number of pairs.
+    Scores falling in the same bin are ties, the curves are exact when no bin mixes distinct scores.
+    Higher scores predict positives.
+    """
+    def __init__(self, low, high, num_bins=65536):
+        super().__init__()
+        assert high > low, "Empty score range"
+        self.low_ = float(low)
+        self.high_ = float(high)
+        self.num_bins_ = num_bins
+        self.positives_ = np.zeros(num_bins, dtype=np.int64)
+        self.negatives_ = np.zeros(num_bins, dtype=np.int64)
+
+    def add(self, scores, labels, count=1):
+        """
+        :param scores: array of scores
+        :param labels: bool array of the same shape, True for positive pairs
+        :param count: number of times each pair is counted
+        """
+        scores = np.asarray(scores).reshape(-1)
+        labels = np.asarray(labels, dtype=bool).reshape(-1)
+        bins = ((scores - self.low_) * (self.num_bins_ / (self.high_ - self.low_))).astype(np.int64)
+        np.clip(bins, 0, self.num_bins_ - 1, out=bins)
+        self.positives_ += count * np.bincount(bins[labels], minlength=self.num_bins_)
+        self.negatives_ += count * np.bincount(bins[~labels], minlength=self.num_bins_)
+
+    def _cumulative_counts(self):
+        """
+        :return: true positives, false positives and thresholds of the non-empty bins, from the highest score
+        """
+        non_empty = (self.positives_ + self.negatives_)[::-1] > 0
+        tp = np.cumsum(self.positives_[::-1])[non_empty]
+        fp = np.cumsum(self.negatives_[::-1])[non_empty]
+        thresholds = (self.low_ + (self.high_ - self.low_) / self.num_bins_ * np.arange(self.num_bins_))[::-1]
+        return tp, fp, thresholds[non_empty]
+
+    def roc_curve(self):
+        """
+        :return: fpr, tpr, thresholds (lower edges of the bins), as sklearn.metrics.roc_curve
+        """
+        tp, fp, thresholds = self._cumulative_counts()
+        tpr = np.concatenate([[0.], tp / max(tp[-1], 1)])
+        fpr = np.concatenate([[0.], fp / max(fp[-1], 1)])
+        return fpr, tpr, np.concatenate([[np.inf], thresholds])
+
+    def roc_auc(self):
+        fpr, tpr, _ = self.roc_curve()
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1])) / 2.)
+
+    def pr_curve(self):
+        """
+        :return: precision, recall, thresholds, as sklearn.metrics.precision_recall_curve
+        """
+        tp, fp, thresholds = self._cumulative_counts()
+        precision = tp / (tp + fp)
+        recall = tp / max(tp[-1], 1)
+        return np.concatenate([precision[::-1], [1.]]), np.concatenate([recall[::-1], [0.]]), thresholds[::-1]
+
+    def average_precision(self):
+        """ Area under the precision-recall curve, as sklearn.metrics.average_precision_score """
+        precision, recall, _ = self.pr_curve()
+        return float(-np.sum(np.diff(recall) * precision[:-1]))
+
+
+def _sq_distances(a, a_sq_norms, b, b_sq_norms):
+    return np.maximum(a_sq_norms[:, None] + b_sq_norms[None, :] - 2. * (a @ b.T), 0.)
+
+
+def retrieval_histogram(descriptors, positions, positive_radius, tile_size=2048, num_bins=65536):
+    """
+    Scores of all pairs of SPIs, computed tile by tile: pairs closer than positive_radius are positives,
+    the score of a pair is 1 - squared descriptor distance, as the pairwise score and label matrices
+    did. Peak memory is a few tile_size * tile_size matrices, whatever the number of SPIs, and only the
+    tiles above the diagonal are computed, the pairs are symmetric.
+    :param descriptors: N * D
+    :param positions: N * 2 or N * 3
+    :return: ScoreHistogram of the N * N pairs
+    """
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    # positions in meters far from the origin lose the radius in float32
+    positions = np.ascontiguousarray(positions, dtype=np.float64)
+    descriptor_sq_norms = np.sum(descriptors ** 2, axis=1)
+    position_sq_norms = np.sum(positions ** 2, axis=1)
+    # |a - b|^2 <= (|a| + |b|)^2 bounds the scores
+    max_sq_distance = 4. * float(descriptor_sq_norms.max()) if len(descriptors) > 0 else 0.
+    histogram = ScoreHistogram(1. - max_sq_distance - 1e-6, 1. + 1e-6, num_bins)
+
+    n = len(descriptors)
+    for i in range(0, n, tile_size):
+        rows = slice(i, min(i + tile_size, n))
+        for j in range(i, n, tile_size):
+            columns = slice(j, min(j + tile_size, n))
+            scores = 1. - _sq_distances(descriptors[rows], descriptor_sq_norms[rows],
+                                        descriptors[columns], descriptor_sq_norms[columns])
+            labels = _sq_distances(positions[rows], position_sq_norms[rows],
+                                   positions[columns], position_sq_norms[columns]) < positive_radius ** 2
+            histogram.add(scores, labels, count=1 if i == j else 2)
+    return histogram
+
+
+def retrieval_auc(descriptors, positions, positive_radius, tile_size=2048, num_bins=65536):
+    """
+    :return: ROC AUC, average precision of the pairs of SPIs, see retrieval_histogram
+    """
+    histogram = retrieval_histogram(descriptors, positions, positive_radius, tile_size, num_bins)
+    return histogram.roc_auc(), histogram.average_precision()
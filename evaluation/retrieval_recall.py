@@ -0,0 +1,60 @@
+import faiss
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def retrieval_recall(database_descriptors, query_descriptors, database_positions, query_positions,
+                     positive_radius, top_k=25, exclude_self=False):
+    """
+    Recall of place recognition for any global descriptor (SPI-NetVLAD, M2DP, ScanContext ring keys,
+    PointNetVLAD): all queries are searched at once in a flat L2 index, a result is true when it lies
+    within positive_radius of the query.
+    :param database_descriptors: N * D
+    :param query_descriptors: M * D
+    :param database_positions: N * 2 or N * 3
+    :param query_positions: M * 2 or M * 3
+    :param exclude_self: the queries are in the database, their nearest descriptor (themselves) is skipped
+    :return: dict of
+             'recall@k': top_k, recall@1..top_k over all queries
+             'recall@1%': recall@k for k = 1% of the database
+             'precision', 'recall', 'thresholds': precision-recall of the top-1 results accepted below a
+                                                 descriptor distance threshold, recall over the queries
+                                                 with a positive in the database
+             'num_queries', 'num_queries_with_positives'
+    """
+    database_descriptors = np.ascontiguousarray(database_descriptors, dtype=np.float32)
+    query_descriptors = np.ascontiguousarray(query_descriptors, dtype=np.float32)
+    database_positions = np.asarray(database_positions, dtype=np.float64)
+    query_positions = np.asarray(query_positions, dtype=np.float64)
+
+    one_percent = max(1, int(round(len(database_descriptors) / 100.)))
+    k = min(max(top_k, one_percent) + int(exclude_self), len(database_descriptors))
+    index = faiss.IndexFlatL2(database_descriptors.shape[1])
+    index.add(database_descriptors)
+    sq_distances, indices = index.search(query_descriptors, k)
+    if exclude_self:
+        sq_distances, indices = sq_distances[:, 1:], indices[:, 1:]
+
+    is_true_result = np.linalg.norm(database_positions[indices] - query_positions[:, None], axis=2) < positive_radius
+    found = np.cumsum(is_true_result, axis=1) > 0  # M * k, a true result among the first j + 1
+    recall_at_k = found[:, :top_k].mean(axis=0)
+
+    # ground truth, the query itself is within the radius when it is in the database
+    num_positives = cKDTree(database_positions).query_ball_point(query_positions, positive_radius,
+                                                                 return_length=True) - int(exclude_self)
+    num_queries_with_positives = int(np.count_nonzero(num_positives > 0))
+
+    order = np.argsort(sq_distances[:, 0], kind='stable')
+    true_positives = np.cumsum(is_true_result[order, 0])
+    precision = true_positives / np.arange(1, len(order) + 1)
+    recall = true_positives / max(num_queries_with_positives, 1)
+
+    return {
+        'recall@k': recall_at_k,
+        'recall@1%': float(found[:, min(one_percent, found.shape[1]) - 1].mean()),
+        'precision': precision,
+        'recall': recall,
+        'thresholds': np.sqrt(np.maximum(sq_distances[order, 0], 0.)),
+        'num_queries': len(query_descriptors),
+        'num_queries_with_positives': num_queries_with_positives,
+    }
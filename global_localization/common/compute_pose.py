@@ -1,41 +1,65 @@
+import math
+
 import torch
 import numpy as np
 
 
-def compute_relative_pose(target_points, source_points):
-    """
-    :param target_keypoints: N * 2
-    :param source_keypoints: N * 2
-    :return: T_target_source_restored: 4 * 4
-    """
-    assert(len(target_points) == len(target_points))
+def _as_array(points):
+    return points.float().numpy() if torch.is_tensor(points) else np.asarray(points, dtype=np.float32)
 
-    target_points = torch.Tensor(target_points)
-    source_points = torch.Tensor(source_points)
 
-    target_centers = target_points.mean(dim=0)
-    source_centers = source_points.mean(dim=0)
+def _rotation_matrices(theta):
+    """
+    :param theta: ..., rotation angles
+    :return: rotations: ... * 2 * 2
+    """
+    c, s = np.cos(theta), np.sin(theta)
+    return np.stack([np.stack([c, -s], axis=-1), np.stack([s, c], axis=-1)], axis=-2)
 
-    target_points_centered = target_points - target_centers
-    source_points_centered = source_points - source_centers
 
-    cov = source_points_centered.transpose(0, 1) @ target_points_centered
-    u, s, v = torch.svd(cov, some=True, compute_uv=True)
+def _rotate(rotations, points):
+    """
+    :param rotations: ... * 2 * 2
+    :param points: ... * 2
+    :return: rotated points: ... * 2, without matmul, which is slow on stacks of small matrices
+    """
+    return (rotations * points[..., None, :]).sum(axis=-1)
 
-    v_neg = v.clone()
-    v_neg[:, 1] *= -1
-    rot_mat_neg = v_neg @ u.transpose(0, 1)
-    rot_mat_pos = v @ u.transpose(0, 1)
 
-    rot_mat = rot_mat_pos if torch.det(rot_mat_pos) > 0 else rot_mat_neg
-    trans = -rot_mat @ source_centers + target_centers
+def fit_rigid_transforms_2d(target_points, source_points, weights):
+    """
+    Weighted least squares 2D rigid transforms target = R @ source + t, in closed form
+    :param target_points: ... * N * 2
+    :param source_points: ... * N * 2
+    :param weights: ... * N, 0 for ignored points
+    :return: rotations: ... * 2 * 2, translations: ... * 2
+    """
+    weights = weights / np.maximum(weights.sum(axis=-1, keepdims=True), 1e-9)
+    target_centers = (weights[..., None] * target_points).sum(axis=-2)
+    source_centers = (weights[..., None] * source_points).sum(axis=-2)
+    target_centered = target_points - target_centers[..., None, :]
+    source_centered = source_points - source_centers[..., None, :]
+    dot = (weights * (source_centered * target_centered).sum(axis=-1)).sum(axis=-1)
+    cross = (weights * (source_centered[..., 0] * target_centered[..., 1]
+                        - source_centered[..., 1] * target_centered[..., 0])).sum(axis=-1)
+    rotations = _rotation_matrices(np.arctan2(cross, dot))
+    translations = target_centers - _rotate(rotations, source_centers)
+    return rotations, translations
 
-    rot_mat = np.array(rot_mat)
-    trans = np.array(trans).reshape(-1, 1)
-    T_target_source_restored = np.hstack([rot_mat, trans])
-    T_target_source_restored = np.vstack([T_target_source_restored, np.array([0, 0, 1])])
 
-    # print('T_target_source_restored:\n', T_target_source_restored)
+def compute_relative_pose(target_points, source_points):
+    """
+    :param target_keypoints: N * 2
+    :param source_keypoints: N * 2
+    :return: T_target_source_restored: 3 * 3
+    """
+    assert(len(target_points) == len(source_points))
+    target_points, source_points = _as_array(target_points), _as_array(source_points)
+    rotation, translation = fit_rigid_transforms_2d(target_points, source_points,
+                                                    np.ones(len(target_points), dtype=np.float32))
+    T_target_source_restored = np.eye(3)
+    T_target_source_restored[:2, :2] = rotation
+    T_target_source_restored[:2, 2] = translation
     return T_target_source_restored
 
 
@@ -43,52 +67,108 @@ def compute_relative_pose_with_ransac(target_keypoints, source_keypoints):
     """
     :param target_keypoints: N * 2
     :param source_keypoints: N * 2
-    :return: T_target_source_best: 4 * 4
-             score: float
+    :return: T_target_source_best: 3 * 3
+             score: number of inliers
+             see compute_relative_poses_with_ransac for the inliers
+    """
+    return compute_relative_poses_with_ransac([target_keypoints], [source_keypoints])[0][:2]
+
+
+def compute_relative_poses_with_ransac(target_keypoints_list, source_keypoints_list, distance_tolerance=0.5,
+                                       confidence=0.999, max_iterations=1000, chunk_size=64, min_matches=10):
+    """
+    2D rigid RANSAC over several pairs of matched keypoints at once, the pairs are padded to the same length.
+    Hypotheses come from 2-point samples and are drawn in chunks until the number of iterations required
+    for the given confidence (from the best inlier ratio) is reached, the best hypothesis of each pair
+    is then refined by least squares on its inliers.
+    Computed with NumPy: at the size of a few pairs of a few hundred matches, the per-operation overhead
+    of torch dominates.
+    :param target_keypoints_list: list of N_i * 2
+    :param source_keypoints_list: list of N_i * 2
+    :param distance_tolerance: inlier distance, meters
+    :return: list of (T_target_source_best: 3 * 3, score, inliers: N_i bool) as tensors,
+             (None, None, None) for pairs with too few matches
     """
-    assert(target_keypoints.shape == source_keypoints.shape)
-    num_matches = len(target_keypoints)
-    n, k = 1000, 10
-    if num_matches < k:
-        return None, None
-
-    target_keypoints = torch.Tensor(target_keypoints)
-    source_keypoints = torch.Tensor(source_keypoints)
-
-
-    selections = np.random.choice(num_matches, (n, k), replace=True)
-
-    target_sub_keypoints = target_keypoints[selections] # N * k * 2
-    source_sub_keypoints = source_keypoints[selections] # N * k * 2
-    target_centers = target_sub_keypoints.mean(dim=1) # N * 2
-    source_centers = source_sub_keypoints.mean(dim=1) # N * 2
-    target_sub_keypoints_centered = target_sub_keypoints - target_centers.unsqueeze(1)
-    source_sub_keypoints_centered = source_sub_keypoints - source_centers.unsqueeze(1)
-    cov = source_sub_keypoints_centered.transpose(1, 2) @ target_sub_keypoints_centered
-    u, s, v = torch.svd(cov) # u: N*2*2, s: N*2, v: N*2*2
-
-    v_neg = v.clone()
-    v_neg[:,:, 1] *= -1
-
-    rot_mats_neg = v_neg @ u.transpose(1, 2)
-    rot_mats_pos = v @ u.transpose(1, 2)
-    determinants = torch.det(rot_mats_pos)
-
-    rot_mats_neg_list = [rot_mat_neg for rot_mat_neg in rot_mats_neg]
-    rot_mats_pos_list = [rot_mat_neg for rot_mat_neg in rot_mats_pos]
-
-    rot_mats_list = [rot_mat_pos if determinant > 0 else rot_mat_neg for (determinant, rot_mat_pos, rot_mat_neg) in zip(determinants, rot_mats_pos_list, rot_mats_neg_list)]
-    rotations = torch.stack(rot_mats_list) # N * 2 * 2
-    translations = torch.einsum("nab,nb->na", -rotations, source_centers) + target_centers # N * 2
-    diff = source_keypoints @ rotations.transpose(1,2) + translations.unsqueeze(1) - target_keypoints
-    distances_squared = torch.sum(diff * diff, dim=2)
-
-    distance_tolerance = 0.5
-    scores = (distances_squared < (distance_tolerance**2)).sum(dim=1)
-    score = torch.max(scores)
-    best_index = torch.argmax(scores)
-    rotation = rotations[best_index]
-    translation = translations[best_index]
-    T_target_source = torch.cat((rotation, translation[...,None]), dim=1)
-    T_target_source = torch.cat((T_target_source, torch.Tensor([[0,0,1]])), dim=0)
-    return T_target_source, score
+    assert(len(target_keypoints_list) == len(source_keypoints_list))
+    results = [(None, None, None)] * len(target_keypoints_list)
+    pair_indices = [i for i, target_keypoints in enumerate(target_keypoints_list) if len(target_keypoints) >= min_matches]
+    if len(pair_indices) == 0:
+        return results
+
+    num_matches = np.array([len(target_keypoints_list[i]) for i in pair_indices])
+    b, m = len(pair_indices), int(num_matches.max())
+    target_keypoints = np.zeros((b, m, 2), dtype=np.float32)
+    source_keypoints = np.zeros((b, m, 2), dtype=np.float32)
+    for j, i in enumerate(pair_indices):
+        assert(target_keypoints_list[i].shape == source_keypoints_list[i].shape)
+        target_keypoints[j, :num_matches[j]] = _as_array(target_keypoints_list[i])
+        source_keypoints[j, :num_matches[j]] = _as_array(source_keypoints_list[i])
+    valid = np.arange(m)[None, :] < num_matches[:, None] # B * M
+    batch_indices = np.arange(b)[:, None]
+    tolerance_squared = distance_tolerance ** 2
+
+    source_x, source_y = source_keypoints[:, None, :, 0], source_keypoints[:, None, :, 1] # B * 1 * M
+    target_x, target_y = target_keypoints[:, None, :, 0], target_keypoints[:, None, :, 1]
+
+    def count_inliers(rotations, translations):
+        """ rotations: B * n * 2 * 2, translations: B * n * 2 -> inliers: B * n * M """
+        c, s = rotations[..., 0, 0, None], rotations[..., 1, 0, None]
+        dx = c * source_x - s * source_y + translations[..., 0, None] - target_x
+        dy = s * source_x + c * source_y + translations[..., 1, None] - target_y
+        return (dx * dx + dy * dy < tolerance_squared) & valid[:, None]
+
+    best_scores = np.zeros(b, dtype=np.int64)
+    best_rotations = np.tile(np.eye(2, dtype=np.float32), (b, 1, 1))
+    best_translations = np.zeros((b, 2), dtype=np.float32)
+    done = np.zeros(b, dtype=bool)
+    iterations = 0
+    while iterations < max_iterations and not done.all():
+        # minimal samples of 2 matches
+        samples = (np.random.random_sample((b, chunk_size, 2)) * num_matches[:, None, None]).astype(np.int64) # B * n * 2
+        target_samples = target_keypoints[batch_indices[..., None], samples] # B * n * 2 * 2
+        source_samples = source_keypoints[batch_indices[..., None], samples] # B * n * 2 * 2
+        target_delta = target_samples[:, :, 1] - target_samples[:, :, 0]
+        source_delta = source_samples[:, :, 1] - source_samples[:, :, 0]
+        theta = np.arctan2(source_delta[..., 0] * target_delta[..., 1] - source_delta[..., 1] * target_delta[..., 0],
+                           (source_delta * target_delta).sum(axis=-1))
+        rotations = _rotation_matrices(theta)
+        translations = target_samples.mean(axis=2) - _rotate(rotations, source_samples.mean(axis=2))
+        scores = count_inliers(rotations, translations).sum(axis=2) # B * n
+        # coincident samples do not define a rotation
+        scores[(source_delta * source_delta).sum(axis=-1) < 1e-6] = 0
+
+        chunk_indices = scores.argmax(axis=1)
+        chunk_scores = scores[batch_indices[:, 0], chunk_indices]
+        improved = (chunk_scores > best_scores) & ~done
+        best_scores = np.where(improved, chunk_scores, best_scores)
+        best_rotations = np.where(improved[:, None, None], rotations[batch_indices[:, 0], chunk_indices],
+                                  best_rotations)
+        best_translations = np.where(improved[:, None], translations[batch_indices[:, 0], chunk_indices],
+                                     best_translations)
+        iterations += chunk_size
+
+        # iterations needed to draw an all-inlier sample with the given confidence
+        inlier_ratios = best_scores / num_matches
+        outlier_probabilities = np.clip(1 - inlier_ratios ** 2, 1e-9, 1 - 1e-9)
+        required_iterations = math.log(1 - confidence) / np.log(outlier_probabilities)
+        done = done | (iterations >= required_iterations)
+
+    # least squares refit on the inliers of the best hypotheses
+    inliers = count_inliers(best_rotations[:, None], best_translations[:, None])[:, 0] # B * M
+    refit_rotations, refit_translations = fit_rigid_transforms_2d(target_keypoints, source_keypoints,
+                                                                  inliers.astype(np.float32))
+    refit_inliers = count_inliers(refit_rotations[:, None], refit_translations[:, None])[:, 0]
+    use_refit = refit_inliers.sum(axis=1) >= inliers.sum(axis=1)
+    rotations = np.where(use_refit[:, None, None], refit_rotations, best_rotations)
+    translations = np.where(use_refit[:, None], refit_translations, best_translations)
+    inliers = np.where(use_refit[:, None], refit_inliers, inliers)
+    scores = torch.from_numpy(inliers.sum(axis=1))
+
+    T_target_source = torch.zeros(b, 3, 3)
+    T_target_source[:, :2, :2] = torch.from_numpy(rotations.astype(np.float32))
+    T_target_source[:, :2, 2] = torch.from_numpy(translations.astype(np.float32))
+    T_target_source[:, 2, 2] = 1
+    inliers = torch.from_numpy(inliers)
+    for j, i in enumerate(pair_indices):
+        results[i] = (T_target_source[j], scores[j], inliers[j, :num_matches[j]])
+    return results
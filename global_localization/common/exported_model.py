@@ -0,0 +1,44 @@
+import os
+
+import torch
+
+
+class ExportedModel(object):
+    """
+    Runs a network exported by global_localization/offline/export_models.py, with the same calling
+    convention as the eager module: tensors in, a tensor or a tuple of tensors out.
+    Backends:
+      'torchscript': traced and frozen graph, loaded with torch.jit.load
+      'onnxruntime': ONNX graph run by onnxruntime on CPU
+    """
+    def __init__(self, model_file, backend='torchscript', device=torch.device("cpu"), num_threads=0):
+        super().__init__()
+        assert backend in ['torchscript', 'onnxruntime'], "Unknown backend {}".format(backend)
+        self.backend_ = backend
+        self.device_ = device
+        if backend == 'torchscript':
+            model = torch.jit.load(model_file, map_location=device)
+            self.model_ = torch.jit.optimize_for_inference(model) if device.type == 'cpu' else model
+        else:
+            # optional dependency, only needed by this backend
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads > 0:
+                options.intra_op_num_threads = num_threads
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session_ = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+            self.input_names_ = [i.name for i in self.session_.get_inputs()]
+        print("Loaded {} model from \'{}\'.".format(backend, model_file))
+
+    def __call__(self, *inputs):
+        if self.backend_ == 'torchscript':
+            return self.model_(*inputs)
+        outputs = self.session_.run(None, {name: x.detach().cpu().numpy()
+                                           for name, x in zip(self.input_names_, inputs)})
+        outputs = [torch.from_numpy(output).to(self.device_) for output in outputs]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+def exported_model_file(model_path, name, backend):
+    """ File name of an exported network, e.g. netvlad.torchscript.pt or superpoint_dense.onnx """
+    return os.path.join(model_path, "{}.{}".format(name, 'torchscript.pt' if backend == 'torchscript' else 'onnx'))
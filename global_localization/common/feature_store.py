@@ -0,0 +1,138 @@
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+import torch
+
+
+class StoredFeatures(Mapping):
+    """
+    SuperPoint features of one SPI of a FeatureStore, in the format of FeatureExtractor.extract_features:
+    'keypoints': [n * 2], 'scores': [n], 'descriptors': [D * n].
+    Tensors are views on the store (float16 descriptors, uint16 keypoints), PQ-coded descriptors are
+    decoded on access. Consumers copy them into their float32 batches.
+    """
+    keys_ = ('keypoints', 'scores', 'descriptors')
+
+    def __init__(self, store, index):
+        super().__init__()
+        self.store_ = store
+        self.index_ = index
+
+    def __getitem__(self, key):
+        if key == 'keypoints':
+            return [self.store_.keypoints(self.index_)]
+        if key == 'scores':
+            return [self.store_.scores(self.index_)]
+        if key == 'descriptors':
+            return [self.store_.descriptors(self.index_)]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+
+class FeatureStore(object):
+    """
+    Columnar storage of the SuperPoint features of many SPIs: the keypoints, scores and descriptors of all
+    SPIs are concatenated in contiguous arrays, SPI i owns rows offsets[i]:offsets[i + 1].
+    Keypoints are uint16 (SuperPoint keypoints are integer pixel positions, float32 is kept otherwise),
+    scores float16, descriptors float16 or PQ codes.
+    """
+    def __init__(self, offsets, keypoints, scores, descriptors, pq=None):
+        """
+        :param offsets: N + 1, int64
+        :param keypoints: K * 2, uint16 or float32
+        :param scores: K, float16
+        :param descriptors: K * D float16, or K * M uint8 PQ codes if pq is given
+        :param pq: faiss.ProductQuantizer of the descriptors, None for float16 descriptors
+        """
+        super().__init__()
+        self.offsets_ = offsets
+        self.keypoints_ = torch.from_numpy(keypoints)
+        self.scores_ = torch.from_numpy(scores)
+        self.descriptors_ = descriptors if pq is not None else torch.from_numpy(descriptors)
+        self.pq_ = pq
+
+    @staticmethod
+    def build(features_list, descriptor_codec='float16', pq_m=32, pq_nbits=8):
+        """
+        :param features_list: list of feature dicts of FeatureExtractor.extract_features, or StoredFeatures
+        :param descriptor_codec: 'float16', or 'pq' for product quantization with pq_m codes of pq_nbits.
+                                 With StoredFeatures of a store with the same product quantizer, the quantizer
+                                 is reused and their codes are copied instead of being decoded and coded again
+        :return: FeatureStore
+        """
+        assert descriptor_codec in ['float16', 'pq'], "Unknown descriptor codec {}".format(descriptor_codec)
+        offsets = np.zeros(len(features_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(features['keypoints'][0]) for features in features_list])
+        keypoints = torch.cat([features['keypoints'][0].float() for features in features_list]).numpy()
+        if np.all(keypoints == np.round(keypoints)) and (len(keypoints) == 0 or
+                                                         (keypoints.min() >= 0 and keypoints.max() < 2 ** 16)):
+            keypoints = keypoints.astype(np.uint16)
+        scores = torch.cat([features['scores'][0].float() for features in features_list]).numpy().astype(np.float16)
+
+        pq = None
+        if descriptor_codec == 'pq':
+            pq = next((features.store_.pq_ for features in features_list if isinstance(features, StoredFeatures)
+                       and features.store_.pq_ is not None and features.store_.pq_.M == pq_m
+                       and features.store_.pq_.nbits == pq_nbits), None)
+        if pq is not None:
+            descriptors = np.concatenate([
+                features.store_.codes(features.index_) if isinstance(features, StoredFeatures) and
+                features.store_.pq_ is pq else
+                pq.compute_codes(np.ascontiguousarray(features['descriptors'][0].float().t().numpy()))
+                for features in features_list]).reshape(-1, pq.code_size)
+            return FeatureStore(offsets, np.ascontiguousarray(keypoints), scores, descriptors, pq)
+
+        descriptors = torch.cat([features['descriptors'][0].float().t() for features in features_list]).numpy()
+        if descriptor_codec == 'pq':
+            assert len(descriptors) >= 2 ** pq_nbits, "Too few descriptors to train the product quantizer"
+            pq = faiss.ProductQuantizer(descriptors.shape[1], pq_m, pq_nbits)
+            pq.train(np.ascontiguousarray(descriptors))
+            descriptors = pq.compute_codes(np.ascontiguousarray(descriptors))
+        else:
+            descriptors = descriptors.astype(np.float16)
+        return FeatureStore(offsets, np.ascontiguousarray(keypoints), scores, descriptors, pq)
+
+    def __len__(self):
+        return len(self.offsets_) - 1
+
+    def _rows(self, i):
+        return int(self.offsets_[i]), int(self.offsets_[i + 1])
+
+    def features(self, i):
+        return StoredFeatures(self, i)
+
+    def keypoints(self, i):
+        begin, end = self._rows(i)
+        return self.keypoints_[begin:end]
+
+    def scores(self, i):
+        begin, end = self._rows(i)
+        return self.scores_[begin:end]
+
+    def codes(self, i):
+        """
+        :return: n * code_size PQ codes, only for a store with a product quantizer
+        """
+        begin, end = self._rows(i)
+        return np.asarray(self.descriptors_[begin:end])
+
+    def descriptors(self, i):
+        """
+        :return: D * n, float16 view, or float32 decoded from the PQ codes
+        """
+        begin, end = self._rows(i)
+        if self.pq_ is None:
+            return self.descriptors_[begin:end].t()
+        descriptors = torch.from_numpy(self.pq_.decode(np.ascontiguousarray(self.descriptors_[begin:end])))
+        return torch.nn.functional.normalize(descriptors, p=2., dim=1).t()
+
+    @property
+    def nbytes(self):
+        return self.offsets_.nbytes + self.keypoints_.numpy().nbytes + self.scores_.numpy().nbytes + \
+            (self.descriptors_.nbytes if self.pq_ is not None else self.descriptors_.numpy().nbytes)
@@ -0,0 +1,97 @@
+import json
+import threading
+
+import torch
+
+from global_localization.common.exported_model import ExportedModel
+
+
+class ModelRegistry(object):
+    """
+    Loads every model checkpoint once per process and hands out the same module to all its users.
+    Modules are in eval mode, optionally converted to frozen TorchScript and optionally moved to
+    shared memory, so that worker processes started afterwards (fork, or torch.multiprocessing)
+    use the weights of the parent process instead of loading their own copy.
+    Modules are shared: they must not be modified by their users.
+    """
+    default_config = {
+        'torchscript': False,  # convert modules to frozen TorchScript, eager modules are kept if it fails
+        'share_memory': False,  # move the weights of CPU modules to shared memory
+    }
+
+    def __init__(self, config={}):
+        super().__init__()
+        self.config_ = {**self.default_config, **config}
+        self.models_ = {}
+        self.lock_ = threading.Lock()
+
+    def get(self, name, build_fn, checkpoint_file=None, device=torch.device("cpu"), model_config=None,
+            post_load_fn=None, torchscript=None):
+        """
+        :param name: name of the model, e.g. 'superpoint'
+        :param build_fn: () -> nn.Module without the checkpoint weights
+        :param checkpoint_file: state dict loaded into the module, None to keep the weights of build_fn
+        :param post_load_fn: nn.Module -> nn.Module applied once the checkpoint is loaded
+        :param model_config: config of the module, modules with different configs are kept apart
+        :param torchscript: overrides config 'torchscript' for this model
+        :return: nn.Module in eval mode on device
+        """
+        key = (name, checkpoint_file, str(device), json.dumps(model_config, sort_keys=True, default=str))
+        with self.lock_:
+            model = self.models_.get(key)
+            if model is None:
+                model = self._load(name, build_fn, checkpoint_file, device, post_load_fn, torchscript)
+                self.models_[key] = model
+        return model
+
+    def _load(self, name, build_fn, checkpoint_file, device, post_load_fn, torchscript):
+        model = build_fn()
+        if checkpoint_file is not None:
+            model_checkpoint = torch.load(checkpoint_file, map_location=lambda storage, loc: storage)
+            model.load_state_dict(model_checkpoint)
+            print("Loaded {} checkpoint from \'{}\'.".format(name, checkpoint_file))
+        if post_load_fn is not None:
+            model = post_load_fn(model)
+        model.eval().to(device)
+        for parameter in model.parameters():
+            parameter.requires_grad_(False)
+
+        if self.config_['torchscript'] if torchscript is None else torchscript:
+            try:
+                model = torch.jit.freeze(torch.jit.script(model))
+            except Exception as e:
+                print("Keeping {} as eager module, TorchScript conversion failed: {}".format(name, e))
+        if self.config_['share_memory'] and device.type == 'cpu':
+            model.share_memory()
+        return model
+
+    def get_exported(self, name, model_file, backend, device=torch.device("cpu")):
+        """
+        :param model_file: network exported by global_localization/offline/export_models.py
+        :param backend: 'torchscript' or 'onnxruntime'
+        :return: ExportedModel
+        """
+        key = (name, model_file, str(device), backend)
+        with self.lock_:
+            model = self.models_.get(key)
+            if model is None:
+                model = ExportedModel(model_file, backend, device)
+                self.models_[key] = model
+        return model
+
+    def clear(self):
+        with self.lock_:
+            self.models_ = {}
+
+
+_default_registry = ModelRegistry()
+
+
+def default_registry():
+    """ Registry shared by all the SPI components of the process """
+    return _default_registry
+
+
+def configure_default_registry(config):
+    """ Set the options of the default registry, models already loaded are kept as they are """
+    _default_registry.config_ = {**ModelRegistry.default_config, **config}
@@ -0,0 +1,94 @@
+import copy
+import glob
+import os
+
+import cv2
+import torch
+from torch import nn
+
+
+class PointwiseLinear(nn.Module):
+    """ Conv1d with kernel_size 1 as a Linear layer over the channels, which dynamic quantization supports """
+    def __init__(self, conv):
+        super().__init__()
+        assert conv.kernel_size == (1,) and conv.groups == 1
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data.copy_(conv.weight.data[..., 0])
+        if conv.bias is not None:
+            self.linear.bias.data.copy_(conv.bias.data)
+
+    def forward(self, x):
+        """
+        :param x: B * C * N
+        """
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def pointwise_convs_to_linear(model):
+    """ Replace all Conv1d with kernel_size 1 of model by PointwiseLinear, in place """
+    for name, module in model.named_children():
+        if isinstance(module, nn.Conv1d) and module.kernel_size == (1,) and module.groups == 1:
+            setattr(model, name, PointwiseLinear(module))
+        else:
+            pointwise_convs_to_linear(module)
+    return model
+
+
+def quantize_dynamic(model, backend='x86'):
+    """
+    int8 weights for Linear and pointwise Conv1d layers, activations are quantized on the fly
+    :return: quantized copy of model, in eval mode on CPU
+    """
+    torch.backends.quantized.engine = backend
+    model = pointwise_convs_to_linear(copy.deepcopy(model).cpu().eval())
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_images, skip_modules=(), backend='x86'):
+    """
+    int8 weights and activations for a convolutional model, activation ranges are calibrated on
+    calibration_images with FX graph mode quantization
+    :param calibration_images: list of 1 * 1 * H * W float tensors
+    :param skip_modules: names of the submodules kept in fp32, e.g. output layers feeding thresholds
+    :return: quantized copy of model, in eval mode on CPU
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    assert len(calibration_images) > 0, "Static quantization needs calibration images"
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for name in skip_modules:
+        qconfig_mapping.set_module_name(name, None)
+    model = prepare_fx(copy.deepcopy(model).cpu().eval(), qconfig_mapping, (calibration_images[0],))
+    with torch.no_grad():
+        for image in calibration_images:
+            model(image)
+    return convert_fx(model)
+
+
+def load_calibration_images(images_dir, image_size, num_images=32):
+    """
+    Recorded SPIs used to calibrate static quantization
+    :return: list of 1 * 1 * image_size * image_size float tensors in [0, 1]
+    """
+    image_files = sorted(glob.glob(os.path.join(images_dir, '*.png')))
+    step = max(len(image_files) // num_images, 1)
+    images = []
+    for image_file in image_files[::step][:num_images]:
+        image = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+        image = cv2.resize(image, (image_size, image_size), interpolation=cv2.INTER_LINEAR)
+        images.append(torch.from_numpy(image).float()[None, None] / 255.)
+    print("Loaded {} calibration images from \'{}\'.".format(len(images), images_dir))
+    return images
+
+
+def model_size_mb(model):
+    """ Size of the parameters and buffers of model, including packed quantized weights """
+    size = 0
+    for value in model.state_dict().values():
+        if isinstance(value, torch.Tensor):
+            size += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            # packed params of dynamically quantized Linear layers: (weight, bias)
+            size += sum(v.numel() * v.element_size() for v in value if isinstance(v, torch.Tensor))
+    return size / 2 ** 20
@@ -0,0 +1,121 @@
+import numpy as np
+from scipy.ndimage import uniform_filter1d
+
+
+class SequenceMatcher(object):
+    """
+    SeqSLAM-style place recognition over the recent query SPIs: the distances of the last sequence_length
+    NetVLAD descriptors to all database descriptors are kept in a ring buffer of rows, and the database
+    is searched for the run of SPIs traversed at a constant velocity (database SPIs per query SPI) which
+    best matches the whole history. The head of the best run is aligned with the newest query.
+    The database is one sequence, in the order the SPIs were recorded.
+    A run is accepted when its cost is lower than min_uniqueness times the cost of the best run ending
+    more than sequence_length SPIs away, otherwise the caller falls back to single frame retrieval.
+    """
+    default_config = {
+        'enabled': False,
+        'sequence_length': 10,
+        # velocities of the runs, in database SPIs per query SPI
+        'min_velocity': 0.8,
+        'max_velocity': 1.25,
+        'num_velocities': 5,
+        # distances are normalized over this many neighbouring database SPIs, None to use raw distances
+        'contrast_window': None,
+        'min_uniqueness': 1.1,
+    }
+
+    def __init__(self, config={}):
+        super().__init__()
+        self.config_ = {**self.default_config, **config}
+        self.sequence_length_ = self.config_['sequence_length']
+        length = self.sequence_length_ - 1
+        velocities = np.linspace(self.config_['min_velocity'], self.config_['max_velocity'],
+                                 self.config_['num_velocities'])
+        # offsets[v, t]: database SPIs between the head of the run and query t, the oldest query first
+        self.offsets_ = np.unique(np.round(velocities[:, None] * np.arange(length, -1, -1)[None, :]).astype(np.int64),
+                                  axis=0)
+        self.database_ = None
+        self.database_sq_norms_ = None
+        self.rows_ = None
+        self.next_row_ = 0
+        self.num_rows_ = 0
+
+    def set_database(self, descriptors):
+        """
+        :param descriptors: N * D, database descriptors in the order of the sequence, row i is the SPI of id i
+        """
+        self.database_ = np.ascontiguousarray(descriptors, dtype=np.float32)
+        self.database_sq_norms_ = np.sum(self.database_ ** 2, axis=1)
+        self.rows_ = np.empty((self.sequence_length_, len(self.database_)), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        """ Forget the history, e.g. after a gap in the queries """
+        self.next_row_ = 0
+        self.num_rows_ = 0
+
+    def _distances(self, descriptor):
+        """
+        :return: N, distances of descriptor to the database descriptors
+        """
+        descriptor = np.asarray(descriptor, dtype=np.float32).reshape(-1)
+        sq_distances = self.database_sq_norms_ - 2. * (self.database_ @ descriptor) + descriptor @ descriptor
+        distances = np.sqrt(np.maximum(sq_distances, 0.))
+        window = self.config_['contrast_window']
+        if window is not None:
+            mean = uniform_filter1d(distances, window, mode='nearest')
+            std = np.sqrt(np.maximum(uniform_filter1d(distances ** 2, window, mode='nearest') - mean ** 2, 0.))
+            distances = (distances - mean) / np.maximum(std, 1e-6)
+            distances -= distances.min()
+        return distances
+
+    def _costs(self):
+        """
+        :return: N, cost of the best run ending at each database SPI, inf if no run fits in the database
+        """
+        n = self.rows_.shape[1]
+        # rows of the ring from the oldest query to the newest one
+        rows = self.rows_[(self.next_row_ + np.arange(self.sequence_length_)) % self.sequence_length_]
+        best_costs = np.full(n, np.inf, dtype=np.float32)
+        for offsets in self.offsets_:
+            max_offset = int(offsets.max())
+            if max_offset >= n:
+                continue
+            # cost[j] = sum_t rows[t, j - offsets[t]], for the heads j with the whole run in the database
+            costs = np.zeros(n - max_offset, dtype=np.float32)
+            for row, offset in zip(rows, offsets):
+                costs += row[max_offset - offset:n - offset]
+            np.minimum(best_costs[max_offset:], costs, out=best_costs[max_offset:])
+        return best_costs
+
+    def match(self, descriptor, allowed_ids=None):
+        """
+        Add a query to the history and search the best run
+        :param descriptor: D, NetVLAD descriptor of the newest query
+        :param allowed_ids: ids of the database SPIs the head of the run may be, None for all of them
+        :return: (id of the head of the best run, cost), None until the history is full or
+                 if the best run is not distinctive
+        """
+        if self.database_ is None or len(self.database_) == 0:
+            return None
+        self.rows_[self.next_row_] = self._distances(descriptor)
+        self.next_row_ = (self.next_row_ + 1) % self.sequence_length_
+        self.num_rows_ = min(self.num_rows_ + 1, self.sequence_length_)
+        if self.num_rows_ < self.sequence_length_:
+            return None
+
+        costs = self._costs()
+        if allowed_ids is not None:
+            mask = np.full(len(costs), np.inf, dtype=np.float32)
+            mask[np.asarray(allowed_ids, dtype=np.int64)] = 0.
+            costs += mask
+        head = int(np.argmin(costs))
+        if not np.isfinite(costs[head]):
+            return None
+        # best run ending outside the neighbourhood of the head
+        outside = costs.copy()
+        outside[max(0, head - self.sequence_length_):head + self.sequence_length_ + 1] = np.inf
+        second = float(outside.min())
+        if np.isfinite(second) and second < self.config_['min_uniqueness'] * costs[head]:
+            return None
+        return head, float(costs[head])
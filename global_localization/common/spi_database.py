@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+
+import faiss
+import numpy as np
+
+from global_localization.common.feature_store import FeatureStore
+
+
+# 2: compact features, see FeatureStore
+CACHE_VERSION = 2
+
+
+def file_sha1(filename, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _save_array(cache_dir, name, array):
+    # Write next to the old file and swap it in: the old file may still be memory-mapped
+    tmp_filename = os.path.join(cache_dir, name + ".tmp.npy")
+    np.save(tmp_filename, array)
+    os.replace(tmp_filename, os.path.join(cache_dir, name + ".npy"))
+
+
+def _load_array(cache_dir, name):
+    # copy-on-write mapping, so torch.from_numpy gets a writable view without copying
+    return np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="c")
+
+
+def save_spi_entries(cache_dir, images_info, meta, feature_store_config=None):
+    """
+    Save vlad descriptors, poses and SuperPoint features of SPIs as contiguous arrays
+    :param cache_dir: output directory
+    :param images_info: list of image info with 'vlad' and 'features' filled
+    :param meta: dict, stored as meta.json
+    :param feature_store_config: keyword arguments of FeatureStore.build, e.g. {'descriptor_codec': 'pq'}
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    vlads = np.stack([np.asarray(image_info['vlad'], dtype=np.float32) for image_info in images_info])
+    poses = np.stack([image_info['pose'] for image_info in images_info])
+    timestamps = np.array([image_info.get('timestamp', 0.) for image_info in images_info])
+    store = FeatureStore.build([image_info['features'] for image_info in images_info],
+                               **({} if feature_store_config is None else feature_store_config))
+
+    _save_array(cache_dir, "vlads", vlads)
+    _save_array(cache_dir, "poses", poses)
+    _save_array(cache_dir, "timestamps", timestamps)
+    _save_array(cache_dir, "offsets", store.offsets_)
+    _save_array(cache_dir, "keypoints", store.keypoints_.numpy())
+    _save_array(cache_dir, "scores", store.scores_.numpy())
+    if store.pq_ is None:
+        _save_array(cache_dir, "descriptors", store.descriptors_.numpy())
+    else:
+        _save_array(cache_dir, "descriptors", store.descriptors_)
+        tmp_filename = os.path.join(cache_dir, "descriptors.pq.tmp")
+        faiss.write_ProductQuantizer(store.pq_, tmp_filename)
+        os.replace(tmp_filename, os.path.join(cache_dir, "descriptors.pq"))
+
+    meta = {**meta, "version": CACHE_VERSION, "pq": store.pq_ is not None,
+            "image_files": [image_info['image_file'] for image_info in images_info]}
+    tmp_filename = os.path.join(cache_dir, "meta.json.tmp")
+    with open(tmp_filename, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_filename, os.path.join(cache_dir, "meta.json"))
+
+
+def load_spi_entries(cache_dir):
+    """
+    Memory-map SPI entries written by save_spi_entries
+    :param cache_dir: cache directory
+    :return: images_info: list of image info whose 'vlad' and 'features' are views on the mapped arrays
+             vlads: N * D, float32
+             meta: dict
+    """
+    with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    if meta.get("version") != CACHE_VERSION:
+        return [], None, meta
+    vlads = _load_array(cache_dir, "vlads")
+    poses = _load_array(cache_dir, "poses")
+    timestamps = _load_array(cache_dir, "timestamps")
+    pq = faiss.read_ProductQuantizer(os.path.join(cache_dir, "descriptors.pq")) if meta["pq"] else None
+    store = FeatureStore(np.asarray(_load_array(cache_dir, "offsets")), _load_array(cache_dir, "keypoints"),
+                         _load_array(cache_dir, "scores"), _load_array(cache_dir, "descriptors"), pq)
+
+    images_info = []
+    for i, image_file in enumerate(meta["image_files"]):
+        images_info.append({
+            'image_file': image_file,
+            'timestamp': float(timestamps[i]),
+            'pose': np.asarray(poses[i]),
+            'vlad': vlads[i],
+            'features': store.features(i),
+        })
+    return images_info, vlads, meta
+
+
+class SpiDatabaseCache(object):
+    """
+    On-disk cache of a precomputed SPI database (NetVLAD descriptors, SuperPoint features and poses).
+    The cache is keyed on the struct file, the modification time of every SPI image, the model
+    checkpoints and the extraction parameters. Only entries whose source changed are re-extracted.
+    """
+    def __init__(self, cache_dir, model_files, params=None, feature_store_config=None):
+        """
+        :param cache_dir: directory of the cache
+        :param model_files: dict, name -> checkpoint file used to compute the entries
+        :param params: dict, extraction parameters (image sizes, SuperPoint config...)
+        :param feature_store_config: storage of the features, see FeatureStore.build
+        """
+        super().__init__()
+        self.cache_dir_ = cache_dir
+        self.model_hashes_ = {name: file_sha1(filename) for name, filename in model_files.items()}
+        self.feature_store_config_ = {} if feature_store_config is None else feature_store_config
+        self.params_ = {**({} if params is None else params), 'feature_store': self.feature_store_config_}
+        self.meta_ = None
+
+    def _make_meta(self, struct_file, images_info, images_dir):
+        return {
+            "struct_file_sha1": file_sha1(struct_file),
+            "model_sha1": self.model_hashes_,
+            "params": self.params_,
+            "mtimes": [os.stat(os.path.join(images_dir, image_info['image_file'])).st_mtime_ns
+                       for image_info in images_info],
+        }
+
+    def restore(self, struct_file, images_info, images_dir):
+        """
+        Fill 'vlad' and 'features' of the up-to-date entries of images_info from the cache
+        :return: stale_indices: indices of images_info which have to be (re-)extracted
+                 vlads: N * D memory-mapped descriptors if the whole cache is up to date, else None
+        """
+        self.meta_ = self._make_meta(struct_file, images_info, images_dir)
+        all_indices = list(range(len(images_info)))
+        if not os.path.exists(os.path.join(self.cache_dir_, "meta.json")):
+            return all_indices, None
+
+        cached_images_info, cached_vlads, cached_meta = load_spi_entries(self.cache_dir_)
+        if cached_meta.get("version") != CACHE_VERSION \
+                or cached_meta["model_sha1"] != self.meta_["model_sha1"] \
+                or cached_meta["params"] != json.loads(json.dumps(self.meta_["params"])):
+            print("SPI database cache in {} is outdated, rebuilding it".format(self.cache_dir_))
+            return all_indices, None
+
+        cached_entries = {(image_info['image_file'], mtime): image_info
+                          for image_info, mtime in zip(cached_images_info, cached_meta["mtimes"])}
+        stale_indices = []
+        for i, (image_info, mtime) in enumerate(zip(images_info, self.meta_["mtimes"])):
+            cached_image_info = cached_entries.get((image_info['image_file'], mtime))
+            if cached_image_info is None:
+                stale_indices.append(i)
+                continue
+            image_info['vlad'] = cached_image_info['vlad']
+            image_info['features'] = cached_image_info['features']
+
+        up_to_date = len(stale_indices) == 0 \
+            and cached_meta["struct_file_sha1"] == self.meta_["struct_file_sha1"] \
+            and cached_meta["image_files"] == [image_info['image_file'] for image_info in images_info]
+        return stale_indices, cached_vlads if up_to_date else None
+
+    def save(self, images_info):
+        assert self.meta_ is not None, "restore() must be called before save()"
+        save_spi_entries(self.cache_dir_, images_info, self.meta_, self.feature_store_config_)
+        print("Saved SPI database cache to {}".format(self.cache_dir_))
@@ -0,0 +1,29 @@
+import os
+
+import cv2
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset
+
+from global_localization.common.spi_preprocessor import resize_pyramid
+
+
+class SpiImageDataset(Dataset):
+    """
+    Database SPIs decoded and resized for both NetVLAD and SuperPoint,
+    to be batched by a DataLoader whose workers do the decoding
+    """
+    def __init__(self, images_info, images_dir, netvlad_imgsize, feature_imgsize):
+        super(SpiImageDataset, self).__init__()
+        self.images_info = images_info
+        self.images_dir = images_dir
+        self.netvlad_imgsize = netvlad_imgsize
+        self.feature_imgsize = feature_imgsize
+        self.to_tensor = transforms.ToTensor()
+
+    def __len__(self):
+        return len(self.images_info)
+
+    def __getitem__(self, index):
+        image = cv2.imread(os.path.join(self.images_dir, self.images_info[index]['image_file']), cv2.IMREAD_GRAYSCALE)
+        spinetvlad_image, features_image = resize_pyramid(image, [self.netvlad_imgsize, self.feature_imgsize])
+        return self.to_tensor(spinetvlad_image), self.to_tensor(features_image), index
@@ -0,0 +1,182 @@
+import os
+import threading
+
+import faiss
+import numpy as np
+from scipy.spatial import cKDTree
+
+from model.Birdview.vlad_index import VladIndex
+from global_localization.common.spi_database import save_spi_entries, load_spi_entries
+from global_localization.common.feature_store import StoredFeatures
+
+
+class SpiMap(object):
+    """
+    Map of SPIs: image info by id and the index of their NetVLAD descriptors.
+    In SLAM mode the map grows incrementally, it can be snapshotted to disk, restored after
+    a restart and stale entries can be removed by id.
+    Searches can be restricted to the SPIs around a position with a KD-tree of the SPI positions (x, y).
+    """
+    def __init__(self, dim, index_config={}):
+        super().__init__()
+        self.dim_ = dim
+        self.index_config_ = index_config
+        self.index_ = VladIndex(dim, index_config)
+        self.images_info_ = {}  # id -> image info
+        # KD-tree of SPI positions, rebuilt lazily, SPIs appended since the last build are checked one by one
+        self.spatial_tree_ = None
+        self.spatial_tree_ids_ = np.zeros(0, dtype=np.int64)
+        self.pending_ids_ = []
+        self.snapshot_thread_ = None
+
+    def __len__(self):
+        return len(self.images_info_)
+
+    @property
+    def next_id(self):
+        return self.index_.next_id
+
+    def __getitem__(self, spi_id):
+        return self.images_info_[spi_id]
+
+    @property
+    def nbytes(self):
+        """
+        Memory of the descriptor index, the NetVLAD descriptors and the stored SuperPoint features,
+        features kept as tensors are not counted
+        """
+        stores = {}
+        for image_info in self.images_info_.values():
+            if isinstance(image_info['features'], StoredFeatures):
+                stores[id(image_info['features'].store_)] = image_info['features'].store_
+        return self.index_.nbytes + len(self) * self.dim_ * 4 + sum(store.nbytes for store in stores.values())
+
+    def append(self, image_info):
+        """
+        :param image_info: image info with 'vlad' filled
+        :return: id of the SPI
+        """
+        spi_id = int(self.index_.add(image_info['vlad'][None, ...])[0])
+        self.images_info_[spi_id] = image_info
+        self.pending_ids_.append(spi_id)
+        return spi_id
+
+    def extend(self, images_info, descriptors):
+        """
+        :param descriptors: N * D, descriptors of images_info
+        :return: ids of the SPIs
+        """
+        ids = self.index_.add(descriptors)
+        for spi_id, image_info in zip(ids, images_info):
+            self.images_info_[int(spi_id)] = image_info
+        self.pending_ids_.extend(int(spi_id) for spi_id in ids)
+        return ids
+
+    def oldest_ids(self, n):
+        """
+        :return: ids of the n SPIs appended first
+        """
+        return list(self.images_info_.keys())[:n]
+
+    def remove(self, ids):
+        self.index_.remove(ids)
+        for spi_id in ids:
+            self.images_info_.pop(int(spi_id), None)
+
+    def _build_spatial_tree(self):
+        self.spatial_tree_ids_ = np.array(list(self.images_info_.keys()), dtype=np.int64)
+        positions = np.array([self.images_info_[spi_id]['pose'][:2, 3] for spi_id in self.spatial_tree_ids_])
+        self.spatial_tree_ = cKDTree(positions.reshape(-1, 2))
+        self.pending_ids_ = []
+
+    def ids_within(self, position, radius):
+        """
+        :param position: x, y (, z) in the map frame, z is ignored
+        :param radius: meters
+        :return: ids of the SPIs whose position is within radius of position
+        """
+        if self.spatial_tree_ is None or len(self.pending_ids_) > max(64, len(self.spatial_tree_ids_) // 4):
+            self._build_spatial_tree()
+        position = np.asarray(position, dtype=np.float64)[:2]
+        ids = self.spatial_tree_ids_[self.spatial_tree_.query_ball_point(position, radius)].tolist()
+        ids += [spi_id for spi_id in self.pending_ids_ if spi_id in self.images_info_ and
+                np.linalg.norm(self.images_info_[spi_id]['pose'][:2, 3] - position) <= radius]
+        # removed SPIs stay in the tree until the next build
+        return np.array([spi_id for spi_id in ids if spi_id in self.images_info_], dtype=np.int64)
+
+    def search(self, descriptor, k, max_id=None, prior_position=None, prior_radius=None, with_distances=False):
+        """
+        :param descriptor: 1 * D
+        :param max_id: only SPIs with id < max_id are searched, None to search all of them
+        :param prior_position: only SPIs within prior_radius of prior_position are searched, None to search all of them
+        :param prior_radius: meters
+        :param with_distances: return (descriptor distance, image info) pairs instead of image info
+        :return: list of image info, at most k
+        """
+        selector = None if max_id is None else faiss.IDSelectorRange(0, max(0, max_id))
+        if prior_position is not None:
+            ids = self.ids_within(prior_position, prior_radius)
+            if max_id is not None:
+                ids = ids[ids < max_id]
+            if len(ids) == 0:
+                return []
+            selector = faiss.IDSelectorBatch(ids)
+        distances, ids = self.index_.search(descriptor, k, selector)
+        if with_distances:
+            return [(float(distance), self.images_info_[spi_id]) for distance, spi_id in zip(distances[0], ids[0])
+                    if spi_id >= 0]
+        return [self.images_info_[spi_id] for spi_id in ids[0] if spi_id >= 0]
+
+    def snapshot(self, snapshot_dir, background=False, feature_store_config=None):
+        """
+        Save the map to snapshot_dir, the previous snapshot is overwritten
+        :param feature_store_config: storage of the features, see FeatureStore.build
+        :param background: write a copy of the map in a background thread, the map can be changed meanwhile.
+                           Skipped while the previous background snapshot is still being written
+        :return: False if the snapshot was skipped
+        """
+        if self.snapshot_thread_ is not None and self.snapshot_thread_.is_alive():
+            if background:
+                return False
+            self.wait_snapshot()
+        ids = sorted(self.images_info_.keys())
+        if len(ids) == 0:
+            return True
+        images_info = [self.images_info_[spi_id] for spi_id in ids]
+        index = self.index_.copy() if background else self.index_
+
+        def write():
+            save_spi_entries(snapshot_dir, images_info, {"ids": ids}, feature_store_config)
+            index.save(os.path.join(snapshot_dir, "vlad.index"))
+
+        if not background:
+            write()
+            return True
+        # not a daemon, the interpreter waits for the snapshot at exit
+        self.snapshot_thread_ = threading.Thread(target=write, name="spi_map_snapshot")
+        self.snapshot_thread_.start()
+        return True
+
+    def wait_snapshot(self):
+        """
+        Wait for the background snapshot being written, if any
+        """
+        if self.snapshot_thread_ is not None:
+            self.snapshot_thread_.join()
+            self.snapshot_thread_ = None
+
+    @staticmethod
+    def restore(snapshot_dir, dim, index_config={}):
+        """
+        :return: SpiMap, None if there is no snapshot in snapshot_dir
+        """
+        index = VladIndex.load(os.path.join(snapshot_dir, "vlad.index"), index_config)
+        if index is None or not os.path.exists(os.path.join(snapshot_dir, "meta.json")):
+            return None
+        images_info, _, meta = load_spi_entries(snapshot_dir)
+        if index.ntotal != len(images_info):
+            return None
+        spi_map = SpiMap(dim, index_config)
+        spi_map.index_ = index
+        spi_map.images_info_ = {spi_id: image_info for spi_id, image_info in zip(meta["ids"], images_info)}
+        return spi_map
@@ -0,0 +1,108 @@
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+
+def resize_pyramid(image, sizes, interpolation=cv2.INTER_LINEAR, buffers=None):
+    """
+    Resize a square SPI to several sizes, from the largest size to the smallest one.
+    Each level is resized from the previous level instead of the full resolution image, and a level
+    with the size of its source is the source itself, without copy.
+    :param sizes: output sizes in pixels, in any order
+    :param buffers: list of preallocated size * size arrays written in place, None to allocate the outputs
+    :return: list of images in the order of sizes
+    """
+    outputs = [None] * len(sizes)
+    source = image
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        size = sizes[i]
+        if source.shape[:2] == (size, size):
+            outputs[i] = source
+            continue
+        if buffers is None:
+            outputs[i] = cv2.resize(source, (size, size), interpolation=interpolation)
+        else:
+            outputs[i] = cv2.resize(source, (size, size), dst=buffers[i], interpolation=interpolation)
+        source = outputs[i]
+    return outputs
+
+
+class SpiPreprocessor(object):
+    """
+    Builds the resolutions needed by the networks from a decoded SPI as a pyramid, into
+    preallocated arrays reused in a ring of num_buffers frames.
+    By default an output is overwritten num_buffers calls later, which suits a caller using each frame
+    before preprocessing the next one. When frames are used by another thread, e.g. the extract stage of
+    SpiPipeline, a frame is reserved with acquire(), preprocessed into with buffer_index and given back with
+    release() once used: the ring never overwrites a reserved frame.
+    One thread preprocesses the SPIs, acquire() and release() can be called from any thread.
+    With as_tensor, the outputs are 1 * 1 * size * size float tensors in [0, 1], as transforms.ToTensor
+    would make them, ready for both networks. They are normalized in a single pass from the uint8 levels
+    into reused tensors, which are pinned when CUDA is available for asynchronous copies to the GPU.
+    """
+    def __init__(self, sizes, num_buffers=4, interpolation=cv2.INTER_LINEAR, as_tensor=False):
+        super().__init__()
+        self.sizes_ = list(sizes)
+        self.interpolation_ = interpolation
+        self.as_tensor_ = as_tensor
+        self.pin_memory_ = as_tensor and torch.cuda.is_available()
+        self.buffers_ = []
+        self.tensors_ = []
+        self.next_buffer_ = 0
+        self.reserved_ = set()
+        self.lock_ = threading.Lock()
+        self.reserve(num_buffers)
+
+    def reserve(self, num_buffers):
+        """ Grow the ring to at least num_buffers frames """
+        while len(self.buffers_) < num_buffers:
+            self.buffers_.append([np.empty((size, size), dtype=np.uint8) for size in self.sizes_])
+            if self.as_tensor_:
+                tensors = [torch.empty(1, 1, size, size) for size in self.sizes_]
+                self.tensors_.append([t.pin_memory() for t in tensors] if self.pin_memory_ else tensors)
+
+    def acquire(self):
+        """
+        Reserve a frame of the ring until release()
+        :return: index of the frame, None if all the frames are reserved
+        """
+        with self.lock_:
+            for i in range(len(self.buffers_)):
+                index = (self.next_buffer_ + i) % len(self.buffers_)
+                if index not in self.reserved_:
+                    self.reserved_.add(index)
+                    self.next_buffer_ = (index + 1) % len(self.buffers_)
+                    return index
+            return None
+
+    def release(self, buffer_index):
+        with self.lock_:
+            self.reserved_.discard(buffer_index)
+
+    def __call__(self, image, buffer_index=None):
+        """
+        :param image: H * W uint8 SPI
+        :param buffer_index: frame reserved by acquire(), None for the next frame of the ring which is not reserved
+        :return: list of uint8 images (float tensors with as_tensor) in the order of sizes. Without buffer_index,
+                 valid until the ring comes back to the frame, num_buffers - 1 calls later if no frame is reserved
+        """
+        assert image.dtype == np.uint8 and image.ndim == 2, "SPIs are single channel uint8 images"
+        if buffer_index is None:
+            with self.lock_:
+                assert len(self.reserved_) < len(self.buffers_), "All the preprocessing buffers are reserved"
+                while self.next_buffer_ in self.reserved_:
+                    self.next_buffer_ = (self.next_buffer_ + 1) % len(self.buffers_)
+                buffer_index = self.next_buffer_
+                self.next_buffer_ = (self.next_buffer_ + 1) % len(self.buffers_)
+        buffers = self.buffers_[buffer_index]
+        levels = resize_pyramid(image, self.sizes_, self.interpolation_, buffers)
+        if self.as_tensor_:
+            tensors = self.tensors_[buffer_index]
+            for level, tensor in zip(levels, tensors):
+                if not level.flags.writeable or not level.flags.c_contiguous:
+                    level = np.array(level)
+                tensor[0, 0].copy_(torch.from_numpy(level)).div_(255.)
+            levels = tensors
+        return levels
@@ -0,0 +1,177 @@
+import json
+import math
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from model.Birdview.vlad_index import VladIndex
+from global_localization.common.spi_map import SpiMap
+
+
+MANIFEST_FILE = "tiles.json"
+
+
+def tile_key(position, tile_size):
+    """
+    :param position: x, y (, z) in the map frame
+    :return: (ix, iy), the tile containing position
+    """
+    return int(math.floor(position[0] / tile_size)), int(math.floor(position[1] / tile_size))
+
+
+def tile_name(key):
+    return "tile_{}_{}".format(*key)
+
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory))
+
+
+def build_map_tiles(images_info, tiles_dir, tile_size, dim, index_config={}, sessions=None,
+                    feature_store_config=None):
+    """
+    Split SPIs, possibly of several sessions sharing the same map frame, into square tiles of tile_size
+    meters. Each tile is saved as a SpiMap snapshot in its own directory, described by a manifest.
+    :param images_info: list of image info with 'pose', 'vlad' and 'features' filled
+    :param sessions: list of names of the sessions the SPIs come from, stored in the manifest
+    :param feature_store_config: storage of the features of each tile, see FeatureStore.build
+    """
+    tiles = {}
+    for image_info in images_info:
+        tiles.setdefault(tile_key(image_info['pose'][:3, 3], tile_size), []).append(image_info)
+
+    manifest = {"tile_size": tile_size, "dim": dim, "sessions": sessions or [],
+                "index": {**VladIndex.default_config, **index_config},
+                "feature_store": {} if feature_store_config is None else feature_store_config, "tiles": []}
+    for key, tile_images_info in sorted(tiles.items()):
+        tile_map = SpiMap(dim, index_config)
+        tile_map.extend(tile_images_info, np.stack([np.asarray(image_info['vlad'], dtype=np.float32)
+                                                    for image_info in tile_images_info]))
+        tile_dir = os.path.join(tiles_dir, tile_name(key))
+        tile_map.snapshot(tile_dir, feature_store_config=feature_store_config)
+        manifest["tiles"].append({"ix": key[0], "iy": key[1], "count": len(tile_images_info),
+                                  "bytes": _directory_size(tile_dir)})
+
+    tmp_filename = os.path.join(tiles_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_filename, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_filename, os.path.join(tiles_dir, MANIFEST_FILE))
+    print("Saved {} SPIs in {} tiles to {}".format(len(images_info), len(tiles), tiles_dir))
+    return manifest
+
+
+class TiledSpiMap(object):
+    """
+    Read-only map of SPIs split into spatial tiles by build_map_tiles, each with its own descriptor index
+    and memory-mapped features. Tiles are loaded when a search needs them, and the least recently used
+    ones are released once the loaded tiles exceed memory_budget_mb, counted as the memory of their index,
+    descriptors and features (SpiMap.nbytes) rather than their size on disk.
+    Searches around a prior position only load the tiles within the prior radius. Searches without prior
+    go through all the tiles, which is only practical for small maps: GlobalLocalizer always searches
+    around a prior.
+    Same search interface as SpiMap, for pure localization.
+    """
+    def __init__(self, tiles_dir, index_config={}, memory_budget_mb=1024):
+        super().__init__()
+        with open(os.path.join(tiles_dir, MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+        # tiles built before the manifest stored the index config are checked when they are loaded
+        assert "index" not in manifest or VladIndex.same_structure(manifest["index"], index_config), \
+            "Tiles in {} were built with index config {}, not {}, rebuild them or change config 'index'".format(
+                tiles_dir, manifest["index"], {**VladIndex.default_config, **index_config})
+        self.tiles_dir_ = tiles_dir
+        self.index_config_ = index_config
+        self.tile_size_ = manifest["tile_size"]
+        self.dim_ = manifest["dim"]
+        self.tiles_ = {(tile["ix"], tile["iy"]): tile for tile in manifest["tiles"]}
+        self.size_ = sum(tile["count"] for tile in manifest["tiles"])
+        self.memory_budget_ = memory_budget_mb * 2 ** 20
+        self.loaded_tiles_ = OrderedDict()  # key -> SpiMap, least recently used first
+        self.tile_bytes_ = {}  # key -> memory of the loaded tile
+        self.loaded_bytes_ = 0
+        print("Opened map of {} SPIs in {} tiles of {} m from {}".format(
+            self.size_, len(self.tiles_), self.tile_size_, tiles_dir))
+
+    def __len__(self):
+        return self.size_
+
+    @property
+    def num_loaded_tiles(self):
+        return len(self.loaded_tiles_)
+
+    def tiles_within(self, position, radius):
+        """
+        :return: keys of the tiles intersecting the disc of radius around position (x, y)
+        """
+        x, y = float(position[0]), float(position[1])
+        (ix_min, iy_min), (ix_max, iy_max) = tile_key((x - radius, y - radius), self.tile_size_), \
+            tile_key((x + radius, y + radius), self.tile_size_)
+        keys = []
+        for ix in range(ix_min, ix_max + 1):
+            for iy in range(iy_min, iy_max + 1):
+                if (ix, iy) not in self.tiles_:
+                    continue
+                # distance from position to the tile square
+                dx = max(ix * self.tile_size_ - x, 0., x - (ix + 1) * self.tile_size_)
+                dy = max(iy * self.tile_size_ - y, 0., y - (iy + 1) * self.tile_size_)
+                if dx * dx + dy * dy <= radius * radius:
+                    keys.append((ix, iy))
+        return keys
+
+    def tile(self, key):
+        """
+        :return: SpiMap of the tile, loaded if needed
+        """
+        tile_map = self.loaded_tiles_.get(key)
+        if tile_map is not None:
+            self.loaded_tiles_.move_to_end(key)
+            return tile_map
+        tile_dir = os.path.join(self.tiles_dir_, tile_name(key))
+        tile_map = SpiMap.restore(tile_dir, self.dim_, self.index_config_)
+        if tile_map is None:
+            saved_index = VladIndex.load(os.path.join(tile_dir, "vlad.index"))
+            assert saved_index is None or VladIndex.same_structure(saved_index.config, self.index_config_), \
+                "Tile {} was built with index config {}, not {}".format(
+                    tile_dir, saved_index.config, {**VladIndex.default_config, **self.index_config_})
+        assert tile_map is not None, "Missing or outdated tile {}, rebuild the tiles".format(tile_dir)
+        self.loaded_tiles_[key] = tile_map
+        self.tile_bytes_[key] = tile_map.nbytes
+        self.loaded_bytes_ += self.tile_bytes_[key]
+        self._evict(keep=key)
+        return tile_map
+
+    def _evict(self, keep):
+        while self.loaded_bytes_ > self.memory_budget_ and len(self.loaded_tiles_) > 1:
+            key = next(iter(self.loaded_tiles_))
+            if key == keep:
+                self.loaded_tiles_.move_to_end(key)
+                continue
+            # candidates returned before keep their entries, the tile itself is released
+            del self.loaded_tiles_[key]
+            self.loaded_bytes_ -= self.tile_bytes_.pop(key)
+
+    def preload(self, position, radius):
+        """ Load the tiles around position ahead of the queries, e.g. from the pose prior """
+        for key in self.tiles_within(position, radius):
+            self.tile(key)
+
+    def search(self, descriptor, k, max_id=None, prior_position=None, prior_radius=None):
+        """
+        :param descriptor: 1 * D
+        :param max_id: unsupported, tiled maps are read-only
+        :param prior_position: only SPIs within prior_radius of prior_position are searched, None to search all tiles
+        :return: list of image info, at most k
+        """
+        assert max_id is None, "Tiled maps are used for pure localization only"
+        if prior_position is None:
+            # tiles already loaded first, so that the others are loaded once
+            keys = list(self.loaded_tiles_.keys()) + [key for key in self.tiles_ if key not in self.loaded_tiles_]
+        else:
+            keys = self.tiles_within(prior_position, prior_radius)
+        results = []
+        for key in keys:
+            results += self.tile(key).search(descriptor, k, prior_position=prior_position, prior_radius=prior_radius,
+                                             with_distances=True)
+        results.sort(key=lambda result: result[0])
+        return [image_info for _, image_info in results[:k]]
@@ -1,3 +1,7 @@
+import bisect
+import json
+import os
+import threading
 import time
 from functools import wraps
 
@@ -9,8 +13,144 @@ def fn_timer(function):
         result = function(*args, **kwargs)
         t1 = time.time()
         print("Total time running %s: %s seconds" %
-              (function.func_name, str(t1 - t0))
+              (function.__name__, str(t1 - t0))
               )
         return result
 
-    return function_timer
\ No newline at end of file
+    return function_timer
+
+
+class _StageTimer(object):
+    __slots__ = ['profiler_', 'name_', 't0_']
+
+    def __init__(self, profiler, name):
+        self.profiler_ = profiler
+        self.name_ = name
+
+    def __enter__(self):
+        self.t0_ = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler_.record(self.name_, time.perf_counter() - self.t0_)
+        return False
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class StageHistogram(object):
+    """Latency histogram of a stage with fixed bucket upper bounds, in seconds"""
+    def __init__(self, buckets):
+        super().__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile, max for the +Inf bucket """
+        if self.count == 0:
+            return 0.
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / max(self.count, 1),
+            'min': self.min if self.count > 0 else 0.,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class StageProfiler(object):
+    """
+    Per-stage latency histograms of the online localization, cheap enough to stay enabled in production.
+    Usage:
+        with profiler.stage('superpoint'):
+            ...
+    A disabled profiler records nothing.
+    """
+    default_buckets = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5.)
+
+    def __init__(self, enabled=True, buckets=None):
+        super().__init__()
+        self.enabled = enabled
+        self.buckets_ = tuple(self.default_buckets if buckets is None else sorted(buckets))
+        self.histograms_ = {}
+        self.lock_ = threading.Lock()
+
+    def stage(self, name):
+        return _StageTimer(self, name) if self.enabled else _NULL_TIMER
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock_:
+            histogram = self.histograms_.get(name)
+            if histogram is None:
+                histogram = self.histograms_[name] = StageHistogram(self.buckets_)
+            histogram.record(seconds)
+
+    def reset(self):
+        with self.lock_:
+            self.histograms_ = {}
+
+    def as_dict(self):
+        with self.lock_:
+            return {name: histogram.as_dict() for name, histogram in self.histograms_.items()}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self, metric='global_localization_stage_seconds'):
+        """ Prometheus text exposition format, one histogram with a stage label """
+        lines = ["# HELP {} Latency of the stages of the online localization".format(metric),
+                 "# TYPE {} histogram".format(metric)]
+        for name, histogram in self.as_dict().items():
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(metric, name, bound, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(metric, name, histogram['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(metric, name, histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename, export_format='json'):
+        """
+        :param export_format: 'json' or 'prometheus'
+        """
+        assert export_format in ['json', 'prometheus'], "Unknown export format {}".format(export_format)
+        text = self.to_json() if export_format == 'json' else self.to_prometheus()
+        # written next to the file then moved, so that scrapers never read a partial file
+        with open(filename + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
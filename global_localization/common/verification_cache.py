@@ -0,0 +1,96 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _pose_2d(pose):
+    """ 4 * 4 pose -> 3 * 3 pose in the x, y plane """
+    return np.array([[pose[0, 0], pose[0, 1], pose[0, 3]],
+                     [pose[1, 0], pose[1, 1], pose[1, 3]],
+                     [0., 0., 1.]])
+
+
+class VerificationCache(object):
+    """
+    Bounded cache of recent SuperGlue + RANSAC verification results, keyed on the candidate SPI and a
+    coarse key of the query:
+      'descriptor': sign bits of random projections of the NetVLAD descriptor, equal for near identical SPIs
+      'pose': cell of the query pose, for queries with a reliable odometry pose
+    Entries are evicted when least recently used beyond max_size, or after ttl seconds.
+    A cached relative pose is corrected by the motion of the query pose since it was verified, which
+    is exact when query poses come from odometry and changes nothing when they are not provided.
+    """
+    default_config = {
+        'enabled': False,
+        'max_size': 1024,
+        'ttl': 30.0,  # seconds
+        'key': 'descriptor',  # 'descriptor' or 'pose'
+        'hash_bits': 32,
+        'cell_size': 1.0,  # meters
+        'yaw_cell_size': 10.0,  # degrees
+    }
+
+    def __init__(self, config={}):
+        super().__init__()
+        self.config_ = {**self.default_config, **config}
+        assert self.config_['key'] in ['descriptor', 'pose'], "Unknown key {}".format(self.config_['key'])
+        self.entries_ = OrderedDict()  # key -> (time, query pose, result), least recently used first
+        self.projections_ = None
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def __len__(self):
+        return len(self.entries_)
+
+    def _query_key(self, query_image_info):
+        if self.config_['key'] == 'pose':
+            pose = query_image_info['pose']
+            yaw = np.degrees(np.arctan2(pose[1, 0], pose[0, 0]))
+            return (int(np.floor(pose[0, 3] / self.config_['cell_size'])),
+                    int(np.floor(pose[1, 3] / self.config_['cell_size'])),
+                    int(np.floor(yaw / self.config_['yaw_cell_size'])))
+        descriptor = np.asarray(query_image_info['vlad'], dtype=np.float32).reshape(-1)
+        if self.projections_ is None:
+            self.projections_ = np.random.default_rng(0).standard_normal(
+                (len(descriptor), self.config_['hash_bits'])).astype(np.float32)
+        return np.packbits(descriptor @ self.projections_ > 0).tobytes()
+
+    def _key(self, query_image_info, candidate_image_info):
+        return candidate_image_info['image_file'], self._query_key(query_image_info)
+
+    def get(self, query_image_info, candidate_image_info):
+        """
+        :return: cached (T_target_source, score, inliers) of the candidate, None if there is none
+        """
+        key = self._key(query_image_info, candidate_image_info)
+        entry = self.entries_.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.config_['ttl']:
+            self.entries_.pop(key, None)
+            self.misses_ += 1
+            return None
+        self.entries_.move_to_end(key)
+        self.hits_ += 1
+        _, T_o_source, (T_target_source, score, inliers) = entry
+        if T_target_source is not None and T_o_source is not None and query_image_info['pose'] is not None:
+            # T_target_source' = T_target_source * T_source_o * T_o_source'
+            T_target_source = T_target_source @ np.linalg.inv(_pose_2d(T_o_source)) @ \
+                _pose_2d(query_image_info['pose'])
+        return T_target_source, score, inliers
+
+    def put(self, query_image_info, candidate_image_info, result):
+        """
+        :param result: (T_target_source, score, inliers) of PoseEstimator.estimate_poses
+        """
+        T_target_source, score, inliers = result
+        if T_target_source is not None:
+            T_target_source = np.asarray(T_target_source, dtype=np.float64)
+        key = self._key(query_image_info, candidate_image_info)
+        T_o_source = None if query_image_info['pose'] is None else np.array(query_image_info['pose'])
+        self.entries_[key] = (time.monotonic(), T_o_source, (T_target_source, score, inliers))
+        self.entries_.move_to_end(key)
+        while len(self.entries_) > self.config_['max_size']:
+            self.entries_.popitem(last=False)
+
+    def statistics(self):
+        return {'size': len(self.entries_), 'hits': self.hits_, 'misses': self.misses_}
@@ -0,0 +1,50 @@
+import argparse
+import os
+
+from global_localization.common.tiled_map import build_map_tiles
+from global_localization.online.global_localizer import GlobalLocalizer
+
+
+# Build a tiled map from the SPI databases of one or several sessions sharing the same map frame,
+# for GlobalLocalizer config "map_tiles_dir"
+
+parser = argparse.ArgumentParser(description='BuildMapTiles')
+parser.add_argument('--dataset_dir', type=str, default='/media/li/lavie/dataset/birdview_dataset/', help='dataset_dir')
+parser.add_argument('--sequences', type=str, nargs='+', default=['juxin_1023_map'], help='sessions of the map')
+parser.add_argument('--tiles_dir', type=str, required=True, help='output directory of the tiles')
+parser.add_argument('--tile_size', type=float, default=200, help='size of the tiles in meters')
+parser.add_argument('--cache_dir', type=str, default=None,
+                    help='directory of the SPI database caches of the sessions, features are re-extracted if not given')
+parser.add_argument('--saved_model_path', type=str,
+                    default='/media/li/lavie/dataset/birdview_dataset/saved_models', help='saved_model_path')
+parser.add_argument('--index_type', type=str, default='flat', help='type of the VladIndex of the tiles')
+parser.add_argument('--descriptor_codec', type=str, default='float16', choices=['float16', 'pq'],
+                    help='storage of the SuperPoint descriptors of the tiles, see FeatureStore.build')
+args = parser.parse_args()
+
+
+def build():
+    localizer = GlobalLocalizer({
+        # the databases are loaded below
+        "pure_localization": False,
+        "index": {"type": args.index_type},
+        "place_recognizer": {"saved_model_path": args.saved_model_path},
+        "feature_extractor": {"saved_model_path": args.saved_model_path},
+        "pose_estimator": {"saved_model_path": args.saved_model_path},
+    })
+    images_info = []
+    for sequence in args.sequences:
+        print("Loading session {} ...".format(sequence))
+        localizer.load_spi_database(
+            os.path.join(args.dataset_dir, 'struct_file_' + sequence + '.txt'),
+            os.path.join(args.dataset_dir, sequence),
+            None if args.cache_dir is None else os.path.join(args.cache_dir, sequence))
+        images_info += [{**image_info, 'image_file': os.path.join(sequence, image_info['image_file'])}
+                        for image_info in localizer.map_.images_info_.values()]
+    build_map_tiles(images_info, args.tiles_dir, args.tile_size, localizer.config_['vlad_dim'],
+                    {"type": args.index_type}, sessions=args.sequences,
+                    feature_store_config={"descriptor_codec": args.descriptor_codec})
+
+
+if __name__ == '__main__':
+    build()
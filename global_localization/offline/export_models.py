@@ -0,0 +1,126 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from model.Birdview.base_model import BaseModel, to_per_image_normalization
+from model.Birdview.netvlad import NetVLAD, EmbedNet
+from model.Superglue.superpoint import SuperPoint, SuperPointDense
+from global_localization.common.model_registry import ModelRegistry
+from global_localization.common.exported_model import ExportedModel, exported_model_file
+
+
+# Export the dense networks of the online stack (NetVLAD and the dense part of SuperPoint) as TorchScript
+# and ONNX graphs, check them against the eager modules and compare their latencies.
+# The exported backends cover feature extraction only (place recognition and keypoint extraction).
+# SuperGlue is not exported and pose verification always runs it as an eager module, so the speed-ups
+# printed here do not apply to the per-candidate matching time: its inputs have a variable number of
+# keypoints and masks, and its Sinkhorn iterations stop early. Use the 'dynamic' quantization of
+# PoseEstimator and the 'keypoint_budget' of FeatureExtractor to reduce the verification time instead.
+
+parser = argparse.ArgumentParser(description='ExportModels')
+parser.add_argument('--saved_model_path', type=str,
+                    default='/media/li/lavie/dataset/birdview_dataset/saved_models', help='saved_model_path')
+parser.add_argument('--output_path', type=str, default=None, help='output_path, saved_model_path if not given')
+parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'],
+                    choices=['torchscript', 'onnx'], help='formats')
+parser.add_argument('--num_clusters', type=int, default=64, help='num_clusters')
+parser.add_argument('--final_dim', type=int, default=256, help='final_dim')
+parser.add_argument('--netvlad_imgsize', type=int, default=1000, help='netvlad_imgsize')
+parser.add_argument('--feature_imgsize', type=int, default=400, help='feature_imgsize')
+parser.add_argument('--opset', type=int, default=13, help='ONNX opset')
+parser.add_argument('--num_runs', type=int, default=10, help='number of runs of the latency comparison')
+parser.add_argument('--tolerance', type=float, default=1e-4, help='max abs difference to the eager outputs')
+parser.add_argument('--random_weights', action='store_true', help='export untrained networks, without checkpoints')
+args = parser.parse_args()
+
+
+def load_models():
+    """
+    :return: dict of name -> (eager module, example input)
+    """
+    registry = ModelRegistry()
+    checkpoint = lambda filename: None if args.random_weights else os.path.join(args.saved_model_path, filename)
+
+    def build_netvlad():
+        net_vlad = NetVLAD(num_clusters=args.num_clusters, dim=256, alpha=1.0, outdim=args.final_dim)
+        return EmbedNet(BaseModel(), net_vlad)
+    netvlad = registry.get('netvlad', build_netvlad, checkpoint('model-to-check-top1.pth.tar'),
+                           post_load_fn=to_per_image_normalization)
+    superpoint = registry.get('superpoint', lambda: SuperPoint({'pretrained': False}),
+                              checkpoint('superpoint-rotation-invariant.pth.tar'))
+    return {
+        'netvlad': (netvlad, torch.rand(1, 1, args.netvlad_imgsize, args.netvlad_imgsize)),
+        'superpoint_dense': (SuperPointDense(superpoint).eval(),
+                             torch.rand(1, 1, args.feature_imgsize, args.feature_imgsize)),
+    }
+
+
+def export_torchscript(model, example, filename):
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    torch.jit.save(traced, filename)
+
+
+def export_onnx(model, example, filename, output_names):
+    dynamic_axes = {'image': {0: 'batch', 2: 'height', 3: 'width'}}
+    dynamic_axes.update({name: {0: 'batch'} for name in output_names})
+    with torch.no_grad():
+        torch.onnx.export(model, example, filename, input_names=['image'], output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=args.opset, do_constant_folding=True)
+
+
+def as_tuple(outputs):
+    return outputs if isinstance(outputs, (tuple, list)) else (outputs,)
+
+
+def latency(model, example):
+    with torch.no_grad():
+        model(example)
+        t = time.perf_counter()
+        for _ in range(args.num_runs):
+            model(example)
+    return (time.perf_counter() - t) / args.num_runs
+
+
+def export():
+    output_path = args.output_path or args.saved_model_path
+    os.makedirs(output_path, exist_ok=True)
+    backends = {'torchscript': 'torchscript', 'onnx': 'onnxruntime'}
+    failed = False
+    for name, (model, example) in load_models().items():
+        with torch.no_grad():
+            expected = as_tuple(model(example))
+        output_names = ['vlad'] if name == 'netvlad' else ['scores', 'descriptors']
+        results = {'eager': latency(model, example)}
+        for export_format in args.formats:
+            backend = backends[export_format]
+            filename = exported_model_file(output_path, name, backend)
+            if export_format == 'torchscript':
+                export_torchscript(model, example, filename)
+            else:
+                export_onnx(model, example, filename, output_names)
+            print("Exported {} to {}".format(name, filename))
+
+            exported = ExportedModel(filename, backend)
+            with torch.no_grad():
+                outputs = as_tuple(exported(example))
+            max_diff = max(float((output - expected_output).abs().max())
+                           for output, expected_output in zip(outputs, expected))
+            print("{} {}: max abs difference to eager {:.2e}".format(name, backend, max_diff))
+            if not max_diff <= args.tolerance:
+                print("{} {}: parity check FAILED".format(name, backend))
+                failed = True
+            results[backend] = latency(exported, example)
+
+        print("{} latency on {}x{}:".format(name, example.shape[2], example.shape[3]))
+        for backend, seconds in results.items():
+            print("  {:12s} {:8.1f} ms  x{:.2f}".format(backend, seconds * 1e3, results['eager'] / seconds))
+    if failed:
+        raise SystemExit("Exported models differ from the eager models")
+
+
+if __name__ == '__main__':
+    export()
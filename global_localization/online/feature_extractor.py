@@ -1,11 +1,15 @@
-from model.Superglue.superpoint import SuperPoint
+from model.Superglue.superpoint import SuperPoint, SuperPointDense
 import os
 import torch
 # import PIL.Image as Image
 import torchvision.transforms as transforms
+from global_localization.common.timer import StageProfiler
+from global_localization.common.model_registry import default_registry
+from global_localization.common.exported_model import exported_model_file
+from global_localization.common.quantization import quantize_static, load_calibration_images
 
 class FeatureExtractor(object):
-    def __init__(self, config={}):
+    def __init__(self, config={}, profiler=None, registry=None):
         super().__init__()
         default_config = {
             "images_dir": "/media/li/lavie/dataset/birdview_dataset/00",
@@ -14,29 +18,120 @@ class FeatureExtractor(object):
                 'keypoint_threshold': 0.005,
                 'max_keypoints': -1,
             },
+            # keypoint budget policy:
+            #   'none': all keypoints above the threshold (superpoint config is used as is)
+            #   'top_k': the max_keypoints best keypoints
+            #   'grid': max_keypoints spread over a grid_cells * grid_cells grid
+            #   'latency': query keypoints adapted so that SuperGlue takes about target_latency seconds per
+            #              candidate, assuming latency = c * K * N for K query keypoints and N candidate keypoints
+            'keypoint_budget': {
+                'policy': 'none',
+                'max_keypoints': 1024,
+                'min_keypoints': 128,
+                'grid_cells': 8,
+                'target_latency': 0.1,
+            },
             'saved_model_path': '/media/li/lavie/dataset/birdview_dataset/saved_models',
+            # dense part of SuperPoint: 'eager', or exported by offline/export_models.py: 'torchscript', 'onnxruntime',
+            # keypoint selection stays eager and SuperGlue in PoseEstimator is never exported
+            'backend': 'eager',
+            'exported_model_path': None,  # saved_model_path if None
+            # 'static': int8 encoder on CPU with the eager backend, calibrated on the SPIs of calibration_images_dir,
+            #           the score and descriptor heads are kept in fp32
+            'quantization': {
+                'mode': 'none',
+                'backend': 'x86',  # 'qnnpack' on ARM
+                'calibration_images_dir': None,
+                'num_calibration_images': 32,
+                'image_size': 400,
+            },
             # "resolution": 400,
         }
 
         config = {**default_config, **config}
+        quantization_config = {**default_config['quantization'], **config['quantization']}
+        assert quantization_config['mode'] in ['none', 'static']
 
         # self.resolution_ = config["resolution"]
-        self.superpoint_  = SuperPoint(config['superpoint'])
+        self.budget_config_ = {**default_config['keypoint_budget'], **config['keypoint_budget']}
+        policy = self.budget_config_['policy']
+        assert policy in ['none', 'top_k', 'grid', 'latency'], "Unknown keypoint budget policy {}".format(policy)
+        if policy != 'none':
+            config['superpoint'] = {**config['superpoint'], 'max_keypoints': self.budget_config_['max_keypoints']}
+        if policy == 'grid':
+            config['superpoint']['grid_cells'] = self.budget_config_['grid_cells']
+        # current number of query keypoints and estimated c of latency = c * K * N for the 'latency' policy
+        self.keypoint_budget_ = config['superpoint']['max_keypoints']
+        self.latency_coefficient_ = None
 
         # saved_model_file_superpoint = os.path.join(config["saved_model_path"], 'superpoint-juxin.pth.tar')
-        saved_model_file_superpoint = os.path.join(config["saved_model_path"], 'superpoint-rotation-invariant.pth.tar')
-
-        model_checkpoint = torch.load(saved_model_file_superpoint, map_location=lambda storage, loc: storage)
-        self.superpoint_.load_state_dict(model_checkpoint)
+        self.saved_model_file_ = os.path.join(config["saved_model_path"], 'superpoint-rotation-invariant.pth.tar')
+        self.superpoint_config_ = config['superpoint']
 
-        self.device_ = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.superpoint_.to(self.device_)
-        self.superpoint_.eval()
+        self.device_ = torch.device("cuda" if torch.cuda.is_available() and quantization_config['mode'] == 'none' else "cpu")
+        registry = default_registry() if registry is None else registry
+        self.superpoint_ = registry.get('superpoint', lambda: SuperPoint({**config['superpoint'], 'pretrained': False}),
+                                        self.saved_model_file_, self.device_, model_config=config['superpoint'],
+                                        torchscript=False)
+        self.dense_model_ = None
+        if config['backend'] != 'eager':
+            exported_model_path = config['exported_model_path'] or config['saved_model_path']
+            self.dense_model_ = registry.get_exported(
+                'superpoint_dense', exported_model_file(exported_model_path, 'superpoint_dense', config['backend']),
+                config['backend'], self.device_)
+        elif quantization_config['mode'] == 'static':
+            calibrate = lambda model: quantize_static(
+                model, load_calibration_images(quantization_config['calibration_images_dir'],
+                                               quantization_config['image_size'],
+                                               quantization_config['num_calibration_images']),
+                skip_modules=['superpoint.convPb', 'superpoint.convDb'], backend=quantization_config['backend'])
+            self.dense_model_ = registry.get('superpoint_dense', lambda: SuperPointDense(self.superpoint_),
+                                             device=self.device_,
+                                             model_config={**config['superpoint'], 'quantization': quantization_config,
+                                                           'checkpoint': self.saved_model_file_},
+                                             post_load_fn=calibrate, torchscript=False)
+        self.profiler_ = StageProfiler(enabled=False) if profiler is None else profiler
 
     def extract_features(self, image):
         # Extract SuperPoint (keypoints, scores, descriptors) if not provided
-        image_tensor = transforms.ToTensor()(image[...,None]).float()[None,...].to(self.device_)
+        # image: H * W uint8 SPI, or 1 * 1 * H * W float tensor in [0, 1], see SpiPreprocessor
+        with torch.no_grad(), self.profiler_.stage('superpoint'):
+            if torch.is_tensor(image):
+                image_tensor = image.to(self.device_, non_blocking=True)
+            else:
+                image_tensor = transforms.ToTensor()(image[...,None]).float()[None,...].to(self.device_)
+            pred = self._superpoint(image_tensor, self.keypoint_budget_)
+            return {k : [item.cpu() for item in v] for k, v in pred.items()}
+
+    def _superpoint(self, image_tensor, max_keypoints):
+        if self.dense_model_ is None:
+            return self.superpoint_({'image': image_tensor, 'max_keypoints': max_keypoints})
+        scores, descriptors = self.dense_model_(image_tensor)
+        return self.superpoint_.extract_keypoints(scores, descriptors, max_keypoints)
+
+    def update_keypoint_budget(self, latency, num_keypoints, num_database_keypoints):
+        """
+        Feedback of the 'latency' policy, adapt the query keypoint budget to the measured SuperGlue latency
+        :param latency: seconds spent by SuperGlue per matched candidate
+        :param num_keypoints: number of keypoints of the query
+        :param num_database_keypoints: mean number of keypoints of the matched candidates
+        """
+        if self.budget_config_['policy'] != 'latency' or num_keypoints == 0 or num_database_keypoints == 0:
+            return
+        coefficient = latency / (num_keypoints * num_database_keypoints)
+        if self.latency_coefficient_ is None:
+            self.latency_coefficient_ = coefficient
+        else:
+            self.latency_coefficient_ = 0.9 * self.latency_coefficient_ + 0.1 * coefficient
+        budget = int(self.budget_config_['target_latency'] / (self.latency_coefficient_ * num_database_keypoints))
+        self.keypoint_budget_ = min(max(budget, self.budget_config_['min_keypoints']),
+                                    self.budget_config_['max_keypoints'])
 
+    def extract_features_batch(self, images):
+        """
+        :param images: B * 1 * H * W, float tensor
+        :return: list of B feature dicts, same format as extract_features
+        """
         with torch.no_grad():
-            pred = self.superpoint_({'image': image_tensor})
-        return {k : [item.cpu() for item in v] for k, v in pred.items()}
+            pred = self._superpoint(images.to(self.device_), self.superpoint_.config['max_keypoints'])
+        return [{k: [v[i].cpu()] for k, v in pred.items()} for i in range(len(images))]
@@ -1,13 +1,25 @@
 import cv2
 import numpy as np
-import faiss
 from scipy.spatial.transform import Rotation as R
 import os
+import time
 from tqdm import tqdm
+from torch.utils.data import DataLoader
 from global_localization.online.place_recognizer import PlaceRecognizer
 from global_localization.online.feature_extractor import FeatureExtractor
 from global_localization.online.pose_estimator import PoseEstimator
+from model.Birdview.vlad_index import VladIndex
 from global_localization.common.image_info import make_images_info
+from global_localization.common.spi_database import SpiDatabaseCache, load_spi_entries
+from global_localization.common.feature_store import FeatureStore, StoredFeatures
+from global_localization.common.spi_dataset import SpiImageDataset
+from global_localization.common.spi_preprocessor import SpiPreprocessor
+from global_localization.common.spi_map import SpiMap
+from global_localization.common.tiled_map import TiledSpiMap
+from global_localization.common.verification_cache import VerificationCache
+from global_localization.common.sequence_matcher import SequenceMatcher
+from global_localization.common.timer import StageProfiler
+from global_localization.common.model_registry import configure_default_registry
 
 
 
@@ -26,39 +38,126 @@ class GlobalLocalizer(object):
             "top_k": 3,
             "meters_per_pixel": 0.25,
             "scale": 100,
+            # frames of preallocated resized SPIs reused in a ring, see SpiPreprocessor
+            "preprocess_buffers": 4,
             "min_inliers": 20,
             "max_inliers": 40,
             "loop_detect_threshold": 10,
             "pure_localization": True,
+            # directory of the precomputed SPI database, None to extract the database at every start
+            "database_cache_dir": None,
+            # pure localization in a map split into tiles by offline/build_map_tiles.py, instead of the database
+            # struct file: tiles are loaded around the pose prior (the last fix when no prior is given, no
+            # candidates before the first one) and released beyond the memory budget of the loaded tiles
+            "map_tiles_dir": None,
+            "map_memory_budget_mb": 1024,
+            # reuse of recent verification results of the same candidates, see VerificationCache.default_config
+            "verification_cache": {},
+            # pure localization: the database SPI matching the recent queries as a sequence is the only candidate,
+            # top_k single frame retrieval when no run is distinctive, see SequenceMatcher.default_config
+            "sequence_matching": {},
+            # storage of the database features, see FeatureStore.build: 'float16' or 'pq' descriptors
+            "feature_store": {
+                "descriptor_codec": "float16",
+            },
+            # batched extraction of the database
+            "batch_size": 8,
+            "num_workers": 4,
+            # nearest neighbour index of NetVLAD descriptors, see VladIndex.default_config
+            "index": {
+                "type": "flat",
+            },
+            # SLAM mode: the map is saved to map_snapshot_dir every map_snapshot_period SPIs, in a background
+            # thread, and restored from it at start, None to disable
+            "map_snapshot_dir": None,
+            "map_snapshot_period": 100,
+            # SLAM mode: the oldest SPIs are removed beyond map_max_size SPIs, None to keep all of them,
+            # not supported by 'hnsw' indices
+            "map_max_size": None,
+            # default search radius around a prior pose, in meters
+            "prior_radius": 50.0,
+            # search the whole map when no SPI lies within the prior radius, never for tiled maps
+            "prior_fallback_global": True,
+            # per-stage latency histograms, exported to export_file as 'json' or 'prometheus' text
+            "profiling": {
+                "enabled": False,
+                "export_file": None,
+                "export_format": "json",
+            },
+            # configs of the models, see PlaceRecognizer, FeatureExtractor and PoseEstimator
+            "place_recognizer": {},
+            "feature_extractor": {},
+            "pose_estimator": {},
+            # options of the registry the models are loaded once by, see ModelRegistry.default_config
+            "model_registry": {},
         }
         self.config_ = {**default_config, **config}
+        assert self.config_["map_max_size"] is None or self.config_["index"].get("type", "flat") != "hnsw", \
+            "map_max_size needs to remove SPIs from the index, which a 'hnsw' index does not support"
         self.database_images_dir_ = self.config_["database_images_dir"]
         self.tmp_image_dir = self.config_["tmp_image_dir"]
         self.netvlad_imgsize_ = self.config_["netvlad_imgsize"]
-        self.images_info_ = []
-        self.index_ = faiss.IndexFlatL2(self.config_['vlad_dim'])
+        self.map_ = SpiMap(self.config_['vlad_dim'], self.config_['index'])
         self.top_k_ = self.config_["top_k"]
         self.pure_localization_ = self.config_["pure_localization"]
 
         self.feature_imgsize_ = int(self.config_["scale"] / self.config_["meters_per_pixel"])
+        self.preprocessor_ = SpiPreprocessor([self.netvlad_imgsize_, self.feature_imgsize_],
+                                             self.config_["preprocess_buffers"], as_tensor=True)
         self.min_inliers_ = self.config_["min_inliers"]
         self.max_inliers_ = self.config_["max_inliers"]
-        self.place_recognizer_ = PlaceRecognizer()
-        self.feature_extractor_ = FeatureExtractor()
-        self.pose_estimator_ = PoseEstimator()
+        self.profiling_config_ = {**default_config["profiling"], **self.config_["profiling"]}
+        self.profiler_ = StageProfiler(enabled=self.profiling_config_["enabled"])
+        configure_default_registry(self.config_["model_registry"])
+        self.place_recognizer_ = PlaceRecognizer(self.config_["place_recognizer"], profiler=self.profiler_)
+        self.feature_extractor_ = FeatureExtractor(self.config_["feature_extractor"], profiler=self.profiler_)
+        self.pose_estimator_ = PoseEstimator(self.config_["pose_estimator"], profiler=self.profiler_)
 
+        self.verification_cache_ = VerificationCache(self.config_["verification_cache"])
+        self.sequence_matcher_ = SequenceMatcher(self.config_["sequence_matching"])
+        assert not self.sequence_matcher_.config_['enabled'] or \
+            (self.pure_localization_ and self.config_["map_tiles_dir"] is None), \
+            "Sequence matching needs the database of pure localization"
         self.image_id_ = 0
+        # pose of the last verified query, prior of the searches in tiled maps
+        self.last_fix_ = None
 
-        if self.pure_localization_:
+        if self.pure_localization_ and self.config_["map_tiles_dir"] is not None:
+            self.map_ = TiledSpiMap(self.config_["map_tiles_dir"], self.config_['index'],
+                                    self.config_["map_memory_budget_mb"])
+        elif self.pure_localization_:
             print("Loading SPI database from {} ...".format(self.config_["database_images_dir"]))
             self.load_spi_database()
+        elif self.config_["map_snapshot_dir"] is not None:
+            spi_map = SpiMap.restore(self.config_["map_snapshot_dir"], self.config_['vlad_dim'], self.config_['index'])
+            if spi_map is not None:
+                self.map_ = spi_map
+                print("Restored map of {} SPIs from {}".format(len(self.map_), self.config_["map_snapshot_dir"]))
         pass
 
-    def handle_slam_spi(self, image, pose, seq):
+    def handle_slam_spi(self, image, pose, seq, prior_pose=None, prior_radius=None):
+        """
+        :param prior_pose: 4 * 4, coarse pose of the SPI (GNSS or previous fix), None if unknown
+        :param prior_radius: meters, only SPIs within prior_radius of prior_pose are candidates,
+                             None for config "prior_radius"
+        """
+        with self.profiler_.stage('total'):
+            spinetvlad_image, features_image = self.preprocess_spi(image)
+            query_image_info = self.extract_spi(spinetvlad_image, features_image, pose, seq)
+            candidate_images_info = self.retrieve_candidates(query_image_info, prior_pose, prior_radius)
+            return self.verify_candidates(query_image_info, candidate_images_info)
 
-        spinetvlad_image = cv2.resize(image, (self.netvlad_imgsize_, self.netvlad_imgsize_), interpolation=cv2.INTER_LINEAR) # 8 ms
-        features_image = cv2.resize(image, (self.feature_imgsize_, self.feature_imgsize_), interpolation=cv2.INTER_LINEAR) # 8 ms
+    def preprocess_spi(self, image, buffer_index=None):
+        """
+        :param buffer_index: frame of the preprocessor reserved by SpiPreprocessor.acquire, None for the next one
+        :return: SPI resized for NetVLAD and SuperPoint as 1 * 1 * H * W float tensors, without buffer_index
+                 overwritten after config "preprocess_buffers" calls
+        """
+        with self.profiler_.stage('resize'):
+            spinetvlad_image, features_image = self.preprocessor_(image, buffer_index)
+        return spinetvlad_image, features_image
 
+    def extract_spi(self, spinetvlad_image, features_image, pose, seq):
         global_descriptor = self.place_recognizer_.extract_descriptor(spinetvlad_image)  # 1 * D
         local_features = self.feature_extractor_.extract_features(features_image) # dict
 
@@ -70,28 +169,92 @@ class GlobalLocalizer(object):
             'vlad': global_descriptor.squeeze(),
             "features": local_features,
         }
+        return query_image_info
+
+    def retrieve_candidates(self, query_image_info, prior_pose=None, prior_radius=None):
+        """
+        Search the query in the database, in SLAM mode the query is then added to the database
+        :param prior_pose: 4 * 4, the search is restricted to SPIs around it, None to search the whole database
+        :param prior_radius: meters, None for config "prior_radius"
+        :return: candidate_images_info: list of image info, empty if the database is too small
+        """
+        global_descriptor = query_image_info['vlad'][None, ...]
+        candidate_images_info = []
+        tiled_map = isinstance(self.map_, TiledSpiMap)
+        if tiled_map and prior_pose is None:
+            # a search without prior would load every tile
+            prior_pose = self.last_fix_
+            if prior_pose is None:
+                print("No pose prior nor previous fix to search the tiled map around, no candidates")
+                return candidate_images_info
+        if len(self.map_) >= self.top_k_:
+            # search spi in database
+            # Deny some adjacent results
+            max_id = None if self.pure_localization_ else self.map_.next_id - self.config_['loop_detect_threshold']
+            prior_radius = self.config_["prior_radius"] if prior_radius is None else prior_radius
+            with self.profiler_.stage('search'):
+                if self.sequence_matcher_.config_['enabled']:
+                    candidate_images_info = self._match_sequence(query_image_info, prior_pose, prior_radius)
+                if len(candidate_images_info) == 0 and prior_pose is not None:
+                    candidate_images_info = self.map_.search(global_descriptor, self.top_k_, max_id=max_id,
+                                                             prior_position=prior_pose[:3, 3], prior_radius=prior_radius)
+                    if len(candidate_images_info) == 0 and self.config_["prior_fallback_global"] and not tiled_map:
+                        candidate_images_info = self.map_.search(global_descriptor, self.top_k_, max_id=max_id)
+                elif len(candidate_images_info) == 0:
+                    candidate_images_info = self.map_.search(global_descriptor, self.top_k_, max_id=max_id)
+
+        # save image info
+        if not self.pure_localization_:
+            spi_id = self.map_.append(query_image_info)
+            max_size = self.config_["map_max_size"]
+            if max_size is not None and len(self.map_) > max_size:
+                self.map_.remove(self.map_.oldest_ids(len(self.map_) - max_size))
+            snapshot_dir = self.config_["map_snapshot_dir"]
+            if snapshot_dir is not None and (spi_id + 1) % self.config_["map_snapshot_period"] == 0:
+                self.map_.snapshot(snapshot_dir, background=True)
+        return candidate_images_info
+
+    def _match_sequence(self, query_image_info, prior_pose, prior_radius):
+        """
+        :return: [image info of the head of the best run], empty if there is no distinctive run
+        """
+        allowed_ids = None if prior_pose is None else self.map_.ids_within(prior_pose[:3, 3], prior_radius)
+        match = self.sequence_matcher_.match(query_image_info['vlad'], allowed_ids)
+        if match is None:
+            return []
+        return [self.map_[match[0]]]
+
+    def verify_candidates(self, query_image_info, candidate_images_info):
+        """
+        :return: best_T_w_source: 4 * 4, None if no candidate is verified
+                 best_score: number of inliers of the best candidate
+        """
         # best_T_w_target = None
         best_candidate_image_info = None
         best_T_w_source, best_score = None, -1
-        if len(self.images_info_) >= self.top_k_:
-            assert(len(self.images_info_) == self.index_.ntotal)
-
-            # search spi in database
-            if not self.pure_localization_:
-                # Deny some adjacent results
-                distances, result_indices = self.index_.search(global_descriptor, 30)
-                result_indices = result_indices[0]
-                result_indices = result_indices[result_indices >= 0]
-                result_indices = result_indices[result_indices < (len(self.images_info_) - self.config_['loop_detect_threshold'])]
-                if len(result_indices) >= self.top_k_:
-                    result_indices = result_indices[:self.top_k_]
-                candidate_images_info = [self.images_info_[index] for index in result_indices]
-            else:
-                distances, result_indices = self.index_.search(global_descriptor, self.top_k_)
-                candidate_images_info = [self.images_info_[index] for index in result_indices[0]]
-
-            for candidate_image_info in candidate_images_info:
-                T_target_source, score = self.pose_estimator_.estimate_pose(query_image_info, candidate_image_info)
+        if len(candidate_images_info) > 0:
+            poses = [None] * len(candidate_images_info)
+            if self.verification_cache_.config_['enabled']:
+                poses = [self.verification_cache_.get(query_image_info, candidate_image_info)
+                         for candidate_image_info in candidate_images_info]
+            uncached_indices = [i for i, pose in enumerate(poses) if pose is None]
+            # a cached verification with enough inliers makes the others unnecessary
+            if any(pose is not None and pose[1] is not None and pose[1] > self.max_inliers_ for pose in poses):
+                uncached_indices = []
+            poses = [(None, None, None) if pose is None else pose for pose in poses]
+            if len(uncached_indices) > 0:
+                # verify all uncached candidates with a single SuperGlue forward pass
+                uncached_poses = self.pose_estimator_.estimate_poses(
+                    query_image_info, [candidate_images_info[i] for i in uncached_indices])
+                if self.pose_estimator_.superglue_latency_ is not None:
+                    latency, num_database_keypoints = self.pose_estimator_.superglue_latency_
+                    self.feature_extractor_.update_keypoint_budget(
+                        latency, len(query_image_info['features']['keypoints'][0]), num_database_keypoints)
+                for i, pose in zip(uncached_indices, uncached_poses):
+                    poses[i] = pose
+                    if self.verification_cache_.config_['enabled']:
+                        self.verification_cache_.put(query_image_info, candidate_images_info[i], pose)
+            for candidate_image_info, (T_target_source, score, _) in zip(candidate_images_info, poses):
                 if T_target_source is None or score < self.min_inliers_:
                     continue
                 if score > best_score:
@@ -113,12 +276,9 @@ class GlobalLocalizer(object):
                 if best_score > self.max_inliers_:
                     break
 
-        # save image info
-        if not self.pure_localization_:
-            self.images_info_.append(query_image_info)
-            self.index_.add(global_descriptor)
-
         # print("Saved SPI ", global_descriptor.shape)
+        if best_T_w_source is not None:
+            self.last_fix_ = best_T_w_source
         if best_candidate_image_info is not None:
             # print("candidate position: {}".format(best_candidate_image_info['pose'][:3, 3]))
             print("candidate submap: {}".format(best_candidate_image_info['image_file']))
@@ -129,10 +289,18 @@ class GlobalLocalizer(object):
     def handle_localization_spi(self, image):
         pass
 
-    def load_spi_database(self, struct_file=None, images_dir=None):
+    def export_profile(self):
+        """
+        Write the stage latency histograms to the configured export file, if any
+        """
+        if self.profiler_.enabled and self.profiling_config_["export_file"] is not None:
+            self.profiler_.export(self.profiling_config_["export_file"], self.profiling_config_["export_format"])
+
+    def load_spi_database(self, struct_file=None, images_dir=None, cache_dir=None):
         """
         :param struct_file: xxx.txt
         :param images_dir: directory of SPI images
+        :param cache_dir: directory of the precomputed SPI database, None for config "database_cache_dir"
         :return:
         """
 
@@ -140,24 +308,82 @@ class GlobalLocalizer(object):
             struct_file = self.config_['database_struct_file']
         if images_dir is None:
             images_dir = self.config_['database_images_dir']
+        if cache_dir is None:
+            cache_dir = self.config_['database_cache_dir']
 
-        self.images_info_ = make_images_info(struct_file)
-        global_descriptors = []
-        for image_info in tqdm(self.images_info_):
-            image = cv2.imread(os.path.join(images_dir, image_info['image_file']), cv2.IMREAD_GRAYSCALE)
-            spinetvlad_image = cv2.resize(image, (self.netvlad_imgsize_, self.netvlad_imgsize_), interpolation=cv2.INTER_LINEAR)  # 8 ms
-            features_image = cv2.resize(image, (self.feature_imgsize_, self.feature_imgsize_), interpolation=cv2.INTER_LINEAR)  # 8 ms
+        images_info = make_images_info(struct_file)
+        cache_up_to_date = False
+        if cache_dir is None:
+            self._extract_spi_entries(images_info, images_dir)
+            global_descriptors = np.vstack([image_info['vlad'][None, ...] for image_info in images_info])
+        else:
+            cache = SpiDatabaseCache(cache_dir,
+                                     model_files={
+                                         'netvlad': self.place_recognizer_.saved_model_file_,
+                                         'superpoint': self.feature_extractor_.saved_model_file_,
+                                     },
+                                     params={
+                                         'netvlad_imgsize': self.netvlad_imgsize_,
+                                         'feature_imgsize': self.feature_imgsize_,
+                                         'superpoint': self.feature_extractor_.superpoint_config_,
+                                     },
+                                     feature_store_config=self.config_["feature_store"])
+            stale_indices, global_descriptors = cache.restore(struct_file, images_info, images_dir)
+            cache_up_to_date = global_descriptors is not None
+            if not cache_up_to_date:
+                print("Extracting {} of {} SPIs missing in cache".format(len(stale_indices), len(images_info)))
+                self._extract_spi_entries([images_info[i] for i in stale_indices], images_dir)
+                cache.save(images_info)
+                # the entries written to the cache are used, the features are stored as in the next runs
+                cached_images_info, global_descriptors, _ = load_spi_entries(cache_dir)
+                for image_info, cached_image_info in zip(images_info, cached_images_info):
+                    image_info['vlad'] = cached_image_info['vlad']
+                    image_info['features'] = cached_image_info['features']
+        if not all(isinstance(image_info['features'], StoredFeatures) for image_info in images_info):
+            # features extracted now are packed like the cached ones
+            feature_store = FeatureStore.build([image_info['features'] for image_info in images_info],
+                                               **self.config_["feature_store"])
+            for i, image_info in enumerate(images_info):
+                image_info['features'] = feature_store.features(i)
+        self.map_ = SpiMap(self.config_['vlad_dim'], self.config_['index'])
+        self.map_.index_ = self._build_index(global_descriptors, cache_dir, from_cache=cache_up_to_date)
+        self.map_.images_info_ = {spi_id: image_info for spi_id, image_info in enumerate(images_info)}
+        self.sequence_matcher_.set_database(global_descriptors)
 
-            global_descriptor = self.place_recognizer_.extract_descriptor(spinetvlad_image)  # 1 * D
-            local_features = self.feature_extractor_.extract_features(features_image)  # dict
+        assert(len(self.map_) == self.map_.index_.ntotal)
 
-            image_info['vlad'] = global_descriptor.squeeze()
-            image_info['features'] = local_features
-
-            global_descriptors.append(global_descriptor)
-        global_descriptors = np.vstack(global_descriptors)
-        self.index_.add(global_descriptors)
-
-        assert(len(self.images_info_) == self.index_.ntotal)
+    def _build_index(self, global_descriptors, cache_dir, from_cache):
+        """
+        Train and fill the descriptor index, the index is saved next to the database cache
+        :return: VladIndex, ids are the indices of the database SPIs
+        """
+        index_file = None if cache_dir is None else os.path.join(cache_dir, "vlad_{}.index".format(self.config_['index']['type']))
+        if from_cache and index_file is not None:
+            index = VladIndex.load(index_file, self.config_['index'])
+            if index is not None and index.ntotal == len(global_descriptors):
+                return index
+        index = VladIndex(self.config_['vlad_dim'], self.config_['index'])
+        index.add(global_descriptors)
+        index.train()
+        if index_file is not None:
+            index.save(index_file)
+        return index
 
-        pass
+    def _extract_spi_entries(self, images_info, images_dir):
+        """
+        Compute NetVLAD descriptors and SuperPoint features of the given SPIs in place
+        :param images_info: list of image info
+        :param images_dir: directory of SPI images
+        """
+        if len(images_info) == 0:
+            return
+        dataset = SpiImageDataset(images_info, images_dir, self.netvlad_imgsize_, self.feature_imgsize_)
+        data_loader = DataLoader(dataset, batch_size=self.config_['batch_size'], num_workers=self.config_['num_workers'])
+        t0 = time.time()
+        for spinetvlad_images, features_images, indices in tqdm(data_loader):
+            global_descriptors = self.place_recognizer_.extract_descriptors(spinetvlad_images)  # B * D
+            local_features = self.feature_extractor_.extract_features_batch(features_images)  # list of dict
+            for index, global_descriptor, features in zip(indices.tolist(), global_descriptors, local_features):
+                images_info[index]['vlad'] = global_descriptor
+                images_info[index]['features'] = features
+        print("Extracted {} SPIs at {:.1f} images/s".format(len(images_info), len(images_info) / (time.time() - t0)))
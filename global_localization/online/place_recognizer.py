@@ -2,13 +2,19 @@ import sys
 sys.path.append("../../")
 import numpy as np
 import torch
-import faiss
 import torchvision.transforms as transforms
-from model.Birdview.base_model import BaseModel
+from model.Birdview.base_model import BaseModel, to_per_image_normalization
 from model.Birdview.netvlad import NetVLAD
 from model.Birdview.netvlad import EmbedNet
+from model.Birdview.dataset import DatabaseImageDataset
+from model.Birdview.vlad_index import VladIndex
+from global_localization.common.timer import StageProfiler
+from global_localization.common.model_registry import default_registry
+from global_localization.common.exported_model import exported_model_file
+from global_localization.common.quantization import quantize_dynamic, quantize_static, load_calibration_images
+from torch.utils.data import DataLoader
 from tqdm import tqdm
-from PIL import Image
+import time
 import os
 
 
@@ -18,7 +24,7 @@ def input_transforms():
     ])
 
 class PlaceRecognizer(object):
-    def __init__(self, config={}, images_info=None, load_database=False):
+    def __init__(self, config={}, images_info=None, load_database=False, profiler=None, registry=None):
         super().__init__()
         default_config = {
             'saved_model_path': '/media/li/lavie/dataset/birdview_dataset/saved_models',
@@ -26,26 +32,71 @@ class PlaceRecognizer(object):
             'final_dim': 256,
             'save_dir': None,
             'num_results': 3,
-
+            'images_dir': None,
+            'batch_size': 8,
+            'num_workers': 4,
+            'index': {
+                'type': 'flat',
+            },
+            # 'eager', or a network exported by offline/export_models.py: 'torchscript', 'onnxruntime',
+            # only for extraction, SuperGlue in PoseEstimator is never exported
+            'backend': 'eager',
+            'exported_model_path': None,  # saved_model_path if None
+            # int8 inference on CPU with the eager backend:
+            #   'dynamic': int8 projection layer
+            #   'static': 'dynamic' and the backbone calibrated on the SPIs of calibration_images_dir
+            'quantization': {
+                'mode': 'none',
+                'backend': 'x86',  # 'qnnpack' on ARM
+                'calibration_images_dir': None,
+                'num_calibration_images': 32,
+                'image_size': 1000,
+            },
         }
         config = {**default_config, **config}
-
-        base_model = BaseModel()
-        net_vlad = NetVLAD(num_clusters=config["num_clusters"], dim=256, alpha=1.0, outdim=config["final_dim"])
-        self.model_ = EmbedNet(base_model, net_vlad)
-        saved_model_file = os.path.join(config["saved_model_path"], 'model-to-check-top1.pth.tar')
-        model_checkpoint = torch.load(saved_model_file, map_location=lambda storage, loc: storage)
-        self.model_.load_state_dict(model_checkpoint)
+        quantization_config = {**default_config['quantization'], **config['quantization']}
+        assert quantization_config['mode'] in ['none', 'dynamic', 'static']
+
+        def build_model():
+            base_model = BaseModel()
+            net_vlad = NetVLAD(num_clusters=config["num_clusters"], dim=256, alpha=1.0, outdim=config["final_dim"])
+            return EmbedNet(base_model, net_vlad)
+
+        def post_load(model):
+            model = to_per_image_normalization(model)
+            if quantization_config['mode'] == 'static':
+                calibration_images = load_calibration_images(quantization_config['calibration_images_dir'],
+                                                              quantization_config['image_size'],
+                                                              quantization_config['num_calibration_images'])
+                model.base_model = quantize_static(model.base_model, calibration_images,
+                                                   backend=quantization_config['backend'])
+            if quantization_config['mode'] != 'none':
+                model = quantize_dynamic(model, quantization_config['backend'])
+            return model
+
+        self.saved_model_file_ = os.path.join(config["saved_model_path"], 'model-to-check-top1.pth.tar')
+        self.device_ = torch.device("cuda" if torch.cuda.is_available() and quantization_config['mode'] == 'none' else "cpu")
+        # self.device_ = torch.device("cpu")
+        registry = default_registry() if registry is None else registry
+        if config['backend'] == 'eager':
+            self.model_ = registry.get('netvlad', build_model, self.saved_model_file_, self.device_,
+                                       model_config={'num_clusters': config["num_clusters"], 'final_dim': config["final_dim"],
+                                                     'quantization': quantization_config},
+                                       post_load_fn=post_load)
+        else:
+            exported_model_path = config['exported_model_path'] or config['saved_model_path']
+            self.model_ = registry.get_exported('netvlad', exported_model_file(exported_model_path, 'netvlad', config['backend']),
+                                                config['backend'], self.device_)
 
         self.save_dir_ = config['save_dir']
         self.images_info_ = [] if images_info is None else images_info
-        self.index_ = faiss.IndexFlatL2(config['final_dim'])
-        self.device_ = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        # self.device_ = torch.device("cpu")
-        self.model_.to(self.device_)
+        self.index_ = VladIndex(config['final_dim'], config['index'])
         self.input_transforms_ = input_transforms()
         self.num_results_ = config["num_results"]
+        self.images_dir_ = config["images_dir"]
+        self.batch_size_ = config["batch_size"]
+        self.num_workers_ = config["num_workers"]
+        self.profiler_ = StageProfiler(enabled=False) if profiler is None else profiler
 
         if load_database:
             self._generate_database()
@@ -98,30 +149,43 @@ class PlaceRecognizer(object):
 
     @torch.no_grad()
     def extract_descriptor(self, image):
-        with torch.no_grad():
-            input = self.input_transforms_(image).unsqueeze(0).to(self.device_)
+        """
+        :param image: H * W uint8 SPI, or 1 * 1 * H * W float tensor in [0, 1], see SpiPreprocessor
+        :return: 1 * D
+        """
+        with torch.no_grad(), self.profiler_.stage('netvlad'):
+            if torch.is_tensor(image):
+                input = image.to(self.device_, non_blocking=True)
+            else:
+                input = self.input_transforms_(image).unsqueeze(0).to(self.device_)
             netvlad_encoding = self.model_(input).cpu().numpy() # 1, D
         return netvlad_encoding
 
+    @torch.no_grad()
+    def extract_descriptors(self, images):
+        """
+        :param images: B * 1 * H * W, float tensor
+        :return: B * D
+        """
+        return self.model_(images.to(self.device_)).cpu().numpy()
+
     @torch.no_grad()
     def _generate_database(self):
         assert len(self.images_info_) > 0
-        encodings = []
-        # self.database = []
-        print('Generating database from \'{}\'...'.format(self.images_dir))
-        with torch.no_grad():
-            for image_info in tqdm(self.images_info):
-                image = Image.open(os.path.join(self.images_dir, image_info['image_file']))
-                input = self.input_transforms(image).unsqueeze(0).to(self.device)
-                netvlad_encoding = self.model_(input).cpu().numpy().squeeze()
-                image_info['encoding'] = netvlad_encoding
-                encodings.append(netvlad_encoding)
-
-        dim_encoding = len(encodings[0])
-        encodings = np.array(encodings)
-        self.index = faiss.IndexFlatL2(dim_encoding)
-        self.index.add(encodings)
-        self.images_info = np.array(self.images_info)
+        assert self.images_dir_ is not None
+        print('Generating database from \'{}\'...'.format(self.images_dir_))
+        dataset = DatabaseImageDataset(self.images_info_, self.images_dir_, transforms=self.input_transforms_)
+        data_loader = DataLoader(dataset, batch_size=self.batch_size_, num_workers=self.num_workers_)
+        encodings = np.zeros((len(self.images_info_), self.index_.d), dtype=np.float32)
+        t0 = time.time()
+        for images, indices in tqdm(data_loader):
+            encodings[indices.numpy()] = self.extract_descriptors(images)
+        print("Encoded {} images at {:.1f} images/s".format(len(encodings), len(encodings) / (time.time() - t0)))
+
+        for image_info, encoding in zip(self.images_info_, encodings):
+            image_info['encoding'] = encoding
+        self.index_.add(encodings)
+        self.index_.train()
         print("Generation of database finished")
 
     def export_database(self, filename):
@@ -1,66 +1,126 @@
 from model.Superglue.superglue import SuperGlue
-from global_localization.common.compute_pose import compute_relative_pose_with_ransac
+from global_localization.common.compute_pose import compute_relative_poses_with_ransac
 from model.Superglue.dataset import pts_from_pixel_to_meter
+from global_localization.common.timer import StageProfiler
+from global_localization.common.model_registry import default_registry
+from global_localization.common.quantization import quantize_dynamic
 import torch
 import os
+import time
 
 
 class PoseEstimator(object):
-    def __init__(self, config=None):
+    def __init__(self, config=None, profiler=None, registry=None):
         super().__init__()
-        if config is None:
-            config = {
-                # "images_dir": "/media/li/lavie/dataset/birdview_dataset/00",
-                'superglue': {
-                    'weights': 'outdoor',
-                    'sinkhorn_iterations': 100,
-                    'match_threshold': 0.2,
-                },
-                'saved_model_path': '/media/li/lavie/dataset/birdview_dataset/saved_models',
-                "meters_per_pixel": 0.25,
-                "scale": 100,
-            }
+        default_config = {
+            # "images_dir": "/media/li/lavie/dataset/birdview_dataset/00",
+            'superglue': {
+                'weights': 'outdoor',
+                'sinkhorn_iterations': 100,
+                'sinkhorn_tolerance': 1e-3,
+                'match_threshold': 0.2,
+            },
+            'saved_model_path': '/media/li/lavie/dataset/birdview_dataset/saved_models',
+            "meters_per_pixel": 0.25,
+            "scale": 100,
+            # SuperGlue always runs as an eager module, offline/export_models.py exports extraction networks only
+            # 'dynamic': int8 MLPs and attention projections of SuperGlue on CPU
+            'quantization': {
+                'mode': 'none',
+                'backend': 'x86',  # 'qnnpack' on ARM
+            },
+        }
+        config = {**default_config, **({} if config is None else config)}
+        config['superglue'] = {**default_config['superglue'], **config['superglue']}
+        quantization_config = {**default_config['quantization'], **config['quantization']}
+        assert quantization_config['mode'] in ['none', 'dynamic']
 
         self.meters_per_pixel_ = config["meters_per_pixel"]
-        self.superglue_  = SuperGlue(config['superglue']).eval()
         # saved_model_file_superglue = os.path.join(config["saved_model_path"], 'superglue-juxin.pth.tar')
         saved_model_file_superglue = os.path.join(config["saved_model_path"], 'superglue-rotation-invariant.pth.tar')
-        model_checkpoint = torch.load(saved_model_file_superglue, map_location=lambda storage, loc: storage)
-        self.superglue_.load_state_dict(model_checkpoint)
-
-        self.device_ = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.superglue_.to(self.device_)
+        self.device_ = torch.device("cuda" if torch.cuda.is_available() and quantization_config['mode'] == 'none' else "cpu")
+        registry = default_registry() if registry is None else registry
+        post_load = None
+        if quantization_config['mode'] == 'dynamic':
+            post_load = lambda model: quantize_dynamic(model, quantization_config['backend'])
+        self.superglue_ = registry.get('superglue', lambda: SuperGlue({**config['superglue'], 'pretrained': False}),
+                                       saved_model_file_superglue, self.device_,
+                                       model_config={**config['superglue'], 'quantization': quantization_config},
+                                       post_load_fn=post_load, torchscript=False)
 
         self.resolution_ = int(config["scale"] / config["meters_per_pixel"])
+        self.profiler_ = StageProfiler(enabled=False) if profiler is None else profiler
+        # (seconds per candidate, mean number of candidate keypoints) of the last SuperGlue pass, None if skipped
+        self.superglue_latency_ = None
 
     def estimate_pose(self, query_image_info, candidate_image_info):
+        """
+        :return: T_target_source, score: number of inliers, (None, None) if it failed,
+                 see estimate_poses for the inliers
+        """
+        return self.estimate_poses(query_image_info, [candidate_image_info])[0][:2]
+
+    def estimate_poses(self, query_image_info, candidate_images_info):
+        """
+        Match the query against all candidates with one SuperGlue forward pass, the candidate
+        keypoint sets are padded and masked
+        :return: list of (T_target_source, score, inliers) for each candidate, (None, None, None) if it failed,
+                 inliers: bool mask of the SuperGlue matches of the candidate
+        """
+        results = [(None, None, None)] * len(candidate_images_info)
+        self.superglue_latency_ = None
         query_features = query_image_info["features"]
-        candidate_features = candidate_image_info["features"]
-        keypoints0 = torch.stack(candidate_features["keypoints"])
+        candidate_indices = [i for i, candidate_image_info in enumerate(candidate_images_info)
+                             if len(candidate_image_info["features"]["keypoints"][0]) > 0]
+        if len(query_features["keypoints"][0]) == 0 or len(candidate_indices) == 0:
+            return results
+
+        b = len(candidate_indices)
+        candidates_features = [candidate_images_info[i]["features"] for i in candidate_indices]
+        num_keypoints0 = [len(features["keypoints"][0]) for features in candidates_features]
+        n = max(num_keypoints0)
+        descriptors0 = torch.zeros(b, query_features["descriptors"][0].shape[0], n)
+        keypoints0 = torch.zeros(b, n, 2)
+        scores0 = torch.zeros(b, n)
+        mask0 = torch.zeros(b, n, dtype=torch.bool)
+        for j, (features, num) in enumerate(zip(candidates_features, num_keypoints0)):
+            descriptors0[j, :, :num] = features["descriptors"][0]
+            keypoints0[j, :num] = features["keypoints"][0]
+            scores0[j, :num] = features["scores"][0]
+            mask0[j, :num] = True
+
         keypoints1 = torch.stack(query_features["keypoints"])
         data = {
-            "descriptors0": torch.stack(candidate_features["descriptors"]).to(self.device_),
+            "descriptors0": descriptors0.to(self.device_),
             "keypoints0": keypoints0.to(self.device_),
-            "scores0": torch.stack(candidate_features["scores"]).to(self.device_),
-            "descriptors1": torch.stack(query_features["descriptors"]).to(self.device_),
-            "keypoints1": keypoints1.to(self.device_),
-            "scores1": torch.stack(query_features["scores"]).to(self.device_),
+            "scores0": scores0.to(self.device_),
+            "mask0": mask0.to(self.device_),
+            "descriptors1": torch.stack(query_features["descriptors"]).expand(b, -1, -1).to(self.device_),
+            "keypoints1": keypoints1.expand(b, -1, -1).to(self.device_),
+            "scores1": torch.stack(query_features["scores"]).expand(b, -1).to(self.device_),
             "image_shape": (1, 1, self.resolution_, self.resolution_),
         }
-        with torch.no_grad():
+        t0 = time.perf_counter()
+        with torch.no_grad(), self.profiler_.stage('superglue'):
             matching_result = self.superglue_(data)
+            all_matches = matching_result['matches0'].cpu().numpy()
+        self.superglue_latency_ = ((time.perf_counter() - t0) / b, sum(num_keypoints0) / b)
 
-
-        kpts0 = keypoints0[0].cpu().numpy()
         kpts1 = keypoints1[0].cpu().numpy()
-        matches = matching_result['matches0'][0].cpu().numpy()
+        target_kpts_in_meters, source_kpts_in_meters = [], []
+        for j, num in enumerate(num_keypoints0):
+            kpts0 = keypoints0[j, :num].numpy()
+            matches = all_matches[j, :num]
 
-        valid = matches > -1
-        mkpts0 = kpts0[valid]
-        mkpts1 = kpts1[matches[valid]]
+            valid = matches > -1
+            mkpts0 = kpts0[valid]
+            mkpts1 = kpts1[matches[valid]]
 
-        target_kpts_in_meters = pts_from_pixel_to_meter(mkpts0, self.meters_per_pixel_)
-        source_kpts_in_meters = pts_from_pixel_to_meter(mkpts1, self.meters_per_pixel_)
-        T_target_source, score = compute_relative_pose_with_ransac(target_kpts_in_meters, source_kpts_in_meters)
+            target_kpts_in_meters.append(pts_from_pixel_to_meter(mkpts0, self.meters_per_pixel_))
+            source_kpts_in_meters.append(pts_from_pixel_to_meter(mkpts1, self.meters_per_pixel_))
 
-        return T_target_source, score
\ No newline at end of file
+        with self.profiler_.stage('ransac'):
+            poses = compute_relative_poses_with_ransac(target_kpts_in_meters, source_kpts_in_meters)
+        for i, result in zip(candidate_indices, poses):
+            results[i] = result
+        return results
@@ -17,6 +17,8 @@ from global_localization.online.place_recognizer import PlaceRecognizer
 from global_localization.online.feature_extractor import FeatureExtractor
 from global_localization.online.pose_estimator import PoseEstimator
 from global_localization.online.global_localizer import GlobalLocalizer
+from global_localization.online.spi_pipeline import SpiPipeline
+from global_localization.common.spi_preprocessor import SpiPreprocessor
 
 
 """
@@ -43,12 +45,13 @@ def array2CompressedImage(array):
     msg = CompressedImage()
     msg.header.stamp = rospy.Time.now()
     msg.format = "png"
-    msg.data = np.array(cv2.imencode('.png', array)[1]).tostring()
+    msg.data = cv2.imencode('.png', array)[1].tobytes()
     return msg
 
 
 def CompressedImage2Array(compressed_image):
-    np_arr = np.fromstring(compressed_image.data, np.uint8)
+    # view of the message bytes, imdecode only reads them
+    np_arr = np.frombuffer(compressed_image.data, np.uint8)
     image = cv2.imdecode(np_arr, cv2.IMREAD_GRAYSCALE)
     # msg.format = "png"
     # msg.data = np.array(cv2.imencode('.png', array)[1]).tostring()
@@ -56,8 +59,19 @@ def CompressedImage2Array(compressed_image):
 
 
 class SpiHandler(object):
-    def __init__(self):
+    def __init__(self, config={}):
         super().__init__()
+        default_config = {
+            # process SPIs in a staged asynchronous pipeline instead of inside the subscriber callback
+            "use_pipeline": True,
+            "pipeline": {
+                "queue_capacity": 1,
+                "drop_policy": "newest",  # 'newest', 'keep_n' or 'block'
+            },
+            "statistics_period": 10.0,  # seconds, <= 0 to disable
+            "global_localizer": {},  # see GlobalLocalizer, e.g. {"profiling": {"enabled": True, ...}}
+        }
+        self.config_ = {**default_config, **config}
         rospy.init_node('spi_handler', anonymous=True)
         # self.database_spi_sub_ = rospy.Subscriber("query_spi_image", CompressedImage, self.db_spi_image_callback, queue_size=1)
 
@@ -65,12 +79,22 @@ class SpiHandler(object):
         # self.place_recognizer_ = PlaceRecognizer()
         # self.feature_extractor_ = FeatureExtractor()
         # self.pose_estimator_ = PoseEstimator()
+        # self.preprocessor_ = SpiPreprocessor([600, 400])
         # self.image_id_ = 0
         # self.query_spi_sub_ = rospy.Subscriber("query_spi_image", CompressedImage, self.query_spi_image_callback, queue_size=1)
 
 
         ### For Release Use ###
-        self.global_localizer_ = GlobalLocalizer()
+        self.global_localizer_ = GlobalLocalizer(self.config_["global_localizer"])
+        self.pipeline_ = None
+        if self.config_["use_pipeline"]:
+            self.pipeline_ = SpiPipeline(self.global_localizer_, self.decode_slam_spi, self.handle_result,
+                                         self.config_["pipeline"])
+            self.pipeline_.start()
+            rospy.on_shutdown(self.pipeline_.stop)
+        if self.config_["statistics_period"] > 0:
+            self.statistics_timer_ = rospy.Timer(rospy.Duration(self.config_["statistics_period"]),
+                                                 self.print_statistics)
         self.query_spi_sub_ = rospy.Subscriber("/spi_image/compressed", CompressedImage, self.slam_spi_image_callback,
                                                queue_size=1)
 
@@ -90,7 +114,7 @@ class SpiHandler(object):
 
     def query_spi_image_callback(self, msg):
         image = CompressedImage2Array(msg)
-        image_spinetvlad = cv2.resize(image, (600, 600), interpolation=cv2.INTER_LINEAR)
+        image_spinetvlad, image_features = self.preprocessor_(image)
         # print("decoded image msg", image.shape)
         results = self.place_recognizer_.query_spi(image_spinetvlad)
 
@@ -103,7 +127,6 @@ class SpiHandler(object):
             # cv2.waitKey(delay=1)
             # print("query result:", candidate_image_filenames)
 
-        image_features = cv2.resize(image, (400, 400), interpolation=cv2.INTER_LINEAR)
         features = self.feature_extractor_.extract_features(image_features)
         pose = np.identity(4)
         image_dir = "/media/li/lavie/dataset/birdview_dataset/05/"
@@ -123,9 +146,20 @@ class SpiHandler(object):
         print("query done")
 
     def slam_spi_image_callback(self, msg):
+        if self.pipeline_ is not None:
+            self.pipeline_.put(msg)
+            return
+        image, fake_pose, seq = self.decode_slam_spi(msg)
+        result = self.global_localizer_.handle_slam_spi(image, fake_pose, seq)
+        self.handle_result(result)
+
+    @staticmethod
+    def decode_slam_spi(msg):
         image = CompressedImage2Array(msg)
         fake_pose = np.identity(4)
-        result = self.global_localizer_.handle_slam_spi(image, fake_pose, msg.header.seq)
+        return image, fake_pose, msg.header.seq
+
+    def handle_result(self, result, latency=None):
         # print("result:", result)
         pose, score = result
         if pose is not None:
@@ -135,6 +169,19 @@ class SpiHandler(object):
             print("query failed")
         # print("query done")
     
+    def print_statistics(self, event=None):
+        self.global_localizer_.export_profile()
+        verification_cache = self.global_localizer_.verification_cache_
+        if verification_cache.config_['enabled']:
+            rospy.loginfo("[verification cache] {}".format(verification_cache.statistics()))
+        if self.pipeline_ is None:
+            return
+        for name, statistics in self.pipeline_.statistics().items():
+            rospy.loginfo("[{}] processed: {}, dropped: {}, mean latency: {:.1f} ms, max latency: {:.1f} ms, "
+                          "mean queue wait: {:.1f} ms".format(
+                name, statistics['processed'], statistics['dropped'], statistics['mean_latency'] * 1e3,
+                statistics['max_latency'] * 1e3, statistics['mean_queue_wait'] * 1e3))
+
     def spi_image_player(self):
         img_id = 0
         rate = rospy.Rate(2.5)  # 3 Hz
@@ -0,0 +1,193 @@
+import collections
+import threading
+import time
+
+
+class StageStatistics(object):
+    """Latency counters of a pipeline stage, in seconds"""
+    def __init__(self):
+        super().__init__()
+        self.lock_ = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.total_wait = 0.
+
+    def record(self, latency, wait):
+        with self.lock_:
+            self.processed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_wait += wait
+
+    def record_drop(self):
+        with self.lock_:
+            self.dropped += 1
+
+    def as_dict(self):
+        with self.lock_:
+            count = max(self.processed, 1)
+            return {
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'mean_latency': self.total_latency / count,
+                'max_latency': self.max_latency,
+                'mean_queue_wait': self.total_wait / count,
+            }
+
+
+class PipelineStage(object):
+    """
+    One stage of the SPI pipeline: a worker thread applying fn to the items of a bounded input queue.
+    Drop policies when the queue is full:
+        'newest': newest wins, the pending items are replaced by the incoming one
+        'keep_n': the N = capacity most recent items are kept, the oldest one is dropped
+        'block': the producer waits for a free slot, nothing is dropped
+    """
+    DROP_POLICIES = ['newest', 'keep_n', 'block']
+
+    def __init__(self, name, fn, capacity=1, drop_policy='newest'):
+        super().__init__()
+        assert drop_policy in self.DROP_POLICIES, "Unknown drop policy {}".format(drop_policy)
+        assert capacity > 0
+        self.name_ = name
+        self.fn_ = fn
+        self.capacity_ = 1 if drop_policy == 'newest' else capacity
+        self.drop_policy_ = drop_policy
+        self.queue_ = collections.deque()
+        self.condition_ = threading.Condition()
+        self.next_stage_ = None
+        self.result_callback_ = None
+        # called with the items dropped from the queue
+        self.drop_callback_ = None
+        self.statistics_ = StageStatistics()
+        self.running_ = False
+        self.thread_ = None
+
+    def connect(self, next_stage):
+        self.next_stage_ = next_stage
+        return next_stage
+
+    def put(self, item, timestamp):
+        """
+        :param item: input of fn
+        :param timestamp: arrival time of the frame, used for end-to-end latency
+        """
+        with self.condition_:
+            if self.drop_policy_ == 'block':
+                while self.running_ and len(self.queue_) >= self.capacity_:
+                    self.condition_.wait()
+            elif len(self.queue_) >= self.capacity_:
+                dropped_item, _, _ = self.queue_.popleft()
+                self.statistics_.record_drop()
+                if self.drop_callback_ is not None:
+                    self.drop_callback_(dropped_item)
+            self.queue_.append((item, timestamp, time.perf_counter()))
+            self.condition_.notify_all()
+
+    def start(self):
+        self.running_ = True
+        self.thread_ = threading.Thread(target=self._run, name="spi_pipeline_" + self.name_, daemon=True)
+        self.thread_.start()
+
+    def stop(self):
+        with self.condition_:
+            self.running_ = False
+            self.condition_.notify_all()
+        if self.thread_ is not None:
+            self.thread_.join()
+
+    def _run(self):
+        while True:
+            with self.condition_:
+                while self.running_ and len(self.queue_) == 0:
+                    self.condition_.wait()
+                if not self.running_:
+                    return
+                item, timestamp, enqueue_time = self.queue_.popleft()
+                self.condition_.notify_all()
+
+            t0 = time.perf_counter()
+            output = self.fn_(item)
+            t1 = time.perf_counter()
+            self.statistics_.record(t1 - t0, t0 - enqueue_time)
+
+            # None stops the propagation of the frame
+            if output is None:
+                continue
+            if self.next_stage_ is not None:
+                self.next_stage_.put(output, timestamp)
+            elif self.result_callback_ is not None:
+                self.result_callback_(output, t1 - timestamp)
+
+
+class SpiPipeline(object):
+    """
+    Staged asynchronous processing of SLAM SPIs with GlobalLocalizer:
+        decode + resize -> NetVLAD + SuperPoint -> retrieval -> SuperGlue + RANSAC
+    Each stage runs on its own thread, so throughput is limited by the slowest stage.
+    """
+    def __init__(self, global_localizer, decode_fn, result_callback, config={}):
+        """
+        :param global_localizer: GlobalLocalizer
+        :param decode_fn: message -> (image, pose, seq) or (image, pose, seq, prior_pose)
+        :param result_callback: called with ((best_T_w_source, best_score), end_to_end_latency)
+        """
+        super().__init__()
+        default_config = {
+            "queue_capacity": 1,
+            "drop_policy": "newest",
+        }
+        config = {**default_config, **config}
+
+        preprocessor = global_localizer.preprocessor_
+
+        def preprocess(msg):
+            # the frame stays reserved until extracted, or dropped from the queue of the extract stage
+            buffer_index = preprocessor.acquire()
+            if buffer_index is None:
+                self.stages_[0].statistics_.record_drop()
+                return None
+            image, pose, seq, *prior_pose = decode_fn(msg)
+            spinetvlad_image, features_image = global_localizer.preprocess_spi(image, buffer_index)
+            return buffer_index, spinetvlad_image, features_image, pose, seq, (prior_pose or [None])[0]
+
+        def extract(item):
+            buffer_index, *spi, prior_pose = item
+            try:
+                return global_localizer.extract_spi(*spi), prior_pose
+            finally:
+                preprocessor.release(buffer_index)
+
+        def retrieve(item):
+            query_image_info, prior_pose = item
+            return query_image_info, global_localizer.retrieve_candidates(query_image_info, prior_pose)
+
+        def verify(item):
+            return global_localizer.verify_candidates(*item)
+
+        capacity, drop_policy = config["queue_capacity"], config["drop_policy"]
+        # reserved frames of the preprocessor: one in preprocess, the queue, one in extract,
+        # a frame is only missing when the preprocessor is also used outside of the pipeline
+        preprocessor.reserve(capacity + 2)
+        self.stages_ = [PipelineStage(name, fn, capacity, drop_policy) for name, fn in [
+            ("preprocess", preprocess), ("extract", extract), ("retrieve", retrieve), ("verify", verify)]]
+        self.stages_[1].drop_callback_ = lambda item: preprocessor.release(item[0])
+        for stage, next_stage in zip(self.stages_[:-1], self.stages_[1:]):
+            stage.connect(next_stage)
+        self.stages_[-1].result_callback_ = result_callback
+
+    def start(self):
+        for stage in self.stages_:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages_:
+            stage.stop()
+
+    def put(self, msg):
+        self.stages_[0].put(msg, time.perf_counter())
+
+    def statistics(self):
+        return {stage.name_: stage.statistics_.as_dict() for stage in self.stages_}
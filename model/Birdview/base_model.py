@@ -61,9 +61,24 @@ class BaseModel(nn.Module):
         return h
 
 
+def to_per_image_normalization(model):
+    """
+    NetVLAD models are used in training mode, where the BatchNorm2d(affine=False) layers of BaseModel normalize
+    each single image with its own statistics. Replace them in place by the equivalent InstanceNorm2d, which
+    keeps this behaviour in eval mode and for batches of images.
+    :return: model
+    """
+    for name, module in model.named_children():
+        if isinstance(module, nn.BatchNorm2d) and not module.affine:
+            setattr(model, name, nn.InstanceNorm2d(module.num_features, eps=module.eps, affine=False))
+        else:
+            to_per_image_normalization(module)
+    return model
+
+
 if __name__ == "__main__":
     W, H = 1000, 1000
     base_model = BaseModel(W, H)
     input = torch.randn(3, 1, W, H)
     output = base_model(input)
-    print(output.shape)
\ No newline at end of file
+    print(output.shape)
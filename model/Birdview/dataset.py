@@ -8,9 +8,10 @@ from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
 import torchvision.transforms as transforms
 from sklearn.neighbors import NearestNeighbors
-import faiss
+import time
 from tqdm import tqdm
 from scipy.spatial.transform import Rotation
+from model.Birdview.vlad_index import VladIndex
 
 
 def input_transforms():
@@ -201,11 +202,27 @@ class PureDataset(Dataset):
         return query, self.images_info[index]
 
 
+class DatabaseImageDataset(Dataset):
+    """Database images with their index, for batched encoding"""
+    def __init__(self, images_info, images_dir, transforms=input_transforms_test()):
+        super(DatabaseImageDataset, self).__init__()
+        self.input_transforms = transforms
+        self.images_info = images_info
+        self.images_dir = images_dir
+
+    def __len__(self):
+        return len(self.images_info)
+
+    def __getitem__(self, index):
+        image = Image.open(os.path.join(self.images_dir, self.images_info[index]['image_file']))
+        return self.input_transforms(image), index
+
+
 # for image retrieval
 class ImageDatabase(object):
     def __init__(self, images_info: list, images_dir: str, model, generate_database=False,
                  transforms=input_transforms_test(),
-                 mode='retrieval'):
+                 mode='retrieval', batch_size=8, num_workers=4, index_config={}):
         self.model = model
         self.input_transforms = transforms
         self.database = None
@@ -213,35 +230,46 @@ class ImageDatabase(object):
         self.mode = mode
         self.images_info = images_info.copy()
         self.images_dir = images_dir
+        self.batch_size = batch_size
+        self.index_config = index_config
+        self.num_workers = num_workers
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model.to(self.device)
         if generate_database:
             self._generate_database()
 
+    @torch.no_grad()
+    def encode_images(self, images_info, images_dir=None):
+        """
+        :param images_dir: directory of the images, None for the directory of the database
+        :return: N * D encodings of images_info
+        """
+        images_dir = self.images_dir if images_dir is None else images_dir
+        dataset = DatabaseImageDataset(images_info, images_dir, transforms=self.input_transforms)
+        # batch norm layers of a model in training mode normalize with the statistics of the whole batch
+        batch_size = 1 if self.model.training else self.batch_size
+        data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=self.num_workers)
+        encodings = [None] * len(images_info)
+        t0 = time.time()
+        for images, indices in tqdm(data_loader):
+            netvlad_encodings = self.model(images.to(self.device)).cpu().numpy()
+            for index, netvlad_encoding in zip(indices.tolist(), netvlad_encodings):
+                encodings[index] = netvlad_encoding
+        print("Encoded {} images at {:.1f} images/s".format(len(encodings), len(encodings) / (time.time() - t0)))
+        return np.array(encodings)
+
     @torch.no_grad()
     def _generate_database(self):
         assert len(self.images_info) > 0
-        encodings = []
-        # self.database = []
         print('Generating database from \'{}\'...'.format(self.images_dir))
-        with torch.no_grad():
-            for image_info in tqdm(self.images_info):
-                image = Image.open(os.path.join(self.images_dir, image_info['image_file']))
-                input = self.input_transforms(image).unsqueeze(0).to(self.device)
-                netvlad_encoding = self.model(input).cpu().numpy().squeeze()
-                image_info['encoding'] = netvlad_encoding
-                # self.database.append({
-                #     'image_file': image_filename,
-                #     'encoding': netvlad_encoding,
-                #     # 'position': xxx,
-                #     # 'orientation': xxx,
-                # })
-                encodings.append(netvlad_encoding)
+        encodings = self.encode_images(self.images_info)
+        for image_info, netvlad_encoding in zip(self.images_info, encodings):
+            image_info['encoding'] = netvlad_encoding
 
-        dim_encoding = len(encodings[0])
-        encodings = np.array(encodings)
-        self.index = faiss.IndexFlatL2(dim_encoding)
+        dim_encoding = encodings.shape[1]
+        self.index = VladIndex(dim_encoding, self.index_config)
         self.index.add(encodings)
+        self.index.train()
         # self.model.cpu()
         self.images_info = np.array(self.images_info)
         print("Generation of database finished")
@@ -260,8 +288,9 @@ class ImageDatabase(object):
         encodings = [datum['encoding'] for datum in self.images_info]
         dim_encoding = len(encodings[0])
         encodings = np.array(encodings)
-        self.index = faiss.IndexFlatL2(dim_encoding)
+        self.index = VladIndex(dim_encoding, self.index_config)
         self.index.add(encodings)
+        self.index.train()
         print('Imported database from {}'.format(filename))
 
     @torch.no_grad()
@@ -127,7 +127,7 @@ class NetVLAD(nn.Module):
         N, C = x.shape[:2]
 
         if self.normalize_input:
-            x = F.normalize(x, p=2, dim=1)  # across descriptor dim
+            x = F.normalize(x, p=2., dim=1)  # across descriptor dim
 
         # soft-assignment
         soft_assign = self.conv(x).view(N, self.num_clusters, -1)
@@ -141,10 +141,10 @@ class NetVLAD(nn.Module):
         residual *= soft_assign.unsqueeze(2)
         vlad = residual.sum(dim=-1)
 
-        vlad = F.normalize(vlad, p=2, dim=2)  # intra-normalization
+        vlad = F.normalize(vlad, p=2., dim=2)  # intra-normalization
         vlad = vlad.view(x.size(0), -1)  # flatten
         vlad = self.projection(vlad)
-        vlad = F.normalize(vlad, p=2, dim=1)  # L2 normalize
+        vlad = F.normalize(vlad, p=2., dim=1)  # L2 normalize
 
         return vlad
 
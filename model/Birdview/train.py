@@ -16,6 +16,7 @@ from model.Birdview.netvlad import NetVLAD
 from model.Birdview.netvlad import EmbedNet
 from model.Birdview.loss import HardTripletLoss
 from model.Birdview.base_model import BaseModel
+from evaluation.retrieval_recall import retrieval_recall
 from torchvision.models import resnet18, vgg16
 from PIL import Image
 import matplotlib.pyplot as plt
@@ -179,23 +180,14 @@ def validate(model, database_images_info, query_images_info, images_dir, writer=
                                    images_dir=images_dir, model=model,
                                    generate_database=True,
                                    transforms=input_transforms())
-    top_k_recall = np.zeros(args.top_k)
-    for query_image_info in tqdm(query_images_info):
-        is_true_result = np.zeros(args.top_k)
-        query_results = image_database.query_image(
-            image_filename=os.path.join(images_dir, query_image_info['image_file']), num_results=args.top_k)
-        # print('query_result: \n{}'.format(query_results))
-        for i, query_result in enumerate(query_results):
-            diff = query_image_info['position'] - query_result['position']
-            if np.sqrt(diff @ diff) < args.positive_search_radius:
-                # true_count += 1
-                is_true_result[i] = 1
-                # break
-        is_true_result = np.cumsum(is_true_result) > 0
-        # print("is_true_result: {}".format(is_true_result))
-        top_k_recall = top_k_recall + is_true_result
-    # print("Precision: {}".format(true_count / len(query_images_info)))
-    print("top k recalls: {}".format(top_k_recall / len(query_images_info)))
+    query_encodings = image_database.encode_images(query_images_info)
+    database_encodings = np.array([image_info['encoding'] for image_info in image_database.images_info])
+    results = retrieval_recall(database_encodings, query_encodings,
+                               [image_info['position'] for image_info in image_database.images_info],
+                               [image_info['position'] for image_info in query_images_info],
+                               args.positive_search_radius, top_k=args.top_k)
+    print("top k recalls: {}".format(results['recall@k']))
+    print("recall@1%: {}".format(results['recall@1%']))
 
 
 def model_test():
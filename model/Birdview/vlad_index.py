@@ -0,0 +1,206 @@
+import json
+import os
+
+import faiss
+import numpy as np
+
+
+class VladIndex(object):
+    """
+    Nearest neighbour index of NetVLAD descriptors with a configurable faiss backend:
+        'flat': exact search (faiss.IndexFlatL2)
+        'ivf_flat': inverted lists of raw vectors
+        'ivf_pq': inverted lists of product-quantized vectors
+        'hnsw': hierarchical navigable small world graph
+    IVF indices need training: vectors are kept in a flat index until 'min_train_size' vectors
+    were added (or train() is called), then the IVF index is trained on them.
+    Vectors get consecutive ids in the order they are added, ids are kept when vectors are removed.
+    """
+    default_config = {
+        'type': 'flat',
+        'nlist': 1024,  # IVF: number of inverted lists
+        'pq_m': 32,  # IVF-PQ: number of sub-quantizers, must divide the dimension
+        'pq_nbits': 8,  # IVF-PQ: bits per sub-quantizer code
+        'hnsw_m': 32,  # HNSW: number of neighbours per node
+        'ef_construction': 40,  # HNSW: depth of exploration when adding
+        'nprobe': 16,  # IVF: number of inverted lists visited per query
+        'ef_search': 64,  # HNSW: depth of exploration when searching
+        'min_train_size': 10000,  # IVF: number of vectors required before training
+    }
+    TYPES = ['flat', 'ivf_flat', 'ivf_pq', 'hnsw']
+    # parameters which can differ from the saved ones when loading an index
+    SEARCH_KEYS = ['nprobe', 'ef_search']
+
+    def __init__(self, dim, config={}):
+        super(VladIndex, self).__init__()
+        self.config = {**self.default_config, **config}
+        assert self.config['type'] in self.TYPES, "Unknown index type {}".format(self.config['type'])
+        self.d = dim
+        self.next_id = 0
+        self.index = None
+        if self.config['type'] in ['flat', 'hnsw']:
+            self.index = self._make_index(0)
+            self.set_search_parameters()
+        # vectors waiting for the training of an IVF index
+        self.staging_index = faiss.IndexIDMap(faiss.IndexFlatL2(dim)) if self.index is None else None
+
+    def _make_index(self, num_train):
+        index_type = self.config['type']
+        if index_type == 'flat':
+            return faiss.IndexIDMap(faiss.IndexFlatL2(self.d))
+        if index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.d, self.config['hnsw_m'])
+            index.hnsw.efConstruction = self.config['ef_construction']
+            return faiss.IndexIDMap(index)
+        # faiss needs about 39 training vectors per list
+        nlist = int(max(1, min(self.config['nlist'], num_train // 39)))
+        quantizer = faiss.IndexFlatL2(self.d)
+        if index_type == 'ivf_flat':
+            return faiss.IndexIVFFlat(quantizer, self.d, nlist)
+        return faiss.IndexIVFPQ(quantizer, self.d, nlist, self.config['pq_m'], self.config['pq_nbits'])
+
+    @property
+    def is_trained(self):
+        return self.index is not None
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal if self.is_trained else self.staging_index.ntotal
+
+    @property
+    def nbytes(self):
+        """ Size of the serialized index, close to its memory footprint """
+        return int(faiss.serialize_index(self.index if self.is_trained else self.staging_index).nbytes)
+
+    def set_search_parameters(self, nprobe=None, ef_search=None):
+        if nprobe is not None:
+            self.config['nprobe'] = nprobe
+        if ef_search is not None:
+            self.config['ef_search'] = ef_search
+        if not self.is_trained:
+            return
+        if self.config['type'] in ['ivf_flat', 'ivf_pq']:
+            faiss.extract_index_ivf(self.index).nprobe = self.config['nprobe']
+        elif self.config['type'] == 'hnsw':
+            faiss.downcast_index(self.index.index).hnsw.efSearch = self.config['ef_search']
+
+    def _search_parameters(self, selector):
+        if self.is_trained and self.config['type'] in ['ivf_flat', 'ivf_pq']:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.config['nprobe'])
+        if self.is_trained and self.config['type'] == 'hnsw':
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.config['ef_search'])
+        return faiss.SearchParameters(sel=selector)
+
+    def train(self, vectors=None):
+        """
+        Train the IVF index on the given vectors and the staged ones, then add the staged vectors.
+        With fewer vectors than the index needs (2 ** pq_nbits for 'ivf_pq'), the vectors stay in the flat
+        staging index, which is exact and cheap at that size
+        :return: True if the index is trained
+        """
+        if self.is_trained:
+            return True
+        staged = self.staging_index.index.reconstruct_n(0, self.staging_index.ntotal)
+        staged_ids = faiss.vector_to_array(self.staging_index.id_map)
+        train_vectors = staged if vectors is None else np.vstack([staged, np.asarray(vectors, dtype=np.float32)])
+        min_train_size = 2 ** self.config['pq_nbits'] if self.config['type'] == 'ivf_pq' else 1
+        if len(train_vectors) < min_train_size:
+            return False
+        self.index = self._make_index(len(train_vectors))
+        self.index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+        self.index.add_with_ids(staged, staged_ids)
+        self.staging_index = None
+        self.set_search_parameters()
+        return True
+
+    def add(self, vectors):
+        """
+        :param vectors: N * D
+        :return: ids of the added vectors
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ids = np.arange(self.next_id, self.next_id + len(vectors), dtype=np.int64)
+        self.next_id += len(vectors)
+        if self.is_trained:
+            self.index.add_with_ids(vectors, ids)
+            return ids
+        self.staging_index.add_with_ids(vectors, ids)
+        if self.staging_index.ntotal >= self.config['min_train_size']:
+            self.train()
+        return ids
+
+    def remove(self, ids):
+        """
+        :return: number of removed vectors
+        """
+        assert self.config['type'] != 'hnsw', "Vectors cannot be removed from a HNSW index"
+        index = self.index if self.is_trained else self.staging_index
+        return index.remove_ids(faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64)))
+
+    def search(self, vectors, k, selector=None):
+        """
+        :param selector: faiss.IDSelector, only the selected ids are searched
+        :return: distances: M * k, ids: M * k, -1 for missing results
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        index = self.index if self.is_trained else self.staging_index
+        if selector is None:
+            return index.search(vectors, k)
+        return index.search(vectors, k, params=self._search_parameters(selector))
+
+    def copy(self):
+        """
+        :return: independent copy of the index, e.g. to save it while the index keeps changing
+        """
+        vlad_index = VladIndex(self.d, self.config)
+        vlad_index.next_id = self.next_id
+        vlad_index.index = None if self.index is None else faiss.deserialize_index(faiss.serialize_index(self.index))
+        vlad_index.staging_index = None if self.staging_index is None else \
+            faiss.deserialize_index(faiss.serialize_index(self.staging_index))
+        vlad_index.set_search_parameters()
+        return vlad_index
+
+    def save(self, filename):
+        # an untrained IVF index is saved as its staging index and trained later
+        faiss.write_index(self.index if self.is_trained else self.staging_index, filename)
+        with open(filename + ".json", "w") as f:
+            json.dump({**self.config, 'next_id': self.next_id, 'trained': self.is_trained}, f)
+
+    @staticmethod
+    def same_structure(config, other_config):
+        """
+        :return: True if indices built with both configs are the same, whatever their search parameters
+        """
+        config = {**VladIndex.default_config, **config}
+        other_config = {**VladIndex.default_config, **other_config}
+        return all(config[key] == other_config[key] for key in VladIndex.default_config
+                   if key not in VladIndex.SEARCH_KEYS)
+
+    @staticmethod
+    def load(filename, config=None):
+        """
+        :param config: expected index config, None if the saved config is used as is
+        :return: VladIndex, None if the saved index has no or another config
+        """
+        if not os.path.exists(filename) or not os.path.exists(filename + ".json"):
+            return None
+        with open(filename + ".json", "r") as f:
+            saved_config = json.load(f)
+        next_id = saved_config.pop('next_id', None)
+        trained = saved_config.pop('trained', True)
+        if config is not None:
+            if not VladIndex.same_structure(saved_config, config):
+                return None
+            expected_config = {**VladIndex.default_config, **config}
+            saved_config.update({key: expected_config[key] for key in VladIndex.SEARCH_KEYS})
+        index = faiss.read_index(filename)
+        vlad_index = VladIndex(index.d, saved_config)
+        if trained:
+            vlad_index.index = index
+            vlad_index.staging_index = None
+        else:
+            vlad_index.index = None
+            vlad_index.staging_index = index
+        vlad_index.next_id = index.ntotal if next_id is None else next_id
+        vlad_index.set_search_parameters()
+        return vlad_index
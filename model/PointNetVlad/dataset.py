@@ -186,27 +186,33 @@ class PNVDatabase(object):
         if generate_database:
             self._generate_database()
 
+    @torch.no_grad()
+    def encode_ptclouds(self, ptclouds_info):
+        """
+        :return: N * D encodings of ptclouds_info
+        """
+        encodings = []
+        for ptcloud_info in tqdm(ptclouds_info):
+            input_pcd = o3d.io.read_point_cloud(os.path.join(self.ptclouds_dir, ptcloud_info['pcd_file']))
+            input = torch.Tensor(input_pcd.points)
+            pt_entries = np.random.choice(len(input), self.num_points, replace=False)
+            input = input[pt_entries]
+            # query_pcd.points = o3d.utility.Vector3dVector(query.numpy())
+            # o3d.visualization.draw_geometries([query_pcd])
+            input = input[None, None, ...].to(self.device)
+            encodings.append(self.model(input).cpu().numpy().squeeze())
+        return np.array(encodings)
+
     @torch.no_grad()
     def _generate_database(self):
         assert len(self.ptclouds_info) > 0
-        encodings = []
         # self.database = []
         print('Generating database from \'{}\'...'.format(self.ptclouds_dir))
-        with torch.no_grad():
-            for ptcloud_info in tqdm(self.ptclouds_info):
-                input_pcd = o3d.io.read_point_cloud(os.path.join(self.ptclouds_dir, ptcloud_info['pcd_file']))
-                input = torch.Tensor(input_pcd.points)
-                pt_entries = np.random.choice(len(input), self.num_points, replace=False)
-                input = input[pt_entries]
-                # query_pcd.points = o3d.utility.Vector3dVector(query.numpy())
-                # o3d.visualization.draw_geometries([query_pcd])
-                input = input[None, None, ...].to(self.device)
-                netvlad_encoding = self.model(input).cpu().numpy().squeeze()
-                ptcloud_info['encoding'] = netvlad_encoding
-                encodings.append(netvlad_encoding)
+        encodings = self.encode_ptclouds(self.ptclouds_info)
+        for ptcloud_info, netvlad_encoding in zip(self.ptclouds_info, encodings):
+            ptcloud_info['encoding'] = netvlad_encoding
 
-        dim_encoding = len(encodings[0])
-        encodings = np.array(encodings)
+        dim_encoding = encodings.shape[1]
         np.save('pnv.npy', encodings)
         self.index = faiss.IndexFlatL2(dim_encoding)
         self.index.add(encodings)
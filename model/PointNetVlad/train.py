@@ -4,6 +4,7 @@ from model.PointNetVlad.dataset import make_ptclouds_info
 from model.PointNetVlad.dataset import PNVDataset, PNVDatabase
 from model.PointNetVlad.PointNetVlad import PointNetVlad
 from model.Birdview.loss import lazy_quadruplet_loss
+from evaluation.retrieval_recall import retrieval_recall
 
 import os
 from torch.utils.data import DataLoader
@@ -171,21 +172,14 @@ def validate(model, database_ptclouds_info, query_ptclouds_info, ptclouds_dir):
     model.eval()
     ptcloud_database = PNVDatabase(ptclouds_info=database_ptclouds_info, ptclouds_dir=ptclouds_dir, model=model,
                                  num_points=args.num_points, generate_database=True)
-    top_k_recall = np.zeros(args.top_k)
-    descriptors = []
-    for query_ptcloud_info in tqdm(query_ptclouds_info):
-        is_true_result = np.zeros(args.top_k)
-        query_results = ptcloud_database.query_ptcloud(
-            ptcloud_filename=os.path.join(ptclouds_dir, query_ptcloud_info['pcd_file']), num_results=args.top_k)
-        for i, query_result in enumerate(query_results):
-            diff = query_ptcloud_info['position'] - query_result['position']
-            if np.sqrt(diff @ diff) < args.positive_search_radius:
-                # true_count += 1
-                is_true_result[i] = 1
-        is_true_result = np.cumsum(is_true_result) > 0
-        top_k_recall = top_k_recall + is_true_result
-    # print("Precision: {}".format(true_count / len(query_ptclouds_info)))
-    print("top k recalls: {}".format(top_k_recall / len(query_ptclouds_info)))
+    query_encodings = ptcloud_database.encode_ptclouds(query_ptclouds_info)
+    database_encodings = np.array([ptcloud_info['encoding'] for ptcloud_info in ptcloud_database.ptclouds_info])
+    results = retrieval_recall(database_encodings, query_encodings,
+                               [ptcloud_info['position'] for ptcloud_info in ptcloud_database.ptclouds_info],
+                               [ptcloud_info['position'] for ptcloud_info in query_ptclouds_info],
+                               args.positive_search_radius, top_k=args.top_k)
+    print("top k recalls: {}".format(results['recall@k']))
+    print("recall@1%: {}".format(results['recall@1%']))
 
 
 if __name__ == "__main__":
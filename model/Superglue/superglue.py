@@ -83,9 +83,11 @@ class KeypointEncoder(nn.Module):
         return self.encoder(torch.cat(inputs, dim=1))
 
 
-def attention(query, key, value):
+def attention(query, key, value, mask=None):
     dim = query.shape[1]
     scores = torch.einsum('bdhn,bdhm->bhnm', query, key) / dim**.5
+    if mask is not None:  # ignore padded keys
+        scores = scores.masked_fill(~mask[:, None, None, :], float('-inf'))
     prob = torch.nn.functional.softmax(scores, dim=-1)
     return torch.einsum('bhnm,bdhm->bdhn', prob, value), prob
 
@@ -100,11 +102,11 @@ class MultiHeadedAttention(nn.Module):
         self.merge = nn.Conv1d(d_model, d_model, kernel_size=1)
         self.proj = nn.ModuleList([deepcopy(self.merge) for _ in range(3)])
 
-    def forward(self, query, key, value):
+    def forward(self, query, key, value, mask=None):
         batch_dim = query.size(0)
         query, key, value = [l(x).view(batch_dim, self.dim, self.num_heads, -1)
                              for l, x in zip(self.proj, (query, key, value))]
-        x, prob = attention(query, key, value)
+        x, prob = attention(query, key, value, mask)
         self.prob.append(prob)
         return self.merge(x.contiguous().view(batch_dim, self.dim*self.num_heads, -1))
 
@@ -116,8 +118,8 @@ class AttentionalPropagation(nn.Module):
         self.mlp = MLP([feature_dim*2, feature_dim*2, feature_dim])
         nn.init.constant_(self.mlp[-1].bias, 0.0)
 
-    def forward(self, x, source):
-        message = self.attn(x, source, source)
+    def forward(self, x, source, mask=None):
+        message = self.attn(x, source, source, mask)
         return self.mlp(torch.cat([x, message], dim=1))
 
 
@@ -129,29 +131,49 @@ class AttentionalGNN(nn.Module):
             for _ in range(len(layer_names))])
         self.names = layer_names
 
-    def forward(self, desc0, desc1):
+    def forward(self, desc0, desc1, mask0=None, mask1=None):
         for layer, name in zip(self.layers, self.names):
             layer.attn.prob = []
             if name == 'cross':
                 src0, src1 = desc1, desc0
+                src_mask0, src_mask1 = mask1, mask0
             else:  # if name == 'self':
                 src0, src1 = desc0, desc1
-            delta0, delta1 = layer(desc0, src0), layer(desc1, src1)
+                src_mask0, src_mask1 = mask0, mask1
+            delta0, delta1 = layer(desc0, src0, src_mask0), layer(desc1, src1, src_mask1)
             desc0, desc1 = (desc0 + delta0), (desc1 + delta1)
         return desc0, desc1
 
 
 def log_sinkhorn_iterations(Z, log_mu, log_nu, iters: int):
     """ Perform Sinkhorn Normalization in Log-space for stability"""
+    return log_sinkhorn_iterations_with_tolerance(Z, log_mu, log_nu, iters)[0]
+
+
+def log_sinkhorn_iterations_with_tolerance(Z, log_mu, log_nu, iters: int, tol: float = 0.):
+    """ Sinkhorn Normalization in Log-space, with early stopping
+    With tol > 0, stop once the row potentials change by less than tol (the row marginals
+    are then matched within a factor exp(tol)), at most iters iterations are run.
+    Returns the normalized couplings and the number of iterations run.
+    """
     u, v = torch.zeros_like(log_mu), torch.zeros_like(log_nu)
-    for _ in range(iters):
+    # rows without mass (padded keypoints) have -inf potentials
+    finite = torch.isfinite(log_mu)
+    for i in range(iters):
+        u_prev = u
         u = log_mu - torch.logsumexp(Z + v.unsqueeze(1), dim=2)
         v = log_nu - torch.logsumexp(Z + u.unsqueeze(2), dim=1)
-    return Z + u.unsqueeze(2) + v.unsqueeze(1)
+        if tol > 0 and i > 0 and (u - u_prev)[finite].abs().max() < tol:
+            return Z + u.unsqueeze(2) + v.unsqueeze(1), i + 1
+    return Z + u.unsqueeze(2) + v.unsqueeze(1), iters
 
 
 def log_optimal_transport(scores, alpha, iters: int):
     """ Perform Differentiable Optimal Transport in Log-space for stability"""
+    return _log_optimal_transport(scores, alpha, iters)[0]
+
+
+def _log_optimal_transport(scores, alpha, iters: int, tol: float = 0.):
     b, m, n = scores.shape
     one = scores.new_tensor(1)
     ms, ns = (m*one).to(scores), (n*one).to(scores)
@@ -168,9 +190,41 @@ def log_optimal_transport(scores, alpha, iters: int):
     log_nu = torch.cat([norm.expand(n), ms.log()[None] + norm])
     log_mu, log_nu = log_mu[None].expand(b, -1), log_nu[None].expand(b, -1)
 
-    Z = log_sinkhorn_iterations(couplings, log_mu, log_nu, iters)
+    Z, iters = log_sinkhorn_iterations_with_tolerance(couplings, log_mu, log_nu, iters, tol)
     Z = Z - norm  # multiply probabilities by M+N
-    return Z
+    return Z, iters
+
+
+def masked_log_optimal_transport(scores, alpha, iters: int, mask0=None, mask1=None, tol: float = 0.):
+    """ Optimal Transport of a batch of padded keypoint sets, padded rows/columns get no mass
+    With tol > 0, the Sinkhorn iterations stop early, see log_sinkhorn_iterations_with_tolerance.
+    Returns the log assignment matrix and the number of Sinkhorn iterations run.
+    """
+    if mask0 is None and mask1 is None:
+        return _log_optimal_transport(scores, alpha, iters, tol)
+    b, m, n = scores.shape
+    if mask0 is None:
+        mask0 = scores.new_ones((b, m), dtype=torch.bool)
+    if mask1 is None:
+        mask1 = scores.new_ones((b, n), dtype=torch.bool)
+    ms, ns = mask0.sum(1).to(scores), mask1.sum(1).to(scores)
+
+    bins0 = alpha.expand(b, m, 1)
+    bins1 = alpha.expand(b, 1, n)
+    alpha = alpha.expand(b, 1, 1)
+
+    couplings = torch.cat([torch.cat([scores, bins0], -1),
+                           torch.cat([bins1, alpha], -1)], 1)
+
+    norm = - (ms + ns).log()
+    log_mu = torch.cat([norm[:, None].expand(b, m), (ns.log() + norm)[:, None]], 1)
+    log_nu = torch.cat([norm[:, None].expand(b, n), (ms.log() + norm)[:, None]], 1)
+    log_mu[:, :m] = log_mu[:, :m].masked_fill(~mask0, float('-inf'))
+    log_nu[:, :n] = log_nu[:, :n].masked_fill(~mask1, float('-inf'))
+
+    Z, iters = log_sinkhorn_iterations_with_tolerance(couplings, log_mu, log_nu, iters, tol)
+    Z = Z - norm[:, None, None]  # multiply probabilities by M+N
+    return Z, iters
 
 
 def arange_like(x, dim: int):
@@ -201,7 +255,9 @@ class SuperGlue(nn.Module):
         'keypoint_encoder': [32, 64, 128, 256],
         'GNN_layers': ['self', 'cross'] * 9,
         'sinkhorn_iterations': 100,
+        'sinkhorn_tolerance': 0.,  # > 0 to stop Sinkhorn early in eval mode, training always runs all iterations
         'match_threshold': 0.2,
+        'pretrained': True,  # False when the weights are loaded from a checkpoint afterwards
     }
 
     def __init__(self, config):
@@ -221,12 +277,13 @@ class SuperGlue(nn.Module):
         bin_score = torch.nn.Parameter(torch.tensor(1.))
         self.register_parameter('bin_score', bin_score)
 
-        assert self.config['weights'] in ['indoor', 'outdoor']
-        path = Path(__file__).parent
-        path = path / 'weights/superglue_{}.pth'.format(self.config['weights'])
-        self.load_state_dict(torch.load(path))
-        print('Loaded SuperGlue model (\"{}\" weights)'.format(
-            self.config['weights']))
+        if self.config['pretrained']:
+            assert self.config['weights'] in ['indoor', 'outdoor']
+            path = Path(__file__).parent
+            path = path / 'weights/superglue_{}.pth'.format(self.config['weights'])
+            self.load_state_dict(torch.load(path))
+            print('Loaded SuperGlue model (\"{}\" weights)'.format(
+                self.config['weights']))
 
     def forward(self, data):
         """Run SuperGlue on a pair of keypoints and descriptors"""
@@ -253,8 +310,11 @@ class SuperGlue(nn.Module):
         desc0 = desc0 + self.kenc(kpts0, data['scores0'])
         desc1 = desc1 + self.kenc(kpts1, data['scores1'])
 
+        # Masks of valid keypoints when padded keypoint sets are batched.
+        mask0, mask1 = data.get('mask0'), data.get('mask1')
+
         # Multi-layer Transformer network.
-        desc0, desc1 = self.gnn(desc0, desc1)
+        desc0, desc1 = self.gnn(desc0, desc1, mask0, mask1)
 
         # Final MLP projection.
         mdesc0, mdesc1 = self.final_proj(desc0), self.final_proj(desc1)
@@ -264,9 +324,11 @@ class SuperGlue(nn.Module):
         scores = scores / self.config['descriptor_dim']**.5
 
         # Run the optimal transport.
-        scores = log_optimal_transport(
+        scores, sinkhorn_iterations = masked_log_optimal_transport(
             scores, self.bin_score,
-            iters=self.config['sinkhorn_iterations'])
+            iters=self.config['sinkhorn_iterations'],
+            mask0=mask0, mask1=mask1,
+            tol=0. if self.training else self.config['sinkhorn_tolerance'])
 
         # Get the matches with score above "match_threshold".
         max0, max1 = scores[:, :-1, :-1].max(2), scores[:, :-1, :-1].max(1)
@@ -287,4 +349,5 @@ class SuperGlue(nn.Module):
             'matching_scores0': mscores0,
             'matching_scores1': mscores1,
             'scores': scores,
+            'sinkhorn_iterations': sinkhorn_iterations,
         }
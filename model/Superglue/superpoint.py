@@ -79,6 +79,25 @@ def top_k_keypoints(keypoints, scores, k: int):
     return keypoints[indices], scores
 
 
+def grid_top_k_keypoints(keypoints, scores, k: int, cells: int, height: int, width: int):
+    """ Keep k keypoints spread over a cells * cells grid: the best keypoint of every cell
+    is taken first, then the second best of every cell and so on, by decreasing score """
+    if k >= len(keypoints):
+        return keypoints, scores
+    cell_ids = (keypoints[:, 0] * cells // height) * cells + keypoints[:, 1] * cells // width
+    # sort by cell, then by decreasing score within each cell
+    order = torch.argsort(scores, descending=True)
+    order = order[torch.sort(cell_ids[order], stable=True).indices]
+    sorted_cell_ids = cell_ids[order]
+    counts = torch.bincount(sorted_cell_ids, minlength=cells * cells)
+    starts = torch.cumsum(counts, 0) - counts
+    ranks = torch.arange(len(order), device=keypoints.device) - starts[sorted_cell_ids]
+    # scores are in [0, 1], the rank in the cell comes first
+    _, indices = torch.topk(scores[order] - ranks.to(scores), k, dim=0)
+    indices = order[indices]
+    return keypoints[indices], scores[indices]
+
+
 def sample_descriptors(keypoints, descriptors, s: int = 8):
     """ Interpolate descriptors at keypoint locations """
     b, c, h, w = descriptors.shape
@@ -107,7 +126,9 @@ class SuperPoint(nn.Module):
         'nms_radius': 4,
         'keypoint_threshold': 0.005,
         'max_keypoints': -1,
+        'grid_cells': 0,  # > 0 to spread the max_keypoints over a grid_cells * grid_cells grid
         'remove_borders': 4,
+        'pretrained': True,  # False when the weights are loaded from a checkpoint afterwards
     }
 
     def __init__(self, config):
@@ -136,19 +157,30 @@ class SuperPoint(nn.Module):
             c5, self.config['descriptor_dim'],
             kernel_size=1, stride=1, padding=0)
 
-        path = Path(__file__).parent / 'weights/superpoint_v1.pth'
-        self.load_state_dict(torch.load(str(path)))
+        if self.config['pretrained']:
+            path = Path(__file__).parent / 'weights/superpoint_v1.pth'
+            self.load_state_dict(torch.load(str(path)))
 
         mk = self.config['max_keypoints']
         if mk == 0 or mk < -1:
             raise ValueError('\"max_keypoints\" must be positive or \"-1\"')
 
-        print('Loaded SuperPoint model')
+        if self.config['pretrained']:
+            print('Loaded SuperPoint model')
 
     def forward(self, data):
-        """ Compute keypoints, scores, descriptors for image """
+        """ Compute keypoints, scores, descriptors for image
+        data['max_keypoints'] optionally overrides config 'max_keypoints' for this call
+        """
+        scores, descriptors = self.forward_dense(data['image'])
+        return self.extract_keypoints(scores, descriptors, data.get('max_keypoints', self.config['max_keypoints']))
+
+    def forward_dense(self, image):
+        """ Dense part of the network, which can be exported as a static graph
+        :return: scores: B * H * W after NMS, descriptors: B * D * H/8 * W/8
+        """
         # Shared Encoder
-        x = self.relu(self.conv1a(data['image']))
+        x = self.relu(self.conv1a(image))
         x = self.relu(self.conv1b(x))
         x = self.pool(x)
         x = self.relu(self.conv2a(x))
@@ -169,6 +201,16 @@ class SuperPoint(nn.Module):
         scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h*8, w*8)
         scores = simple_nms(scores, self.config['nms_radius'])
 
+        # Compute the dense descriptors
+        cDa = self.relu(self.convDa(x))
+        descriptors = self.convDb(cDa)
+        descriptors = torch.nn.functional.normalize(descriptors, p=2., dim=1)
+        return scores, descriptors
+
+    def extract_keypoints(self, scores, descriptors, max_keypoints: int):
+        """ Sparse part of the network: keypoints and their descriptors from the dense outputs """
+        h, w = scores.shape[1] // 8, scores.shape[2] // 8
+
         # Extract keypoints
         keypoints = [
             torch.nonzero(s > self.config['keypoint_threshold'])
@@ -181,19 +223,18 @@ class SuperPoint(nn.Module):
             for k, s in zip(keypoints, scores)]))
 
         # Keep the k keypoints with highest score
-        if self.config['max_keypoints'] >= 0:
+        if max_keypoints >= 0 and self.config['grid_cells'] > 0:
             keypoints, scores = list(zip(*[
-                top_k_keypoints(k, s, self.config['max_keypoints'])
+                grid_top_k_keypoints(k, s, max_keypoints, self.config['grid_cells'], h*8, w*8)
+                for k, s in zip(keypoints, scores)]))
+        elif max_keypoints >= 0:
+            keypoints, scores = list(zip(*[
+                top_k_keypoints(k, s, max_keypoints)
                 for k, s in zip(keypoints, scores)]))
 
         # Convert (h, w) to (x, y)
         keypoints = [torch.flip(k, [1]).float() for k in keypoints]
 
-        # Compute the dense descriptors
-        cDa = self.relu(self.convDa(x))
-        descriptors = self.convDb(cDa)
-        descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
-
         # Extract descriptors
         descriptors = [sample_descriptors(k[None], d[None], 8)[0]
                        for k, d in zip(keypoints, descriptors)]
@@ -205,6 +246,16 @@ class SuperPoint(nn.Module):
         }
 
 
+class SuperPointDense(nn.Module):
+    """ Dense part of SuperPoint with a tensor-only interface, for tracing and ONNX export """
+    def __init__(self, superpoint):
+        super().__init__()
+        self.superpoint = superpoint
+
+    def forward(self, image):
+        return self.superpoint.forward_dense(image)
+
+
 if __name__ == '__main__':
     device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
     superpoint = SuperPoint({}).to(device)